@@ -0,0 +1,241 @@
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from parser_ruby import *
+from compiler import BINARY_OPS, UNARY_OPS
+from vm import BINARY_FUNCS, UNARY_FUNCS
+
+#ints are kept in int64 columns while they stay below this magnitude, so
+#every int64 operation and every conversion to float64 is exact; larger
+#ints move to object columns holding python ints
+INT_LIMIT = 2 ** 53
+
+ARITHMETIC_OPS = (PLUS, MINUS, MUL, DIV, MOD)
+BINARY = dict(zip(BINARY_OPS, BINARY_FUNCS))
+UNARY = dict(zip(UNARY_OPS, UNARY_FUNCS))
+
+
+def make_column(values):
+    """Returns the narrowest numpy column that keeps the python type of every value.
+
+    All bools, all small ints or all floats get a bool, int64 or float64
+    column, anything else (strings, big ints, mixed types) an object
+    column so every lane keeps its exact value and type.
+    """
+    types = set(type(value) for value in values)
+    if types == {bool}:
+        return numpy.array(values, dtype=bool)
+    if types == {int} and all(-INT_LIMIT < value < INT_LIMIT for value in values):
+        return numpy.array(values, dtype=numpy.int64)
+    if types == {float}:
+        return numpy.array(values, dtype=numpy.float64)
+    column = numpy.empty(len(values), dtype=object)
+    column[:] = values
+    return column
+
+
+def constant_column(value, count):
+    if type(value) is bool:
+        return numpy.full(count, value, dtype=bool)
+    if type(value) is int and -INT_LIMIT < value < INT_LIMIT:
+        return numpy.full(count, value, dtype=numpy.int64)
+    if type(value) is float:
+        return numpy.full(count, value, dtype=numpy.float64)
+    column = numpy.empty(count, dtype=object)
+    column.fill(value)
+    return column
+
+
+def vectorizable(tree):
+    """Tells whether BatchInterpreter can run tree, collections and methods are not columns"""
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, (ArrayLiteral, RangeLiteral, MethodCall, For, Def, Call)):
+            return False
+        stack.extend(iter_child_nodes(node))
+    return True
+
+
+def max_magnitude(column):
+    return int(numpy.abs(column).max()) if len(column) else 0
+
+
+class BatchInterpreter(object):
+    """Runs one tree over many sets of starting bindings at once.
+
+    Every variable is a numpy column with one lane per input set.
+    Expressions become array operations over the lanes that are active,
+    If/Else arms run on the lanes selected by their condition and a
+    While keeps iterating only the lanes whose condition still holds.
+    Lanes are tracked as an index array, None standing for all of them,
+    so inactive lanes are never computed on and cannot raise.
+
+    Every lane gets the result the tree walking Interpreter would give
+    it. The first error of any lane is raised for the whole batch.
+    """
+
+    def __init__(self, tree, columns, lanes=None):
+        if numpy is None:
+            raise ImportError('BatchInterpreter needs numpy')
+        self.tree = tree
+        lengths = set(len(values) for values in columns.values())
+        if lanes is not None:
+            lengths.add(lanes)
+        if len(lengths) != 1:
+            raise ValueError('every binding column needs the same number of lanes')
+        self.lanes = lengths.pop()
+        # name -> column, and name -> bool column of the lanes that have a
+        # value or None when all of them have one
+        self.values = {}
+        self.bound = {}
+        for name, values in columns.items():
+            values = list(values)
+            bound = numpy.array([value is not None for value in values], dtype=bool)
+            if bound.all():
+                self.values[name] = make_column(values)
+                self.bound[name] = None
+            else:
+                present = make_column([value for value in values if value is not None])
+                self.values[name] = self.scatter(None, numpy.flatnonzero(bound), present)
+                self.bound[name] = bound
+
+    def count(self, lanes):
+        return self.lanes if lanes is None else len(lanes)
+
+    def scatter(self, column, lanes, values):
+        """Returns a copy of column with values stored in lanes"""
+        if column is None:
+            column = numpy.empty(self.lanes, dtype=values.dtype)
+            if values.dtype == object:
+                column.fill(None)
+        if column.dtype != values.dtype:
+            column = column.astype(object)
+            values = values.astype(object)
+        else:
+            column = column.copy()
+        column[lanes] = values
+        return column
+
+    def evaluate(self, node, lanes):
+        """Returns the column of an expression over lanes"""
+        kind = type(node)
+        if isinstance(node, BinOp):
+            return self.binary(node, self.evaluate(node.left, lanes), self.evaluate(node.right, lanes))
+        if kind is Num:
+            return constant_column(node.value, self.count(lanes))
+        if kind is Var:
+            return self.load(node.value, lanes)
+        if isinstance(node, UnaryOp):
+            return self.unary(node, self.evaluate(node.expr, lanes))
+        raise Exception('Cannot evaluate {}'.format(kind.__name__))
+
+    def load(self, name, lanes):
+        column = self.values.get(name)
+        bound = self.bound.get(name)
+        if column is None or (bound is not None and not (bound if lanes is None else bound[lanes]).all()):
+            raise NameError(repr(name))
+        return column if lanes is None else column[lanes]
+
+    def binary(self, node, left, right):
+        op = node.op.type
+        if op in ARITHMETIC_OPS:
+            # python treats bools as the ints 0 and 1 in arithmetic
+            if left.dtype == bool:
+                left = left.astype(numpy.int64)
+            if right.dtype == bool:
+                right = right.astype(numpy.int64)
+            if left.dtype == numpy.int64 and right.dtype == numpy.int64:
+                if op == MUL and max_magnitude(left) * max_magnitude(right) >= 2 ** 63:
+                    left = left.astype(object)
+            if (op == DIV or op == MOD) and left.dtype != object and right.dtype != object:
+                zero = numpy.flatnonzero(right == 0)
+                if len(zero):
+                    # raises the error python gives for this lane
+                    BINARY[op](left[zero[0]].item(), right[zero[0]].item())
+        with numpy.errstate(all='ignore'):
+            result = BINARY[op](left, right)
+        if result.dtype == numpy.int64 and max_magnitude(result) >= INT_LIMIT:
+            result = result.astype(object)
+        return result
+
+    def unary(self, node, operand):
+        if operand.dtype == bool:
+            operand = operand.astype(numpy.int64)
+        return UNARY[node.op.type](operand)
+
+    def truth(self, column):
+        return column.astype(bool)
+
+    def execute(self, node, lanes):
+        """Runs a statement, a statement list or an Else on lanes"""
+        if lanes is not None and not len(lanes):
+            return
+        if isinstance(node, list):
+            for child in node:
+                self.execute(child, lanes)
+        elif isinstance(node, Assign):
+            self.store(node.left.value, lanes, self.evaluate(node.right, lanes))
+        elif isinstance(node, If):
+            self.execute_If(node, lanes)
+        elif isinstance(node, While):
+            self.execute_While(node, lanes)
+        elif isinstance(node, Compound):
+            self.execute(node.children, lanes)
+        elif isinstance(node, Else):
+            self.execute(node.body, lanes)
+        elif not isinstance(node, NoOp):
+            raise Exception('Cannot execute {}'.format(type(node).__name__))
+
+    def store(self, name, lanes, values):
+        if lanes is None:
+            self.values[name] = values
+            self.bound[name] = None
+            return
+        column = self.values.get(name)
+        bound = self.bound[name] if column is not None else numpy.zeros(self.lanes, dtype=bool)
+        self.values[name] = self.scatter(column, lanes, values)
+        if bound is not None:
+            bound = bound.copy()
+            bound[lanes] = True
+            if bound.all():
+                bound = None
+        self.bound[name] = bound
+
+    def select(self, lanes, condition):
+        """Returns the (true, false) lanes of a condition column over lanes"""
+        if condition.all():
+            return lanes, numpy.empty(0, dtype=numpy.intp)
+        if lanes is None:
+            return numpy.flatnonzero(condition), numpy.flatnonzero(~condition)
+        return lanes[condition], lanes[~condition]
+
+    def execute_If(self, node, lanes):
+        taken, rest = self.select(lanes, self.truth(self.evaluate(node.condition, lanes)))
+        self.execute(node.body, taken)
+        self.execute(node.rest, rest)
+
+    def execute_While(self, node, lanes):
+        while True:
+            lanes = self.select(lanes, self.truth(self.evaluate(node.condition, lanes)))[0]
+            if lanes is not None and not len(lanes):
+                return
+            self.execute(node.body, lanes)
+
+    def run(self):
+        """Runs the tree and returns {name: list of the final value of every lane}.
+
+        A lane in which a variable was never set holds None.
+        """
+        if self.tree is not None:
+            self.execute(self.tree, None)
+        result = {}
+        for name, column in self.values.items():
+            values = column.tolist()
+            bound = self.bound[name]
+            if bound is not None:
+                values = [value if ok else None for value, ok in zip(values, bound.tolist())]
+            result[name] = values
+        return result
@@ -0,0 +1,175 @@
+import argparse
+import gc
+import json
+import sys
+import time
+import tracemalloc
+
+from lexer import *
+from parser_ruby import *
+from runner import BACKENDS
+from workloads import *
+
+STAGES = ('lex', 'parse', 'execute')
+
+
+def best_time(func, repeat):
+    """Runs func repeat times and returns (fastest run in seconds, last result)"""
+    best = None
+    result = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def peak_memory(func):
+    """Returns the peak number of bytes allocated while func runs"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def rate(count, seconds):
+    return count / seconds if seconds else 0.0
+
+
+def measure(workload, backend='vm', repeat=3, memory=True):
+    """Times the Lexer, Parser and backend on a workload separately.
+
+    Timings are the best of repeat runs. Peak memory is measured in an
+    extra run of every stage since tracing allocations skews the timings.
+    """
+    source = workload.source
+    run = BACKENDS[backend]
+    result = {'workload': workload.name, 'backend': backend, 'error': None}
+    try:
+        lex_time, tokens = best_time(lambda: Lexer(source).tokens(), repeat)
+        parse_time, tree = best_time(lambda: Parser(ReplayLexer(tokens)).parse(), repeat)
+        execute_time, _ = best_time(lambda: run(tree).interpret(), repeat)
+        stages = {
+            'lex': {'seconds': lex_time, 'tokens_per_s': rate(len(tokens), lex_time)},
+            'parse': {'seconds': parse_time, 'nodes_per_s': rate(count_nodes(tree), parse_time)},
+            'execute': {'seconds': execute_time, 'iterations_per_s': rate(workload.iterations, execute_time)},
+        }
+        if memory:
+            stages['lex']['peak_bytes'] = peak_memory(lambda: Lexer(source).tokens())
+            stages['parse']['peak_bytes'] = peak_memory(lambda: Parser(ReplayLexer(tokens)).parse())
+            stages['execute']['peak_bytes'] = peak_memory(lambda: run(tree).interpret())
+        result.update(tokens=len(tokens), nodes=count_nodes(tree), iterations=workload.iterations, stages=stages)
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    return result
+
+
+def run_benchmarks(scale=1.0, backend='vm', repeat=3, names=None, memory=True):
+    return [measure(workload, backend, repeat, memory) for workload in generate_all(scale, names)]
+
+
+def make_baseline(results, scale, backend):
+    """Keeps the stage timings of results in the baseline file format"""
+    baseline = {'scale': scale, 'backend': backend, 'results': {}}
+    for result in results:
+        if result['error'] is None:
+            baseline['results'][result['workload']] = {
+                stage: result['stages'][stage]['seconds'] for stage in STAGES
+            }
+    return baseline
+
+
+def compare(results, baseline, threshold=0.25, min_delta=0.001):
+    """Returns the stages that got slower than baseline by more than threshold.
+
+    Slowdowns smaller than min_delta seconds are ignored as timer noise.
+    Each regression is (workload, stage, baseline seconds, current seconds),
+    a workload that fails now but has a baseline regresses on every stage.
+    """
+    regressions = []
+    for result in results:
+        expected = baseline['results'].get(result['workload'])
+        if expected is None:
+            continue
+        for stage in STAGES:
+            if stage not in expected:
+                continue
+            if result['error'] is not None:
+                regressions.append((result['workload'], stage, expected[stage], None))
+                continue
+            seconds = result['stages'][stage]['seconds']
+            if seconds > expected[stage] * (1 + threshold) and seconds - expected[stage] > min_delta:
+                regressions.append((result['workload'], stage, expected[stage], seconds))
+    return regressions
+
+
+def format_report(results):
+    lines = ['{:<18} {:<8} {:>10} {:>16} {:>12}'.format('workload', 'stage', 'seconds', 'throughput', 'peak KiB')]
+    for result in results:
+        if result['error'] is not None:
+            lines.append('{:<18} {}'.format(result['workload'], result['error']))
+            continue
+        for stage in STAGES:
+            data = result['stages'][stage]
+            throughput = ''
+            for key, unit in (('tokens_per_s', 'tok/s'), ('nodes_per_s', 'nodes/s'), ('iterations_per_s', 'it/s')):
+                if data.get(key):
+                    throughput = '{:.0f} {}'.format(data[key], unit)
+            peak = data.get('peak_bytes')
+            lines.append('{:<18} {:<8} {:>10.4f} {:>16} {:>12}'.format(
+                result['workload'], stage, data['seconds'], throughput,
+                '' if peak is None else '{:.0f}'.format(peak / 1024)))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Lexer, Parser and a backend on generated workloads.')
+    parser.add_argument('--scale', type=float, default=1.0, help='size multiplier of every workload')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage, the fastest one is kept')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='vm')
+    parser.add_argument('--workload', action='append', choices=sorted(GENERATORS),
+                        help='run only this workload, may be given several times')
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help='skip the peak memory runs')
+    parser.add_argument('--json', action='store_true', help='print the raw results as JSON')
+    parser.add_argument('--save-baseline', metavar='FILE', help='write the timings to FILE')
+    parser.add_argument('--compare', metavar='FILE', help='fail if a stage regressed against the baseline FILE')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed slowdown before a stage counts as regressed (0.25 = 25%%)')
+    parser.add_argument('--min-delta', type=float, default=0.001,
+                        help='ignore slowdowns smaller than this many seconds')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.scale, args.backend, args.repeat, args.workload, args.memory)
+    print(json.dumps(results, indent=2) if args.json else format_report(results))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as file:
+            json.dump(make_baseline(results, args.scale, args.backend), file, indent=2)
+
+    status = 0
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if baseline.get('scale') != args.scale or baseline.get('backend') != args.backend:
+            print('warning: baseline was recorded with scale={} backend={}'.format(
+                baseline.get('scale'), baseline.get('backend')), file=sys.stderr)
+        for workload, stage, expected, seconds in compare(results, baseline, args.threshold, args.min_delta):
+            status = 1
+            if seconds is None:
+                print('REGRESSION {} {}: failed, baseline {:.4f}s'.format(workload, stage, expected), file=sys.stderr)
+            else:
+                print('REGRESSION {} {}: {:.4f}s vs baseline {:.4f}s (+{:.0%})'.format(
+                    workload, stage, seconds, expected, seconds / expected - 1), file=sys.stderr)
+    if any(result['error'] is not None for result in results):
+        status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
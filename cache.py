@@ -0,0 +1,307 @@
+import gc
+import hashlib
+import marshal
+import os
+import tempfile
+
+from parser_ruby import *
+from optimizer import optimize
+
+#bump whenever the parser, the optimizer or the encoding below changes
+CACHE_VERSION = 'rb6'
+CACHE_MAGIC = b'RBC1'
+CACHE_SUFFIX = '.rbc'
+DEFAULT_CACHE_DIR = '__rbcache__'
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+#node tags of the encoded program
+(K_NUM, K_VAR, K_BINOP, K_UNARY, K_ASSIGN, K_COMPOUND, K_LIST, K_IF, K_ELSE, K_WHILE, K_NOOP,
+ K_ARRAY, K_RANGE, K_CALL, K_FOR, K_DEF, K_INVOKE, K_RETURN) = range(18)
+
+
+def encode(tree):
+    """Flattens a tree into a list of primitives in post-order.
+
+    Children come before their parent so decode() can rebuild the tree
+    with a stack, neither function recurses. Every node record starts
+    with its tag and source line and column.
+    """
+    out = []
+    stack = [(tree, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if not expanded:
+            stack.append((node, True))
+            children = list(iter_child_nodes(node))
+            for child in reversed(children):
+                stack.append((child, False))
+            continue
+        if isinstance(node, list):
+            out.extend((K_LIST, len(node)))
+            continue
+        if isinstance(node, Num):
+            out.extend((K_NUM, node.line, node.column, node.token.type, node.value))
+        elif isinstance(node, Var):
+            out.extend((K_VAR, node.line, node.column, node.value))
+        elif isinstance(node, BinOp):
+            out.extend((K_BINOP, node.line, node.column, node.op.type, node.op.value))
+        elif isinstance(node, UnaryOp):
+            out.extend((K_UNARY, node.line, node.column, node.op.type, node.op.value))
+        elif isinstance(node, Assign):
+            out.extend((K_ASSIGN, node.line, node.column, node.op.type, node.op.value))
+        elif isinstance(node, Compound):
+            out.extend((K_COMPOUND, node.line, node.column, len(node.children)))
+        elif isinstance(node, If):
+            out.extend((K_IF, node.line, node.column))
+        elif isinstance(node, Else):
+            out.extend((K_ELSE, node.line, node.column))
+        elif isinstance(node, While):
+            out.extend((K_WHILE, node.line, node.column))
+        elif isinstance(node, NoOp):
+            out.extend((K_NOOP, node.line, node.column))
+        elif isinstance(node, ArrayLiteral):
+            out.extend((K_ARRAY, node.line, node.column, len(node.items)))
+        elif isinstance(node, RangeLiteral):
+            out.extend((K_RANGE, node.line, node.column, node.exclusive))
+        elif isinstance(node, MethodCall):
+            # param is None for a call without a block
+            out.extend((K_CALL, node.line, node.column, node.name, node.param))
+        elif isinstance(node, For):
+            out.extend((K_FOR, node.line, node.column))
+        elif isinstance(node, Def):
+            out.extend((K_DEF, node.line, node.column, node.name, tuple(node.params), node.memoize))
+        elif isinstance(node, Call):
+            out.extend((K_INVOKE, node.line, node.column, node.name, len(node.args), node.statement))
+        elif isinstance(node, Return):
+            out.extend((K_RETURN, node.line, node.column))
+        else:
+            raise Exception('Cannot encode {}'.format(type(node).__name__))
+    return out
+
+
+def decode(data):
+    """Rebuilds the tree encoded by encode()"""
+    #decoding only allocates acyclic nodes, running the cyclic garbage
+    #collector over them would cost more than the decoding itself
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _decode(data)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def _decode(data):
+    stack = []
+    pos = 0
+    end = len(data)
+    while pos < end:
+        tag = data[pos]
+        if tag == K_LIST:
+            count = data[pos + 1]
+            children = stack[len(stack) - count:]
+            del stack[len(stack) - count:]
+            stack.append(children)
+            pos += 2
+            continue
+        line = data[pos + 1]
+        column = data[pos + 2]
+        pos += 3
+        if tag == K_NUM:
+            node = Num(Token(data[pos], data[pos + 1], line, column))
+            pos += 2
+        elif tag == K_VAR:
+            node = Var(Token(ID, data[pos], line, column))
+            pos += 1
+        elif tag == K_BINOP:
+            right = stack.pop()
+            node = BinOp(stack.pop(), FIXED_TOKENS[data[pos + 1]], right)
+            pos += 2
+        elif tag == K_UNARY:
+            node = UnaryOp(FIXED_TOKENS[data[pos + 1]], stack.pop())
+            pos += 2
+        elif tag == K_ASSIGN:
+            right = stack.pop()
+            node = Assign(stack.pop(), FIXED_TOKENS[data[pos + 1]], right)
+            pos += 2
+        elif tag == K_COMPOUND:
+            count = data[pos]
+            node = Compound()
+            node.children = stack[len(stack) - count:]
+            del stack[len(stack) - count:]
+            pos += 1
+        elif tag == K_IF:
+            rest = stack.pop()
+            body = stack.pop()
+            node = If(stack.pop(), body, rest)
+        elif tag == K_ELSE:
+            node = Else(stack.pop())
+        elif tag == K_WHILE:
+            body = stack.pop()
+            node = While(stack.pop(), body)
+        elif tag == K_NOOP:
+            node = NoOp()
+        elif tag == K_ARRAY:
+            count = data[pos]
+            node = ArrayLiteral(stack[len(stack) - count:])
+            del stack[len(stack) - count:]
+            pos += 1
+        elif tag == K_RANGE:
+            last = stack.pop()
+            node = RangeLiteral(stack.pop(), last, data[pos])
+            pos += 1
+        elif tag == K_CALL:
+            param = data[pos + 1]
+            body = stack.pop() if param is not None else None
+            node = MethodCall(stack.pop(), data[pos], param, body)
+            pos += 2
+        elif tag == K_FOR:
+            body = stack.pop()
+            iterable = stack.pop()
+            node = For(stack.pop(), iterable, body)
+        elif tag == K_DEF:
+            node = Def(data[pos], list(data[pos + 1]), stack.pop(), data[pos + 2])
+            pos += 3
+        elif tag == K_INVOKE:
+            count = data[pos + 1]
+            node = Call(data[pos], stack[len(stack) - count:])
+            del stack[len(stack) - count:]
+            node.statement = data[pos + 2]
+            pos += 3
+        elif tag == K_RETURN:
+            node = Return(stack.pop())
+        else:
+            raise Exception('Corrupt program cache entry')
+        node.line = line
+        node.column = column
+        stack.append(node)
+    if len(stack) != 1:
+        raise Exception('Corrupt program cache entry')
+    return stack[0]
+
+
+class ProgramCache(object):
+    """Size bounded on-disk cache of parsed programs.
+
+    Entries are keyed by the hash of the source text plus CACHE_VERSION,
+    written atomically and evicted least recently used first once the
+    directory grows past max_bytes. A hit refreshes the mtime of its
+    entry, which is what the eviction order is based on.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def key(self, source, optimized):
+        digest = hashlib.sha256()
+        digest.update('{}:{}:{}\0'.format(CACHE_VERSION, marshal.version, int(optimized)).encode())
+        digest.update(source.encode('utf-8', 'surrogatepass'))
+        return digest.hexdigest()
+
+    def path(self, source, optimized):
+        return os.path.join(self.cache_dir, self.key(source, optimized) + CACHE_SUFFIX)
+
+    def load(self, source, optimized=True):
+        """Returns the cached tree of source, or None on a miss"""
+        path = self.path(source, optimized)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+        except OSError:
+            return None
+        if not data.startswith(CACHE_MAGIC):
+            return None
+        try:
+            tree = decode(marshal.loads(data[len(CACHE_MAGIC):]))
+        except Exception:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return tree
+
+    def store(self, source, tree, optimized=True):
+        """Writes tree to the cache, the entry becomes visible atomically"""
+        data = CACHE_MAGIC + marshal.dumps(encode(tree))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_path, self.path(source, optimized))
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        self.evict()
+
+    def entries(self):
+        """Returns (mtime, size, path) of every entry, oldest first"""
+        entries = []
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return entries
+        for name in names:
+            if not name.endswith(CACHE_SUFFIX):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        return entries
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in max_bytes"""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Removes every entry of the cache"""
+        for _, _, path in self.entries():
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+def parse_source(source, optimized=True, dump=False):
+    """Lexes and parses source, optimizing the tree when optimized is set"""
+    tree = Parser(Lexer(source)).parse()
+    if optimized:
+        tree = optimize(tree, dump=dump)
+    return tree
+
+
+def load_program(source, cache=None, optimized=True, bypass=False, dump=False):
+    """Returns the tree of source, from cache when possible.
+
+    With bypass set (or no cache) the source is always parsed and the
+    cache is neither read nor written.
+    """
+    if cache is None or bypass:
+        return parse_source(source, optimized, dump)
+    tree = cache.load(source, optimized)
+    if tree is None:
+        tree = parse_source(source, optimized, dump)
+        try:
+            cache.store(source, tree, optimized)
+        except OSError:
+            pass
+    return tree
@@ -0,0 +1,238 @@
+import marshal
+import os
+import signal
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+
+from compiler import Compiler
+from vm import VM
+from cache import ProgramCache
+from methods import uses_methods
+from rope import Rope, flatten
+from collection import Array, Range
+
+#bump whenever the bytecode layout or the encoding below changes
+CHECKPOINT_VERSION = 1
+CHECKPOINT_MAGIC = b'RBS1'
+#instructions run between two looks at the clock and the signals
+CHECKPOINT_BUDGET = 100000
+#seconds between two checkpoints unless asked otherwise
+DEFAULT_INTERVAL = 60.0
+
+#tags of the encoded values marshal cannot hold as they are, anything
+#else (ints, floats, strings, booleans, None) is written as itself
+V_ARRAY, V_LIST, V_RANGE, V_ITER, V_RANGE_ITER = range(5)
+
+#iterators a for loop can leave on the value stack, see collection.iterate()
+ITERATOR_TYPES = tuple(set(type(iter(sequence)) for sequence in
+                           ([], (), array('q'), range(0), range(2 ** 64))))
+
+
+class CheckpointError(Exception):
+    """A checkpoint cannot be written, read or resumed"""
+
+
+def encode_value(value):
+    """Returns a value as marshal data.
+
+    Ropes are joined, Arrays keep their storage (the bytes of an array
+    buffer, or the encoded elements of a list), Ranges their bounds and
+    an iterator its sequence and how far it got.
+    """
+    kind = type(value)
+    if kind is Rope:
+        return flatten(value)
+    if kind is Array:
+        items = value.items
+        if type(items) is array:
+            return (V_ARRAY, items.typecode, items.tobytes())
+        return (V_LIST, [encode_value(item) for item in items])
+    if kind is Range:
+        return (V_RANGE, value.first, value.last, value.exclusive)
+    if kind in ITERATOR_TYPES:
+        reduced = value.__reduce__()
+        sequence = reduced[1][0]
+        # an exhausted iterator reduces to an empty sequence without an index
+        index = reduced[2] if len(reduced) > 2 else 0
+        if type(sequence) is range:
+            return (V_RANGE_ITER, sequence.start, sequence.stop, sequence.step, index)
+        return (V_ITER, encode_value(Array(sequence)), index)
+    if kind in (int, float, str, bool) or value is None:
+        return value
+    raise CheckpointError('cannot checkpoint a {}'.format(kind.__name__))
+
+
+def decode_value(data):
+    if type(data) is not tuple:
+        return data
+    tag = data[0]
+    if tag == V_ARRAY:
+        items = array(data[1])
+        items.frombytes(data[2])
+        return Array(items)
+    if tag == V_LIST:
+        return Array([decode_value(item) for item in data[1]])
+    if tag == V_RANGE:
+        return Range(data[1], data[2], data[3])
+    if tag == V_RANGE_ITER:
+        iterator = iter(range(data[1], data[2], data[3]))
+        iterator.__setstate__(data[4])
+        return iterator
+    if tag == V_ITER:
+        iterator = iter(decode_value(data[1]).items)
+        iterator.__setstate__(data[2])
+        return iterator
+    raise CheckpointError('corrupt checkpoint')
+
+
+def program_key(source, optimized=True):
+    """Returns the key a checkpoint of source is valid for"""
+    return ProgramCache().key(source, optimized)
+
+
+def compile_program(tree):
+    """Returns the Bytecode of a tree that can be checkpointed"""
+    if uses_methods(tree):
+        raise CheckpointError('a program defining methods runs on the tree walker and cannot be checkpointed')
+    return Compiler(tree).compile()
+
+
+def dumps(vm, key):
+    """Returns the state of a VM between two slices as compact bytes.
+
+    Loops and branches are jumps in the bytecode, so the position in the
+    program, the loops and branches it is inside of and the iterators of
+    its for loops are all held by the program counter and the value
+    stack; together with the variables and the hoisted values they are
+    the whole state of the run.
+    """
+    state = (
+        CHECKPOINT_VERSION,
+        key,
+        vm.pc,
+        vm.steps,
+        vm.halted,
+        [encode_value(value) for value in vm.frame],
+        [encode_value(value) for value in vm.stack],
+        [encode_value(value) for value in vm.hoisted],
+    )
+    return CHECKPOINT_MAGIC + zlib.compress(marshal.dumps(state), 1)
+
+
+def loads(data, bytecode, key):
+    """Returns a VM running bytecode from where the state in data stopped"""
+    if not data.startswith(CHECKPOINT_MAGIC):
+        raise CheckpointError('not a checkpoint')
+    try:
+        state = marshal.loads(zlib.decompress(data[len(CHECKPOINT_MAGIC):]))
+    except (ValueError, EOFError, TypeError, zlib.error):
+        raise CheckpointError('corrupt checkpoint')
+    version, state_key, pc, steps, halted, frame, stack, hoisted = state
+    if version != CHECKPOINT_VERSION:
+        raise CheckpointError('checkpoint of another version')
+    if state_key != key:
+        raise CheckpointError('checkpoint of another program')
+    vm = VM(bytecode)
+    if len(frame) != len(vm.frame) or len(hoisted) != len(vm.hoisted):
+        raise CheckpointError('corrupt checkpoint')
+    vm.frame[:] = [decode_value(value) for value in frame]
+    vm.stack[:] = [decode_value(value) for value in stack]
+    vm.hoisted[:] = [decode_value(value) for value in hoisted]
+    vm.pc = pc
+    vm.steps = steps
+    vm.halted = halted
+    return vm
+
+
+def save(vm, key, path):
+    """Writes a checkpoint of vm to path, replacing the old one atomically"""
+    data = dumps(vm, key)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    return len(data)
+
+
+def restore(bytecode, key, path):
+    with open(path, 'rb') as file:
+        return loads(file.read(), bytecode, key)
+
+
+class CheckpointedRun(object):
+    """Runs a program on the VM in slices, writing its state to a file as it goes.
+
+    A checkpoint is written every interval seconds (never when interval
+    is None), on SIGUSR1 and on SIGTERM, which then stops the run, so a
+    restart continues from where it was told to stop. With resume set the
+    run starts from the checkpoint at that path instead of the beginning;
+    many runs can start from the same one. checkpoints counts the ones
+    written.
+    """
+
+    def __init__(self, source, tree, path=None, interval=DEFAULT_INTERVAL, resume=None,
+                 optimized=True, budget=CHECKPOINT_BUDGET):
+        self.key = program_key(source, optimized)
+        bytecode = compile_program(tree)
+        self.vm = restore(bytecode, self.key, resume) if resume else VM(bytecode)
+        self.path = path
+        self.interval = interval
+        self.budget = budget
+        self.checkpoints = 0
+        self.stopped = False
+        # signal name -> True to stop after the checkpoint, set by the handlers
+        self._requested = None
+
+    @property
+    def GLOBAL_MEMORY(self):
+        return self.vm.GLOBAL_MEMORY
+
+    def checkpoint(self):
+        if self.path is not None:
+            save(self.vm, self.key, self.path)
+            self.checkpoints += 1
+
+    def _request(self, signum, frame):
+        self._requested = self._requested or signum == signal.SIGTERM
+
+    def run(self):
+        """Runs the program to its end, returns False when SIGTERM stopped it first"""
+        handlers = {}
+        if self.path is not None and threading.current_thread() is threading.main_thread():
+            for name in ('SIGUSR1', 'SIGTERM'):
+                signum = getattr(signal, name, None)
+                if signum is not None:
+                    handlers[signum] = signal.signal(signum, self._request)
+        try:
+            vm = self.vm
+            interval = self.interval
+            last = time.monotonic()
+            while not vm.run_slice(self.budget):
+                requested = self._requested
+                if requested is not None:
+                    self._requested = None
+                    self.checkpoint()
+                    last = time.monotonic()
+                    if requested:
+                        self.stopped = True
+                        return False
+                elif interval is not None and time.monotonic() - last >= interval:
+                    self.checkpoint()
+                    last = time.monotonic()
+            return True
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+    def interpret(self):
+        return self.run()
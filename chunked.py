@@ -0,0 +1,156 @@
+import codecs
+import marshal
+import mmap
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+from lexer import *
+from parser_ruby import *
+from cache import encode, decode
+
+#files smaller than this are parsed serially, starting a pool costs more
+MIN_PARALLEL_SIZE = 1 << 20
+#chunks per worker process, more of them even out uneven statements
+CHUNKS_PER_JOB = 4
+#bytes decoded past the end of a chunk for its last statement, doubled
+#while that statement does not fit
+OVERHANG = 64 * 1024
+
+#a line starting at column 0 with a word that can begin a statement: the
+#likely start of a top level statement in an indented script
+STATEMENT_START_RE = re.compile(rb'\n(?!(?:end|else|elsif|in|do)\b)(?=[A-Za-z_])')
+
+
+def split_points(source, count):
+    """Returns the (offset, line) of up to count likely top level statement starts, the first is (0, 1)"""
+    size = len(source)
+    points = [(0, 1)]
+    offset = 0
+    line = 1
+    for index in range(1, count):
+        m = STATEMENT_START_RE.search(source, max(size * index // count, offset))
+        if m is None:
+            break
+        start = m.end()
+        line += source[offset:start].count(b'\n')
+        points.append((start, line))
+        offset = start
+    return points
+
+
+def parse_range(source, start, stop, line, column):
+    """Parses the top level statements of a utf-8 buffer from start until one ends at or past stop.
+
+    start is the byte offset of a token at line and column, stop a line
+    start or the end of source. Only the text up to stop and an overhang
+    past it is decoded; a statement is kept once its lookahead token lies
+    wholly inside that text, so a lexeme cut by the end of the overhang is
+    never taken for a whole one. Returns the statements and the offset,
+    line and column of the token after them.
+    """
+    size = len(source)
+    head = source[start:stop].decode('utf-8')
+    overhang = OVERHANG
+    while True:
+        limit = min(stop + overhang, size)
+        complete = limit == size
+        text = head + codecs.getincrementaldecoder('utf-8')().decode(source[stop:limit], complete)
+        lexer = OffsetLexer(text)
+        lexer.line = line
+        lexer.line_start = 1 - column
+        parser = Parser(lexer)
+        statements = []
+        try:
+            while parser.current_token.type != EOF:
+                statements.append(parser.statement())
+                if lexer.match_start >= len(head):
+                    break
+        except Exception:
+            if complete or lexer.match_end < len(text):
+                raise
+        else:
+            if complete or lexer.match_end < len(text):
+                end = start + len(text[:lexer.match_start].encode('utf-8'))
+                return statements, end, lexer.token_line, lexer.token_column
+        overhang *= 2
+
+
+def parse_chunk(path, start, stop, line):
+    """Runs parse_range() on a chunk of a file in a worker process.
+
+    Returns the end offset, line and column and the encoded statements,
+    or None on a syntax error: start may not be a statement boundary.
+    """
+    with open(path, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as source:
+            try:
+                statements, end, end_line, end_column = parse_range(source, start, stop, line, 1)
+            except Exception:
+                return None
+    return end, end_line, end_column, marshal.dumps(encode(statements))
+
+
+def parse_file(path, jobs=None):
+    """Parses a script on jobs processes, returns the Compound a serial parse gives.
+
+    The file is memory-mapped and cut at lines that likely start a top
+    level statement, see split_points(); every chunk is parsed on its own
+    until a statement ends at or past the next cut. A cut is only a guess
+    (it may fall inside an unindented block or a string), so the chunks
+    are checked in order: one is used when the statements before it ended
+    exactly at its start, which makes that start a statement boundary of
+    the serial parse and the chunk's statements those of the serial
+    parse. Text between the end of the statements so far and the next
+    usable cut is parsed here. Small files, files with \\r and runs with
+    a single job are parsed serially.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    with open(path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if jobs < 2 or size < MIN_PARALLEL_SIZE:
+            return Parser(Lexer(file.read().decode('utf-8'))).parse()
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as source:
+            # text mode reading would turn \r\n into \n, inside strings too
+            if source.find(b'\r') != -1:
+                return Parser(Lexer(source[:].decode('utf-8'))).parse()
+            return _parse_chunks(path, source, jobs)
+
+
+def _parse_chunks(path, source, jobs):
+    size = len(source)
+    points = split_points(source, jobs * CHUNKS_PER_JOB)
+    stops = [offset for offset, line in points[1:]] + [size]
+    executor = ProcessPoolExecutor(max_workers=jobs)
+    try:
+        futures = [executor.submit(parse_chunk, path, start, stop, line)
+                   for (start, line), stop in zip(points, stops)]
+        statements = []
+        position, line, column = 0, 1, 1
+        for (start, _), stop, future in zip(points, stops, futures):
+            if position < start:
+                nodes, position, line, column = parse_range(source, position, start, line, column)
+                statements.extend(nodes)
+            if position != start:
+                # the cut fell inside a statement
+                future.cancel()
+                continue
+            result = future.result()
+            if result is None:
+                # a real syntax error, raised from here
+                nodes, position, line, column = parse_range(source, start, stop, line, column)
+                statements.extend(nodes)
+                continue
+            position, line, column, data = result
+            statements.extend(decode(marshal.loads(data)))
+        if position < size:
+            nodes, position, line, column = parse_range(source, position, size, line, column)
+            statements.extend(nodes)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    if not statements:
+        return Parser(Lexer(source[:].decode('utf-8'))).parse()
+    root = Compound()
+    root.children = statements
+    copy_location(root, statements[0])
+    return root
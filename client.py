@@ -0,0 +1,88 @@
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 7878
+
+
+def parse_binding(text):
+    """Parses name=value, value is read as JSON and kept as a string if it is not"""
+    name, sep, value = text.partition('=')
+    if not sep or not name:
+        raise argparse.ArgumentTypeError('expected name=value, got {!r}'.format(text))
+    try:
+        return name, json.loads(value)
+    except ValueError:
+        return name, value
+
+
+def connect(args):
+    if args.unix:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(args.unix)
+        return sock
+    return socket.create_connection((args.host, args.port))
+
+
+def send(sock, requests):
+    for request in requests:
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+    sock.shutdown(socket.SHUT_WR)
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description='Run scripts on a running server.py.')
+    parser.add_argument('paths', nargs='*', help='scripts to run, read by the server')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--unix', metavar='PATH', help='connect to a unix domain socket')
+    parser.add_argument('-e', '--source', action='append', default=[],
+                        help="script source to run, '-' reads it from stdin")
+    parser.add_argument('-b', '--bind', action='append', type=parse_binding, default=[],
+                        metavar='NAME=VALUE', help='starting value of a variable')
+    parser.add_argument('--backend')
+    parser.add_argument('--no-optimize', dest='optimized', action='store_false')
+    parser.add_argument('--metrics', action='store_true', help='print the server metrics')
+    return parser
+
+
+def main(argv=None):
+    arg_parser = build_arg_parser()
+    args = arg_parser.parse_args(argv)
+    requests = []
+    for source in args.source:
+        requests.append({'source': sys.stdin.read() if source == '-' else source})
+    for path in args.paths:
+        # the server opens paths relative to its own working directory
+        requests.append({'path': os.path.abspath(path)})
+    for request_id, request in enumerate(requests):
+        request['id'] = request_id
+        if args.bind:
+            request['bindings'] = dict(args.bind)
+        if args.backend:
+            request['backend'] = args.backend
+        if not args.optimized:
+            request['optimized'] = False
+    if args.metrics:
+        requests.append({'op': 'metrics'})
+    if not requests:
+        arg_parser.error('nothing to run')
+    failed = 0
+    with connect(args) as sock:
+        # the server stops reading while a connection has many requests
+        # running, so the requests are sent while the replies are read
+        sender = threading.Thread(target=send, args=(sock, requests), daemon=True)
+        sender.start()
+        with sock.makefile('r', encoding='utf-8') as replies:
+            for line in replies:
+                if json.loads(line).get('status', 'ok') != 'ok':
+                    failed += 1
+                sys.stdout.write(line)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
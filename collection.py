@@ -0,0 +1,302 @@
+import math
+from array import array
+from itertools import filterfalse
+
+from rope import flatten
+
+#ints in this range are kept in 'q' arrays
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+
+def storage(values):
+    """Returns the most compact container holding values with their exact types.
+
+    All ints that fit in 64 bits go in an array('q'), all floats in an
+    array('d'), anything else (bools, strings, big ints, mixed types) in
+    a list.
+    """
+    if not isinstance(values, list):
+        values = list(values)
+    types = set(map(type, values))
+    if types == {int} and INT64_MIN <= min(values) and max(values) <= INT64_MAX:
+        return array('q', values)
+    if types == {float}:
+        return array('d', values)
+    return values
+
+
+class Array(object):
+    """A Ruby array value.
+
+    items is an array('q'), an array('d') or a list, see storage(), so
+    a numeric array takes 8 bytes per element and sum/min/max/select run
+    over it natively. Arrays compare equal element by element whatever
+    their storage.
+    """
+    __slots__ = ('items',)
+
+    def __init__(self, items):
+        self.items = items
+
+    @classmethod
+    def of(cls, values):
+        return cls(storage(values))
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __eq__(self, other):
+        if type(other) is not Array:
+            return False
+        return len(self.items) == len(other.items) and all(map(_equal, self.items, other.items))
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __add__(self, other):
+        if type(other) is not Array:
+            return NotImplemented
+        left = self.items
+        right = other.items
+        if type(left) is array and type(right) is array and left.typecode == right.typecode:
+            return Array(left + right)
+        return Array.of(list(left) + list(right))
+
+    def __mul__(self, count):
+        if type(count) is not int:
+            return NotImplemented
+        return Array(self.items * max(count, 0))
+
+    __rmul__ = __mul__
+
+    def __repr__(self):
+        return repr(self.to_list())
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + self.items.__sizeof__()
+
+    def to_list(self):
+        """Returns the elements as a python list, strings joined"""
+        return [flatten(value) for value in self.items]
+
+
+def _equal(left, right):
+    return left == right
+
+
+class Range(object):
+    """A Ruby range first..last (or first...last when exclusive).
+
+    It never holds its elements: iterating it iterates a python range,
+    size and sum are computed from the bounds.
+    """
+    __slots__ = ('first', 'last', 'exclusive')
+
+    def __init__(self, first, last, exclusive=False):
+        for value in (first, last):
+            if type(value) not in (int, float):
+                raise TypeError('bad value for range')
+        self.first = first
+        self.last = last
+        self.exclusive = exclusive
+
+    def bounds(self):
+        """Returns the python range of the elements"""
+        if type(self.first) is not int:
+            raise TypeError("can't iterate from float")
+        last = self.last
+        if type(last) is float:
+            stop = math.ceil(last) if self.exclusive else math.floor(last) + 1
+        else:
+            stop = last if self.exclusive else last + 1
+        return range(self.first, stop)
+
+    def __len__(self):
+        return len(self.bounds())
+
+    def __iter__(self):
+        return iter(self.bounds())
+
+    def __eq__(self, other):
+        if type(other) is not Range:
+            return False
+        return (self.first, self.last, self.exclusive) == (other.first, other.last, other.exclusive)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{!r}{}{!r}'.format(self.first, '...' if self.exclusive else '..', self.last)
+
+    def sum(self):
+        elements = self.bounds()
+        count = len(elements)
+        if not count:
+            return 0
+        return (elements[0] + elements[-1]) * count // 2
+
+
+def iterate(value):
+    """Returns an iterator over the elements of an Array or Range"""
+    if type(value) is Array or type(value) is Range:
+        return iter(value)
+    raise TypeError("can't iterate over {}".format(type_name(value)))
+
+
+def type_name(value):
+    return type(flatten(value)).__name__
+
+
+def method_size(receiver, block):
+    return len(receiver)
+
+
+def method_sum(receiver, block):
+    if block is not None:
+        return sum(map(block, receiver))
+    if type(receiver) is Range:
+        return receiver.sum()
+    return sum(receiver.items)
+
+
+def elements(receiver, name):
+    """Returns the elements of a receiver as a sequence, which must not be empty"""
+    elements = receiver.bounds() if type(receiver) is Range else receiver.items
+    if not len(elements):
+        raise IndexError('{} of an empty {}'.format(name, type(receiver).__name__.lower()))
+    return elements
+
+
+def method_min(receiver, block):
+    if type(receiver) is Range:
+        return elements(receiver, 'min')[0]
+    return min(elements(receiver, 'min'))
+
+
+def method_max(receiver, block):
+    if type(receiver) is Range:
+        return elements(receiver, 'max')[-1]
+    return max(elements(receiver, 'max'))
+
+
+def method_first(receiver, block):
+    if type(receiver) is Range:
+        return receiver.first
+    return elements(receiver, 'first')[0]
+
+
+def method_last(receiver, block):
+    if type(receiver) is Range:
+        return receiver.last
+    return elements(receiver, 'last')[-1]
+
+
+def method_to_a(receiver, block):
+    if type(receiver) is Range:
+        return Array.of(receiver.bounds())
+    return receiver
+
+
+def method_map(receiver, block):
+    return Array.of(map(block, receiver))
+
+
+def method_select(receiver, block):
+    if type(receiver) is Array and type(receiver.items) is array:
+        return Array(array(receiver.items.typecode, filter(block, receiver.items)))
+    return Array.of(filter(block, receiver))
+
+
+def method_reject(receiver, block):
+    if type(receiver) is Array and type(receiver.items) is array:
+        return Array(array(receiver.items.typecode, filterfalse(block, receiver.items)))
+    return Array.of(filterfalse(block, receiver))
+
+
+#name -> (function(receiver, block), True when it needs a block, False
+#when it takes none, None when the block is optional). Every method runs
+#as one native pass over the elements, a block is a python function of
+#the element
+METHODS = {
+    'size': (method_size, False),
+    'length': (method_size, False),
+    'sum': (method_sum, None),
+    'min': (method_min, False),
+    'max': (method_max, False),
+    'first': (method_first, False),
+    'last': (method_last, False),
+    'to_a': (method_to_a, False),
+    'map': (method_map, True),
+    'select': (method_select, True),
+    'reject': (method_reject, True),
+}
+
+
+def lookup_method(receiver, name, block):
+    """Returns the function of a collection method, checking it can be called"""
+    method = METHODS.get(name)
+    if method is None or (type(receiver) is not Array and type(receiver) is not Range):
+        raise AttributeError("undefined method '{}' for {}".format(name, type_name(receiver)))
+    function, takes_block = method
+    if takes_block is True and block is None:
+        raise TypeError("'{}' needs a block".format(name))
+    if takes_block is False and block is not None:
+        raise TypeError("'{}' takes no block".format(name))
+    return function
+
+
+def call_method(receiver, name, block=None):
+    """Calls a collection method, block is None or a python function of one element"""
+    return lookup_method(receiver, name, block)(receiver, block)
+
+
+def method_steps(receiver, name, block=None):
+    """Generator running call_method() one element at a time.
+
+    It yields once per element a block is called on (or a range element
+    to_a collects), yielding the list of the values collected so far,
+    and returns the result of the method. Methods that do neither return
+    without yielding. Used by callers that must be able to stop between
+    two elements, like a scheduled VM.
+    """
+    function = lookup_method(receiver, name, block)
+    if block is None and not (name == 'to_a' and type(receiver) is Range):
+        return function(receiver, block)
+    collected = []
+    if block is None or name == 'map' or name == 'sum':
+        block = block or _identity
+        for value in receiver:
+            collected.append(block(value))
+            yield collected
+        if name == 'sum':
+            return sum(collected)
+        return Array.of(collected)
+    keep = name == 'select'
+    for value in receiver:
+        if bool(block(value)) is keep:
+            collected.append(value)
+        yield collected
+    if type(receiver) is Array and type(receiver.items) is array:
+        return Array(array(receiver.items.typecode, collected))
+    return Array.of(collected)
+
+
+def _identity(value):
+    return value
+
+
+def to_python(value):
+    """Returns a value as plain python data, an Array as a list and a Range as its text"""
+    if type(value) is Array:
+        return [to_python(item) for item in value.to_list()]
+    if type(value) is Range:
+        return repr(value)
+    return flatten(value)
@@ -0,0 +1,306 @@
+from array import array
+
+from parser_ruby import *
+from resolver import *
+from loops import loop_plan
+
+#opcodes
+LOAD_CONST = 0
+LOAD_SLOT = 1
+STORE_SLOT = 2
+BINARY_OP = 3
+UNARY_OP = 4
+JUMP = 5
+POP_JUMP_IF_FALSE = 6
+HALT = 7
+BUILD_ARRAY = 8
+BUILD_RANGE = 9
+CALL_METHOD = 10
+GET_ITER = 11
+FOR_ITER = 12
+CLOSED_LOOP = 13
+CLEAR_HOISTED = 14
+LOAD_HOISTED = 15
+HOIST = 16
+
+OPNAMES = (
+    'LOAD_CONST',
+    'LOAD_SLOT',
+    'STORE_SLOT',
+    'BINARY_OP',
+    'UNARY_OP',
+    'JUMP',
+    'POP_JUMP_IF_FALSE',
+    'HALT',
+    'BUILD_ARRAY',
+    'BUILD_RANGE',
+    'CALL_METHOD',
+    'GET_ITER',
+    'FOR_ITER',
+    'CLOSED_LOOP',
+    'CLEAR_HOISTED',
+    'LOAD_HOISTED',
+    'HOIST',
+)
+
+#operator token types in the order used as BINARY_OP / UNARY_OP arguments
+BINARY_OPS = (PLUS, MINUS, MUL, DIV, MOD, EQUAL, NOT, GRE, LESE, GRET, LEST)
+UNARY_OPS = (PLUS, MINUS)
+#BINARY_OP argument of a + known to join strings, see joins_strings()
+CONCAT = len(BINARY_OPS)
+#BINARY_OP argument of a + with a number literal operand, which can never
+#join strings and runs as the native +; any other + checks for a string
+ADD_NUMBER = CONCAT + 1
+BINARY_NAMES = BINARY_OPS + ('CONCAT', 'ADD_NUMBER')
+
+
+def joins_strings(node, left_joins=False, right_joins=False):
+    """Tells whether a BinOp is a + of strings, the result being a string.
+
+    That is the case when an operand is a string literal or itself a +
+    of strings, which left_joins and right_joins tell for the operands
+    so the tree is never searched.
+    """
+    if node.op.type != PLUS:
+        return False
+    left = node.left
+    right = node.right
+    return (left_joins or right_joins or (type(left) is Num and type(left.value) is str)
+            or (type(right) is Num and type(right.value) is str))
+
+
+class CompileError(Exception):
+    """A tree the VM cannot run, see methods.uses_methods()"""
+
+
+def adds_number(node):
+    """Tells whether a BinOp is a + with a number literal operand"""
+    return node.op.type == PLUS and any(type(operand) is Num and type(operand.value) is not str
+                                        for operand in (node.left, node.right))
+
+
+def binary_code(node, left_joins=False, right_joins=False):
+    """Returns the BINARY_OP argument of a BinOp, see joins_strings() for the flags"""
+    if joins_strings(node, left_joins, right_joins):
+        return CONCAT
+    if adds_number(node):
+        return ADD_NUMBER
+    return BINARY_OPS.index(node.op.type)
+
+
+class Bytecode(object):
+    """A compiled program.
+
+    code is a flat array of (opcode, argument) pairs. The argument of
+    LOAD_CONST is an index into consts, LOAD_SLOT/STORE_SLOT hold the
+    frame slot given by symbols and the jumps (and FOR_ITER) hold the
+    absolute position of their target. BUILD_ARRAY holds the number of
+    elements, BUILD_RANGE 1 for an exclusive range and CALL_METHOD the
+    index of its (name, NativeBlock or None, free variable slots) site
+    in consts.
+
+    The values of hoisted loop invariants live in a list of their own,
+    hoisted long. LOAD_HOISTED holds the index of an (index, end) pair in
+    consts: it pushes the value and jumps to end if it is set already,
+    otherwise the expression runs and HOIST (holding the index) keeps
+    it. CLEAR_HOISTED forgets the indexes of the tuple in consts it
+    points at when a loop starts. CLOSED_LOOP points at a (ClosedForm,
+    slots of its vars, end) triple: when the loop can be solved it stores
+    the final values and jumps to end past the loop.
+    """
+    def __init__(self, code, consts, symbols, hoisted=0):
+        self.code = code
+        self.consts = consts
+        self.symbols = symbols
+        self.hoisted = hoisted
+
+    @property
+    def names(self):
+        return self.symbols.names
+
+    def dis(self):
+        """Returns a human readable listing of the bytecode"""
+        lines = []
+        for pos in range(0, len(self.code), 2):
+            op, arg = self.code[pos], self.code[pos + 1]
+            if op == LOAD_CONST:
+                detail = repr(self.consts[arg])
+            elif op in (LOAD_SLOT, STORE_SLOT):
+                detail = self.names[arg]
+            elif op == BINARY_OP:
+                detail = BINARY_NAMES[arg]
+            elif op == UNARY_OP:
+                detail = UNARY_OPS[arg]
+            elif op in (JUMP, POP_JUMP_IF_FALSE, FOR_ITER):
+                detail = 'to {}'.format(arg)
+            elif op == CALL_METHOD:
+                name, block, slots = self.consts[arg]
+                detail = name if block is None else '{} {{|{}|}}'.format(name, block.param)
+            elif op in (BUILD_ARRAY, BUILD_RANGE, HOIST):
+                detail = str(arg)
+            elif op == LOAD_HOISTED:
+                detail = '{} or to {}'.format(*self.consts[arg])
+            elif op == CLEAR_HOISTED:
+                detail = ' '.join(map(str, self.consts[arg]))
+            elif op == CLOSED_LOOP:
+                detail = 'to {}'.format(self.consts[arg][2])
+            else:
+                detail = ''
+            lines.append('{:>6} {:<18} {}'.format(pos, OPNAMES[op], detail).rstrip())
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.dis()
+
+
+class Compiler(NodeVisitor):
+    """Lowers the tree returned by Parser.parse() into Bytecode"""
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.code = array('l')
+        self.consts = []
+        self.symbols = Resolver(tree).resolve()
+        self._const_index = {}
+        # hoisted node -> its index in the hoisted values
+        self._hoisted = {}
+
+    def emit(self, op, arg=0):
+        """Appends an instruction and returns its position"""
+        pos = len(self.code)
+        self.code.append(op)
+        self.code.append(arg)
+        return pos
+
+    def patch(self, pos, target):
+        """Points the jump at pos to target"""
+        self.code[pos + 1] = target
+
+    def const(self, value):
+        #True == 1 == 1.0 so the type is part of the key
+        key = (type(value), value)
+        index = self._const_index.get(key)
+        if index is None:
+            index = self._const_index[key] = len(self.consts)
+            self.consts.append(value)
+        return index
+
+    def visit_BinOp(self, node):
+        """Returns True for a + of strings, which is compiled to CONCAT"""
+        left_joins = self.visit(node.left)
+        right_joins = self.visit(node.right)
+        code = binary_code(node, left_joins, right_joins)
+        self.emit(BINARY_OP, code)
+        return code == CONCAT
+
+    def visit_HoistedBinOp(self, node):
+        index = self._hoisted.setdefault(node, len(self._hoisted))
+        # the end of the expression is only known once it is compiled
+        self.consts.append(None)
+        site = len(self.consts) - 1
+        self.emit(LOAD_HOISTED, site)
+        joins = self.visit_BinOp(node) if isinstance(node, BinOp) else self.visit_UnaryOp(node)
+        self.emit(HOIST, index)
+        self.consts[site] = (index, len(self.code))
+        return joins
+
+    visit_HoistedUnaryOp = visit_HoistedBinOp
+
+    def visit_Num(self, node):
+        self.emit(LOAD_CONST, self.const(node.value))
+
+    def visit_UnaryOp(self, node):
+        self.visit(node.expr)
+        self.emit(UNARY_OP, UNARY_OPS.index(node.op.type))
+
+    def visit_Compound(self, node):
+        for child in node.children:
+            self.visit(child)
+
+    def visit_Assign(self, node):
+        self.visit(node.right)
+        self.emit(STORE_SLOT, node.left.slot)
+
+    def visit_Var(self, node):
+        self.emit(LOAD_SLOT, node.slot)
+
+    def visit_If(self, node):
+        self.visit(node.condition)
+        jump_to_rest = self.emit(POP_JUMP_IF_FALSE)
+        self.visit(node.body)
+        jump_to_end = self.emit(JUMP)
+        self.patch(jump_to_rest, len(self.code))
+        self.visit(node.rest)
+        self.patch(jump_to_end, len(self.code))
+
+    def visit_Else(self, node):
+        self.visit(node.body)
+
+    def visit_While(self, node):
+        plan = loop_plan(node)
+        if plan.closed is not None:
+            self.consts.append(None)
+            closed_site = len(self.consts) - 1
+            self.emit(CLOSED_LOOP, closed_site)
+        if plan.invariants:
+            indexes = tuple(self._hoisted.setdefault(invariant, len(self._hoisted)) for invariant in plan.invariants)
+            self.consts.append(indexes)
+            self.emit(CLEAR_HOISTED, len(self.consts) - 1)
+        top = len(self.code)
+        self.visit(node.condition)
+        jump_to_end = self.emit(POP_JUMP_IF_FALSE)
+        self.visit(node.body)
+        self.emit(JUMP, top)
+        self.patch(jump_to_end, len(self.code))
+        if plan.closed is not None:
+            slots = tuple(var.slot for var in plan.closed.vars)
+            self.consts[closed_site] = (plan.closed, slots, len(self.code))
+
+    def visit_For(self, node):
+        self.visit(node.iterable)
+        self.emit(GET_ITER)
+        top = self.emit(FOR_ITER)
+        self.emit(STORE_SLOT, node.var.slot)
+        self.visit(node.body)
+        self.emit(JUMP, top)
+        self.patch(top, len(self.code))
+
+    def visit_ArrayLiteral(self, node):
+        for item in node.items:
+            self.visit(item)
+        self.emit(BUILD_ARRAY, len(node.items))
+
+    def visit_RangeLiteral(self, node):
+        self.visit(node.first)
+        self.visit(node.last)
+        self.emit(BUILD_RANGE, int(node.exclusive))
+
+    def visit_MethodCall(self, node):
+        self.visit(node.receiver)
+        block = slots = None
+        if node.body is not None:
+            #the transpiler imports the vm, so not at the top
+            from transpiler import native_block
+            block = native_block(node)
+            slots = tuple(self.symbols.slot(name) for name in block.free)
+        # sites are never shared, blocks are not comparable values
+        self.consts.append((node.name, block, slots))
+        self.emit(CALL_METHOD, len(self.consts) - 1)
+
+    def visit_Def(self, node):
+        raise CompileError('a program defining or calling methods runs on the tree walker, not on the vm')
+
+    visit_Call = visit_Def
+
+    def visit_list(self, node):
+        for child in node:
+            self.visit(child)
+
+    def visit_NoOp(self, node):
+        pass
+
+    def compile(self):
+        if self.tree is not None:
+            self.visit(self.tree)
+        self.emit(HALT)
+        return Bytecode(self.code, self.consts, self.symbols, len(self._hoisted))
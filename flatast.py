@@ -0,0 +1,277 @@
+from array import array
+
+from parser_ruby import *
+from resolver import SymbolTable
+from compiler import UNARY_OPS, CONCAT, binary_code
+from vm import BINARY_FUNCS, UNARY_FUNCS
+from optimizer import optimize_statements
+from collection import Array, Range, call_method, iterate
+from transpiler import native_block
+
+#node kinds of a FlatTree
+F_NUM, F_VAR, F_BINOP, F_UNARY, F_ASSIGN, F_BLOCK, F_IF, F_WHILE, F_ARRAY, F_RANGE, F_CALL, F_FOR = range(12)
+KIND_NAMES = ('NUM', 'VAR', 'BINOP', 'UNARY', 'ASSIGN', 'BLOCK', 'IF', 'WHILE', 'ARRAY', 'RANGE', 'CALL', 'FOR')
+
+UNARY_CODES = {op: code for code, op in enumerate(UNARY_OPS)}
+
+
+class FlatTree(object):
+    """A program stored in parallel arrays instead of one object per node.
+
+    Node i has the kind kinds[i] and up to three integer fields:
+
+        NUM     first: index into consts
+        VAR     first: frame slot
+        BINOP   first: left node, second: right node, third: BINARY_OP argument, see compiler.binary_code()
+        UNARY   first: operand node, third: index into UNARY_OPS
+        ASSIGN  first: frame slot, second: value node
+        BLOCK   first: start in items, second: number of statements
+        IF      first: condition, second: body block, third: IF or BLOCK run otherwise
+        WHILE   first: condition, second: body block
+        ARRAY   first: number of elements, the nodes just before it
+        RANGE   first: first node, second: last node, third: 1 when exclusive
+        CALL    first: receiver node, third: index into consts of the
+                (name, NativeBlock or None, free variable slots) site
+        FOR     first: frame slot, second: iterable node, third: body block
+
+    Children are always added before their parent and start[i] is the
+    first node of the subtree of node i, so an expression is evaluated by
+    a single scan from start[i] to i. Else arms, statement lists and
+    Compounds all become BLOCKs, NoOps become empty BLOCKs.
+    """
+
+    def __init__(self):
+        self.kinds = array('B')
+        self.first = array('i')
+        self.second = array('i')
+        self.third = array('i')
+        self.start = array('i')
+        # statement node indices of all BLOCKs
+        self.items = array('i')
+        self.consts = []
+        self._const_index = {}
+        self.symbols = SymbolTable()
+        self.root = -1
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def node(self, kind, first=0, second=0, third=0, child=None):
+        """Appends a node whose first child is child and returns its index"""
+        index = len(self.kinds)
+        self.kinds.append(kind)
+        self.first.append(first)
+        self.second.append(second)
+        self.third.append(third)
+        self.start.append(index if child is None else self.start[child])
+        return index
+
+    def const(self, value):
+        key = (type(value), value)
+        index = self._const_index.get(key)
+        if index is None:
+            index = self._const_index[key] = len(self.consts)
+            self.consts.append(value)
+        return index
+
+    def block(self, statements):
+        start = len(self.items)
+        self.items.extend(statements)
+        return self.node(F_BLOCK, start, len(statements), 0, statements[0] if statements else None)
+
+    def add(self, tree):
+        """Appends the nodes of tree in post-order and returns the index of its root"""
+        results = []
+        stack = [(tree, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if not expanded:
+                stack.append((node, True))
+                # the target of an Assign or For is stored as a slot, not
+                # as a node, the block of a call is native code
+                if isinstance(node, Assign):
+                    children = [node.right]
+                elif isinstance(node, For):
+                    children = [node.iterable, node.body]
+                elif isinstance(node, MethodCall):
+                    children = [node.receiver]
+                else:
+                    children = list(iter_child_nodes(node))
+                for child in reversed(children):
+                    stack.append((child, False))
+                continue
+            if isinstance(node, list):
+                count = len(node)
+                statements = results[len(results) - count:]
+                del results[len(results) - count:]
+                results.append(self.block(statements))
+            elif isinstance(node, Num):
+                results.append(self.node(F_NUM, self.const(node.value)))
+            elif isinstance(node, Var):
+                results.append(self.node(F_VAR, self.symbols.slot(node.value)))
+            elif isinstance(node, BinOp):
+                right = results.pop()
+                left = results[-1]
+                code = binary_code(node, self.third[left] == CONCAT and self.kinds[left] == F_BINOP,
+                                   self.third[right] == CONCAT and self.kinds[right] == F_BINOP)
+                results[-1] = self.node(F_BINOP, left, right, code, left)
+            elif isinstance(node, UnaryOp):
+                results[-1] = self.node(F_UNARY, results[-1], 0, UNARY_CODES[node.op.type], results[-1])
+            elif isinstance(node, Assign):
+                results[-1] = self.node(F_ASSIGN, self.symbols.slot(node.left.value), results[-1], 0, results[-1])
+            elif isinstance(node, Compound):
+                count = len(node.children)
+                statements = results[len(results) - count:]
+                del results[len(results) - count:]
+                results.append(self.block(statements))
+            elif isinstance(node, If):
+                rest = results.pop()
+                body = results.pop()
+                results[-1] = self.node(F_IF, results[-1], body, rest, results[-1])
+            elif isinstance(node, While):
+                body = results.pop()
+                results[-1] = self.node(F_WHILE, results[-1], body, 0, results[-1])
+            elif isinstance(node, NoOp):
+                results.append(self.block(()))
+            elif isinstance(node, ArrayLiteral):
+                count = len(node.items)
+                items = results[len(results) - count:]
+                del results[len(results) - count:]
+                results.append(self.node(F_ARRAY, count, 0, 0, items[0] if items else None))
+            elif isinstance(node, RangeLiteral):
+                last = results.pop()
+                results[-1] = self.node(F_RANGE, results[-1], last, int(node.exclusive), results[-1])
+            elif isinstance(node, MethodCall):
+                block = slots = None
+                if node.body is not None:
+                    block = native_block(node)
+                    slots = tuple(self.symbols.slot(name) for name in block.free)
+                self.consts.append((node.name, block, slots))
+                results[-1] = self.node(F_CALL, results[-1], 0, len(self.consts) - 1, results[-1])
+            elif isinstance(node, For):
+                body = results.pop()
+                results[-1] = self.node(F_FOR, self.symbols.slot(node.var.value), results[-1], body, results[-1])
+            elif not isinstance(node, Else):
+                # an Else leaves the BLOCK of its body as its result
+                raise Exception('Cannot flatten {}'.format(type(node).__name__))
+        return results[0]
+
+    def nbytes(self):
+        """Returns the size of the node and item arrays in bytes"""
+        return sum(a.itemsize * len(a) for a in (self.kinds, self.first, self.second, self.third, self.start, self.items))
+
+
+def flatten(tree):
+    """Returns the FlatTree of a tree returned by Parser.parse()"""
+    flat = FlatTree()
+    if tree is not None:
+        flat.root = flat.add(tree)
+    return flat
+
+
+def parse_flat(text, optimized=True):
+    """Parses text straight into a FlatTree.
+
+    Top level statements are parsed (and optimized) one at a time and
+    flattened right away, so the node objects of at most one statement
+    are alive at any time.
+    """
+    nodes = Parser(Lexer(text)).statements()
+    if optimized:
+        nodes = optimize_statements(nodes)
+    flat = FlatTree()
+    statements = [flat.add(node) for node in nodes]
+    flat.root = flat.block(statements)
+    return flat
+
+
+class FlatInterpreter(object):
+    """Runs a FlatTree directly, a tree is flattened first.
+
+    Produces the same GLOBAL_MEMORY contents as the tree walking
+    Interpreter.
+    """
+
+    def __init__(self, tree):
+        self.flat = tree if isinstance(tree, FlatTree) else flatten(tree)
+        self.frame = self.flat.symbols.new_frame()
+
+    @property
+    def GLOBAL_MEMORY(self):
+        return self.flat.symbols.view(self.frame)
+
+    def evaluate(self, root):
+        """Evaluates the expression rooted at root in one scan of its subtree"""
+        flat = self.flat
+        kinds = flat.kinds
+        first = flat.first
+        third = flat.third
+        consts = flat.consts
+        frame = self.frame
+        values = []
+        for index in range(flat.start[root], root + 1):
+            kind = kinds[index]
+            if kind == F_NUM:
+                values.append(consts[first[index]])
+            elif kind == F_VAR:
+                value = frame[first[index]]
+                if value is None:
+                    raise NameError(repr(flat.symbols.names[first[index]]))
+                values.append(value)
+            elif kind == F_BINOP:
+                right = values.pop()
+                values[-1] = BINARY_FUNCS[third[index]](values[-1], right)
+            elif kind == F_UNARY:
+                values[-1] = UNARY_FUNCS[third[index]](values[-1])
+            elif kind == F_CALL:
+                name, block, slots = consts[third[index]]
+                if block is None:
+                    values[-1] = call_method(values[-1], name)
+                else:
+                    values[-1] = block.call(values[-1], name, [frame[slot] for slot in slots])
+            elif kind == F_ARRAY:
+                count = first[index]
+                items = Array.of(values[len(values) - count:])
+                del values[len(values) - count:]
+                values.append(items)
+            elif kind == F_RANGE:
+                last = values.pop()
+                values[-1] = Range(values[-1], last, third[index] == 1)
+            else:
+                raise Exception('Node {} is not an expression'.format(index))
+        return values[0]
+
+    def execute(self, index):
+        flat = self.flat
+        kind = flat.kinds[index]
+        if kind == F_BLOCK:
+            start = flat.first[index]
+            for statement in flat.items[start:start + flat.second[index]]:
+                self.execute(statement)
+        elif kind == F_ASSIGN:
+            self.frame[flat.first[index]] = self.evaluate(flat.second[index])
+        elif kind == F_IF:
+            if self.evaluate(flat.first[index]):
+                self.execute(flat.second[index])
+            else:
+                self.execute(flat.third[index])
+        elif kind == F_WHILE:
+            condition = flat.first[index]
+            body = flat.second[index]
+            while self.evaluate(condition):
+                self.execute(body)
+        elif kind == F_FOR:
+            frame = self.frame
+            slot = flat.first[index]
+            body = flat.third[index]
+            for value in iterate(self.evaluate(flat.second[index])):
+                frame[slot] = value
+                self.execute(body)
+        else:
+            # an expression statement, run for its errors
+            self.evaluate(index)
+
+    def interpret(self):
+        if self.flat.root < 0:
+            return ''
+        self.execute(self.flat.root)
@@ -1,15 +1,37 @@
+import sys
+
 from parser_ruby import *
+from resolver import *
+from compiler import BINARY_OPS, UNARY_OPS, ADD_NUMBER
+from vm import BINARY_FUNCS, UNARY_FUNCS
+from rope import Rope, concat, flatten_memory
+from collection import Array, Range, call_method, iterate
+from transpiler import native_block
+from methods import *
+from loops import *
+import batch
 
 class Interpreter(NodeVisitor):
-    
-    GLOBAL_MEMORY = {}
-    
+    # the method running and its frame, None at the top level
+    method = None
+    locals = None
+    # number of method calls nested in each other
+    depth = 0
+    # hoisted node -> its value in the innermost loop running
+    hoisted = None
+
     def __init__(self, tree):
         self.tree = tree
+        # every instance has its own variables and methods
+        self.GLOBAL_MEMORY = {}
+        self.methods = {}
 
     def visit_BinOp(self, node):
         if node.op.type == PLUS:
-            return self.visit(node.left) + self.visit(node.right)
+            left = self.visit(node.left)
+            if type(left) is str:
+                return concat(left, self.visit(node.right))
+            return left + self.visit(node.right)
         elif node.op.type == MINUS:
             return self.visit(node.left) - self.visit(node.right)
         elif node.op.type == MUL:
@@ -67,9 +89,238 @@ class Interpreter(NodeVisitor):
         self.visit(node.body)
 
     def visit_While(self, node):
+        plan = loop_plan(node)
+        if plan.closed is not None and self.closed_loop(plan.closed):
+            return
+        if not plan.invariants:
+            return self.run_loop(node)
+        hoisted = self.hoisted
+        self.hoisted = {}
+        try:
+            self.run_loop(node)
+        finally:
+            self.hoisted = hoisted
+
+    def run_loop(self, node):
         while self.visit(node.condition):
             self.visit(node.body)
 
+    def closed_loop(self, closed):
+        """Sets the variables of a ClosedForm loop to their final values, False when it has to run"""
+        values = closed.solve([self.variable(var) for var in closed.vars])
+        if values is None:
+            return False
+        for var, value in zip(closed.vars, values):
+            self.set_variable(var, value)
+        return True
+
+    def variable(self, node):
+        """Returns the value of a Var, None when it is not set"""
+        if isinstance(node, LocalVar):
+            return self.locals[node.slot]
+        return self.GLOBAL_MEMORY.get(node.value)
+
+    def set_variable(self, node, value):
+        if isinstance(node, LocalVar):
+            self.locals[node.slot] = value
+        else:
+            self.GLOBAL_MEMORY[node.value] = value
+
+    def visit_HoistedBinOp(self, node):
+        hoisted = self.hoisted
+        value = hoisted.get(node)
+        if value is None:
+            value = hoisted[node] = self.compute(node)
+        return value
+
+    visit_HoistedUnaryOp = visit_HoistedBinOp
+
+    def compute(self, node):
+        """Evaluates a hoisted expression"""
+        if isinstance(node, BinOp):
+            return Interpreter.visit_BinOp(self, node)
+        return Interpreter.visit_UnaryOp(self, node)
+
+    def visit_For(self, node):
+        var_name = node.var.value
+        for value in iterate(self.visit(node.iterable)):
+            self.GLOBAL_MEMORY[var_name] = value
+            self.visit(node.body)
+
+    def visit_ArrayLiteral(self, node):
+        return Array.of([self.visit(item) for item in node.items])
+
+    def visit_RangeLiteral(self, node):
+        return Range(self.visit(node.first), self.visit(node.last), node.exclusive)
+
+    def visit_MethodCall(self, node):
+        receiver = self.visit(node.receiver)
+        if node.body is None:
+            return call_method(receiver, node.name)
+        block = native_block(node)
+        return block.call(receiver, node.name, self.block_values(block), self.call_by_name)
+
+    def block_values(self, block):
+        """Returns the values of the free variables of a block, None for unset ones"""
+        memory = self.GLOBAL_MEMORY
+        if self.method is None:
+            return [memory.get(name) for name in block.free]
+        slots = self.method.code.slots
+        frame = self.locals
+        return [frame[slots[name]] if name in slots else memory.get(name) for name in block.free]
+
+    def visit_Def(self, node):
+        define(self.methods, node)
+
+    def visit_Call(self, node):
+        method = lookup_method(self.methods, node.name)
+        value = self.invoke(method, self.arguments(method, node.args))
+        if value is None and not node.statement:
+            raise TypeError("method '{}' returned no value".format(node.name))
+        return value
+
+    def call_by_name(self, name, args):
+        """Calls a method with argument values, for the calls made by native blocks"""
+        method = lookup_method(self.methods, name)
+        if len(args) != method.arity:
+            raise TypeError("wrong number of arguments for '{}' (given {}, expected {})".format(
+                name, len(args), method.arity))
+        frame = method.new_frame()
+        frame[:len(args)] = args
+        value = self.invoke(method, frame)
+        if value is None:
+            raise TypeError("method '{}' returned no value".format(name))
+        return value
+
+    def arguments(self, method, args):
+        """Returns a frame of method holding the values of the argument nodes"""
+        if len(args) != method.arity:
+            raise TypeError("wrong number of arguments for '{}' (given {}, expected {})".format(
+                method.name, len(args), method.arity))
+        frame = method.new_frame()
+        try:
+            for slot, arg in enumerate(args):
+                frame[slot] = self.visit(arg)
+        except BaseException:
+            method.release(frame)
+            raise
+        return frame
+
+    def invoke(self, method, frame):
+        """Runs method on a frame holding its arguments and returns its value.
+
+        A tail call raised by the body replaces the running method and
+        frame and loops here, so tail recursion runs in constant stack.
+        A memoized method answers from its memo; the result of a chain of
+        tail calls is remembered for the arguments the chain started with.
+        """
+        caller = self.method
+        caller_locals = self.locals
+        remember = None
+        depth = self.depth
+        if depth >= MAX_CALL_DEPTH:
+            method.release(frame)
+            raise RecursionError('stack level too deep')
+        self.depth = depth + 1
+        limit = sys.getrecursionlimit()
+        if caller is None:
+            # only while the outermost call runs, restored below
+            sys.setrecursionlimit(limit + MAX_CALL_DEPTH * FRAMES_PER_CALL)
+        try:
+            while True:
+                if method.pure is None:
+                    method.decide(self.methods)
+                key = method.key(frame) if method.memo is not None else None
+                if key is not None:
+                    value = method.lookup(key)
+                    if value is not None:
+                        method.release(frame)
+                        break
+                    if remember is None:
+                        remember = (method, key)
+                method.calls += 1
+                self.method = method
+                self.locals = frame
+                try:
+                    self.visit(method.code.body)
+                    value = None
+                except MethodReturn as e:
+                    value = e.value
+                except TailCall as e:
+                    method.release(frame)
+                    method = e.method
+                    frame = e.frame
+                    method.tail_calls += 1
+                    continue
+                method.release(frame)
+                break
+        finally:
+            self.method = caller
+            self.locals = caller_locals
+            self.depth = depth
+            if caller is None:
+                sys.setrecursionlimit(limit)
+        if remember is not None and value is not None and remember[0].memo is not None:
+            remember[0].remember(remember[1], value)
+        return value
+
+    def visit_Return(self, node):
+        value = node.value
+        if type(value) is Call and value.tail:
+            method = lookup_method(self.methods, value.name)
+            raise TailCall(method, self.arguments(method, value.args))
+        raise MethodReturn(self.visit(value))
+
+    def visit_LocalVar(self, node):
+        var_value = self.locals[node.slot]
+        if var_value is None:
+            raise NameError(repr(node.value))
+        return var_value
+
+    def visit_LocalAssign(self, node):
+        self.locals[node.left.slot] = self.visit(node.right)
+
+    def visit_LocalFor(self, node):
+        frame = self.locals
+        slot = node.var.slot
+        for value in iterate(self.visit(node.iterable)):
+            frame[slot] = value
+            self.visit(node.body)
+
+    def method_stats(self):
+        """Returns the counters of every method defined, by name"""
+        stats = {}
+        for name, method in sorted(self.methods.items()):
+            stats[name] = {
+                'calls': method.calls,
+                'tail_calls': method.tail_calls,
+                'frames_allocated': method.allocated,
+                'frames_reused': method.reused,
+                'pure': method.pure,
+                'memoized': method.memo is not None,
+                'memo_hits': method.hits,
+                'memo_misses': method.misses,
+                'memo_evictions': method.evictions,
+                'memo_size': len(method.memo) if method.memo is not None else 0,
+            }
+        return stats
+
+    def method_report(self):
+        """Returns the call, frame and memo counters of every method as text"""
+        lines = ['{:<16} {:>10} {:>10} {:>10} {:>10} {:>9}  {}'.format(
+            'method', 'calls', 'tail', 'allocated', 'reused', 'memo hit', 'memo')]
+        for name, method in sorted(self.methods.items()):
+            if method.memo is not None:
+                memo = '{} entries'.format(len(method.memo))
+            elif method.code.memoize:
+                memo = 'off, not pure: {}'.format(method.impure) if method.impure else 'off, never called'
+            else:
+                memo = '-'
+            lines.append('{:<16} {:>10} {:>10} {:>10} {:>10} {:>9}  {}'.format(
+                name, method.calls, method.tail_calls, method.allocated, method.reused,
+                hit_rate(method.hits, method.misses), memo))
+        return '\n'.join(lines)
+
     def visit_list(self, node):
         for child in node:
             self.visit(child)
@@ -81,4 +332,288 @@ class Interpreter(NodeVisitor):
         tree = self.tree
         if tree is None:
             return ''
-        return self.visit(tree)
\ No newline at end of file
+        try:
+            return self.visit(tree)
+        finally:
+            flatten_memory(self.GLOBAL_MEMORY)
+
+    @staticmethod
+    def run_batch(tree, columns, lanes=None):
+        """Runs tree once per lane of starting bindings and returns the final columns.
+
+        columns maps variable names to equally long sequences of starting
+        values, lane i of the run starts with the i-th value of every
+        column (None leaves a variable unset). Returns {name: list of the
+        final value of every lane}, None where a lane never set it.
+        With numpy all lanes run in one vectorized pass (see
+        batch.BatchInterpreter), without it, or for a tree using arrays or
+        ranges, every lane runs on its own Interpreter. An error in any
+        lane is raised.
+        """
+        if batch.numpy is not None and batch.vectorizable(tree):
+            return batch.BatchInterpreter(tree, columns, lanes).run()
+        lengths = set(len(values) for values in columns.values())
+        if lanes is not None:
+            lengths.add(lanes)
+        if len(lengths) != 1:
+            raise ValueError('every binding column needs the same number of lanes')
+        lanes = lengths.pop()
+        results = []
+        for lane in range(lanes):
+            inter = Interpreter(tree)
+            for name, values in columns.items():
+                if values[lane] is not None:
+                    inter.GLOBAL_MEMORY[name] = values[lane]
+            inter.interpret()
+            results.append(inter.GLOBAL_MEMORY)
+        names = []
+        for memory in [dict.fromkeys(columns)] + results:
+            names.extend(name for name in memory if name not in names)
+        return {name: [memory.get(name) for memory in results] for name in names}
+
+    def run_statements(self, statements, callback=None):
+        """Runs top level statements as they are produced, keeping none of them.
+
+        callback, if given, is called with every statement after it ran.
+        """
+        try:
+            for node in statements:
+                self.visit(node)
+                if callback is not None:
+                    callback(node)
+        finally:
+            flatten_memory(self.GLOBAL_MEMORY)
+
+
+class SlotInterpreter(Interpreter):
+    """Runs the tree with its variables resolved to slots of a frame list.
+
+    GLOBAL_MEMORY is rebuilt from the frame when it is read.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.symbols = Resolver(tree).resolve()
+        self.frame = self.symbols.new_frame()
+        self.methods = {}
+
+    @property
+    def GLOBAL_MEMORY(self):
+        return self.symbols.view(self.frame)
+
+    def visit_Assign(self, node):
+        self.frame[node.left.slot] = self.visit(node.right)
+
+    def visit_Var(self, node):
+        var_value = self.frame[node.slot]
+        if var_value is None:
+            raise NameError(repr(node.value))
+        return var_value
+
+    def variable(self, node):
+        if isinstance(node, LocalVar):
+            return self.locals[node.slot]
+        return self.frame[node.slot]
+
+    def set_variable(self, node, value):
+        if isinstance(node, LocalVar):
+            self.locals[node.slot] = value
+        else:
+            self.frame[node.slot] = value
+
+    def visit_For(self, node):
+        frame = self.frame
+        slot = node.var.slot
+        for value in iterate(self.visit(node.iterable)):
+            frame[slot] = value
+            self.visit(node.body)
+
+    def block_values(self, block):
+        globals = self.symbols.slots
+        frame = self.frame
+        if self.method is None:
+            return [frame[globals[name]] for name in block.free]
+        slots = self.method.code.slots
+        locals = self.locals
+        return [locals[slots[name]] if name in slots else frame[globals[name]] for name in block.free]
+
+
+class IterativeInterpreter(Interpreter):
+    """Evaluates expressions with an explicit work stack instead of recursion.
+
+    Arbitrarily deep BinOp/UnaryOp trees (like the ones of long operator
+    chains or deeply nested parentheses) run in linear time without
+    reaching the python recursion limit.
+    """
+
+    # (function, arity) pairs pushed on the work stack below the operands
+    BINARY = {op: (func, 2) for op, func in zip(BINARY_OPS, BINARY_FUNCS)}
+    BINARY[PLUS] = (concat, 2)
+    UNARY = {op: (func, 1) for op, func in zip(UNARY_OPS, UNARY_FUNCS)}
+
+    def evaluate(self, node):
+        binary = self.BINARY
+        unary = self.UNARY
+        memory = self.GLOBAL_MEMORY
+        values = []
+        work = [node]
+        while work:
+            item = work.pop()
+            kind = type(item)
+            if kind is tuple:
+                func, arity = item
+                if arity == 2:
+                    right = values.pop()
+                    values[-1] = func(values[-1], right)
+                else:
+                    values[-1] = func(values[-1])
+            elif kind is Num:
+                values.append(item.value)
+            elif kind is Var:
+                value = memory.get(item.value)
+                if value is None:
+                    raise NameError(repr(item.value))
+                values.append(value)
+            elif kind is BinOp:
+                work.append(binary[item.op.type])
+                work.append(item.right)
+                work.append(item.left)
+            elif kind is UnaryOp:
+                work.append(unary[item.op.type])
+                work.append(item.expr)
+            else:
+                values.append(self.visit(item))
+        return values[0]
+
+    visit_BinOp = evaluate
+    visit_UnaryOp = evaluate
+
+    def compute(self, node):
+        if isinstance(node, BinOp):
+            return self.BINARY[node.op.type][0](self.evaluate(node.left), self.evaluate(node.right))
+        return self.UNARY[node.op.type][0](self.evaluate(node.expr))
+
+
+#a site whose guard failed this often stays generic
+MAX_DEOPTS = 4
+
+
+class SpecializedBinOp(BinOp):
+    """A BinOp rewritten for the operand types it has seen.
+
+    Subclasses are made by specialized_binop() with the class attributes
+    left_type, right_type and func; a node becomes one by assigning its
+    __class__, which needs no copy since the slots are the same.
+    """
+    __slots__ = ()
+
+
+SPECIALIZED_CLASSES = {}
+
+
+def specialized_binop(op, left_type, right_type):
+    """Returns the SpecializedBinOp subclass of an operator and operand types"""
+    key = (op, left_type, right_type)
+    cls = SPECIALIZED_CLASSES.get(key)
+    if cls is None:
+        if op != PLUS:
+            func = BINARY_FUNCS[BINARY_OPS.index(op)]
+        elif left_type is str or left_type is Rope:
+            func = concat
+        else:
+            func = BINARY_FUNCS[ADD_NUMBER]
+        cls = SPECIALIZED_CLASSES[key] = type('SpecializedBinOp', (SpecializedBinOp,), {
+            '__slots__': (),
+            'left_type': left_type,
+            'right_type': right_type,
+            'func': staticmethod(func),
+            'signature': '{} {} {}'.format(left_type.__name__, op, right_type.__name__),
+        })
+    return cls
+
+
+class SpecializingInterpreter(Interpreter):
+    """Interpreter whose BinOp nodes specialize themselves on operand types.
+
+    The first run of a BinOp rewrites it into a SpecializedBinOp for the
+    types of its operands. A specialized node checks both types on every
+    run and calls its operator directly; when the guard fails it counts a
+    deopt and turns back into a plain BinOp. A node deopted MAX_DEOPTS
+    times stays generic. specialization_stats() reports the counters.
+    """
+
+    BINARY = dict(zip(BINARY_OPS, BINARY_FUNCS))
+    BINARY[PLUS] = concat
+
+    def visit_BinOp(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        if node.deopts < MAX_DEOPTS:
+            node.__class__ = specialized_binop(node.op.type, type(left), type(right))
+        return self.BINARY[node.op.type](left, right)
+
+    def visit_SpecializedBinOp(self, node):
+        #Num and Var operands are read in place instead of being visited
+        left = node.left
+        kind = type(left)
+        if kind is Num:
+            left = left.value
+        elif kind is Var:
+            left = self.GLOBAL_MEMORY.get(left.value)
+            if left is None:
+                raise NameError(repr(node.left.value))
+        else:
+            left = self.visit(left)
+        right = node.right
+        kind = type(right)
+        if kind is Num:
+            right = right.value
+        elif kind is Var:
+            right = self.GLOBAL_MEMORY.get(right.value)
+            if right is None:
+                raise NameError(repr(node.right.value))
+        else:
+            right = self.visit(right)
+        if type(left) is node.left_type and type(right) is node.right_type:
+            node.hits += 1
+            return node.func(left, right)
+        node.deopts += 1
+        node.__class__ = BinOp
+        return self.BINARY[node.op.type](left, right)
+
+    def specialization_stats(self):
+        """Returns (node, signature, hits, deopts) for every BinOp that ran, in source order.
+
+        signature is the operand types a node is specialized for, None
+        for a generic node.
+        """
+        stats = []
+        stack = [self.tree]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, BinOp) and (node.hits or node.deopts or isinstance(node, SpecializedBinOp)):
+                signature = node.signature if isinstance(node, SpecializedBinOp) else None
+                stats.append((node, signature, node.hits, node.deopts))
+            stack.extend(iter_child_nodes(node))
+        stats.sort(key=lambda item: (item[0].line or 0, item[0].column or 0))
+        return stats
+
+    def specialization_report(self):
+        """Returns the per node hit rates and their total as text"""
+        lines = ['{:<12} {:<20} {:>10} {:>8} {:>9}'.format('node', 'types', 'hits', 'deopts', 'hit rate')]
+        hits = deopts = 0
+        for node, signature, node_hits, node_deopts in self.specialization_stats():
+            hits += node_hits
+            deopts += node_deopts
+            position = '?' if node.line is None else '{}:{}'.format(node.line, node.column)
+            lines.append('{:<12} {:<20} {:>10} {:>8} {:>9}'.format(
+                position, signature or 'generic', node_hits, node_deopts, hit_rate(node_hits, node_deopts)))
+        lines.append('{:<12} {:<20} {:>10} {:>8} {:>9}'.format('total', '', hits, deopts, hit_rate(hits, deopts)))
+        return '\n'.join(lines)
+
+
+def hit_rate(hits, misses):
+    """Formats hits / (hits + misses) as a percentage, '-' before any guarded run"""
+    if not hits + misses:
+        return '-'
+    return '{:.1%}'.format(hits / (hits + misses))
@@ -1,3 +1,8 @@
+import codecs
+import gc
+import re
+import sys
+from array import array
 
 #token types
 PLUS='PLUS'
@@ -25,17 +30,33 @@ SEMI=';'
 ID='ID'
 COMMA=','
 DOT='.'
+DOTDOT='..'
+DOTDOTDOT='...'
+LBRACKET='['
+RBRACKET=']'
+LBRACE='{'
+RBRACE='}'
+PIPE='|'
 FOR='for'
+IN='in'
+DO='do'
 WHILE='while'
 IF='if'
 ELSE='else'
 ELSIF='elsif'
 END='end'
+DEF='def'
+RETURN='return'
 
 class Token(object):
-    def __init__(self, type, value):
+    __slots__ = ('type', 'value', 'line', 'column')
+
+    def __init__(self, type, value, line=None, column=None):
         self.type = type
         self.value = value
+        # 1-based source position, None for shared tokens and tokens not read from source
+        self.line = line
+        self.column = column
 
     def __str__(self):
         """String representation of the class instance.
@@ -58,230 +79,356 @@ RESERVED_KEYWORDS={
     'elsif': Token(ELSIF, 'elsif'),
     'else': Token(ELSE, 'else'),
     'while': Token(WHILE, 'while'),
+    'for': Token(FOR, 'for'),
+    'in': Token(IN, 'in'),
+    'do': Token(DO, 'do'),
     'end': Token(END, 'end'),
+    'def': Token(DEF, 'def'),
+    'return': Token(RETURN, 'return'),
     'true': Token(TRUE, 'true'),
     'false': Token(FALSE, 'false')
 }
 
 
+#maps every fixed lexeme to its token type
+OPERATORS = {
+    '==': EQUAL,
+    '!=': NOT,
+    '>=': GRE,
+    '<=': LESE,
+    '=': ASSIGN,
+    '>': GRET,
+    '<': LEST,
+    '+': PLUS,
+    '-': MINUS,
+    '*': MUL,
+    '/': DIV,
+    '%': MOD,
+    ';': SEMI,
+    ',': COMMA,
+    '(': LPAREN,
+    ')': RPAREN,
+    '.': DOT,
+    '..': DOTDOT,
+    '...': DOTDOTDOT,
+    '[': LBRACKET,
+    ']': RBRACKET,
+    '{': LBRACE,
+    '}': RBRACE,
+    '|': PIPE,
+}
+
+#operators and reserved keywords are shared by every occurrence of their
+#lexeme, the position of a shared token is kept by the lexer instead
+FIXED_TOKENS = {lexeme: Token(type, lexeme) for lexeme, type in OPERATORS.items()}
+FIXED_TOKENS.update(RESERVED_KEYWORDS)
+EOF_TOKEN = Token(EOF, None)
+
+#every token type, tokenize_all() stores a type as its index in this tuple
+TOKEN_TYPES = (
+    PLUS, MINUS, MUL, DIV, MOD, LPAREN, RPAREN, APOS, INTEGER, REAL, EOF, STR,
+    TRUE, FALSE, EQUAL, NOT, GRET, LEST, GRE, LESE, ASSIGN, SEMI, ID, COMMA,
+    DOT, FOR, WHILE, IF, ELSE, ELSIF, END,
+    DOTDOT, DOTDOTDOT, LBRACKET, RBRACKET, LBRACE, RBRACE, PIPE, IN, DO,
+    DEF, RETURN,
+)
+TYPE_CODES = {type: code for code, type in enumerate(TOKEN_TYPES)}
+
+LEXEME_RE = re.compile(r"""
+    #INTEGER or REAL, 1..5 is a range and 5.sum a method call
+    [0-9]+(?:\.[0-9]+|\.(?![.\w]))?
+  | [^\W\d_]\w*                 # ID or reserved keyword
+  | "(?:[^"\\]|\\[\s\S]?)*"?    # STR, backslash escapes included
+  | [=!<>]=                     # two character operators
+  | \.\.\.?                     # ranges
+  | \#[^\n]*                    # comment
+  | \S                          # one character operator, anything else is an error
+""", re.VERBOSE)
+
+#characters of the escape sequences of strings, any other escaped
+#character stands for itself
+ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 's': ' ', 'e': '\x1b', '0': '\0'}
+ESCAPE_RE = re.compile(r'\\([\s\S])')
+
+
+def unescape(body):
+    """Returns the value of the text between the quotes of a string literal"""
+    if '\\' not in body:
+        return body
+    return ESCAPE_RE.sub(lambda m: ESCAPES.get(m.group(1), m.group(1)), body)
+
+
+#StreamLexer reads this many characters (or bytes) at a time and forgets
+#its cached lexemes when there are more than MAX_STREAM_LEXEMES of them
+STREAM_CHUNK_SIZE = 64 * 1024
+MAX_STREAM_LEXEMES = 4096
+
+#the first character of a lexeme tells which kind of lexeme it is
+NUMBER_LEXEME, WORD_LEXEME, STR_LEXEME, COMMENT_LEXEME = range(4)
+CHAR_CLASS = dict.fromkeys('0123456789', NUMBER_LEXEME)
+CHAR_CLASS['"'] = STR_LEXEME
+CHAR_CLASS['#'] = COMMENT_LEXEME
+
+
+class UnterminatedString(Exception):
+    """The input ends inside a string literal"""
+
+
 class Lexer(object):
     def __init__(self, text):
         # string input: "2+3*4"
         self.text = text
-        # pos is a pointer to the current character of 'text'
+        # pos is the offset of the next character to be scanned
         self.pos = 0
         self.line = 1
+        # offset of the first character of the current line
+        self.line_start = 0
         # current token 
         self.current_token = None
-        self.current_char = self.text[self.pos]
+        # position of the token returned last by get_next_token()
+        self.token_line = None
+        self.token_column = None
+        # (type, value) of every lexeme seen so far, except strings
+        self.lexemes = {}
 
     def error(self):
         raise Exception('Invalid syntax')
 
-    def advance(self):
-        """Advance the pos pointer and set the current_char variable."""
-        self.pos += 1
-
-        if self.pos > len(self.text) - 1:      #This indicates EOF or end of line
-            self.current_char = None
-        else:
-            self.current_char = self.text[self.pos]
-
-    def peek(self, n):
-        """Peeks the character n characters away from the current current character."""
-        peek_pos = self.pos + n
-        if peek_pos > len(self.text) - 1:      #Indicates EOF
+    def classify(self, lexeme):
+        """Returns the (type, value) pair of a lexeme, or None for a comment"""
+        kind = self.lexemes.get(lexeme)
+        if kind is not None:
+            return kind
+        char_class = CHAR_CLASS.get(lexeme[0])
+        if char_class == NUMBER_LEXEME:
+            if '.' in lexeme:
+                kind = (REAL, float(lexeme))
+            else:
+                kind = (INTEGER, int(lexeme))
+        elif char_class == STR_LEXEME:
+            # the last quote closes the string unless it is escaped
+            body = lexeme[1:-1]
+            closed = len(lexeme) > 1 and lexeme[-1] == '"' and (len(body) - len(body.rstrip('\\'))) % 2 == 0
+            if not closed:
+                raise UnterminatedString('unterminated string literal')
+            return (STR, unescape(body))
+        elif char_class == COMMENT_LEXEME:
             return None
+        elif lexeme in OPERATORS:
+            kind = (OPERATORS[lexeme], lexeme)
+        elif lexeme in RESERVED_KEYWORDS:
+            kind = (RESERVED_KEYWORDS[lexeme].type, lexeme)
+        elif lexeme[0].isalpha():
+            kind = (ID, sys.intern(lexeme))
         else:
-            return self.text[peek_pos]
+            self.error()
+        self.lexemes[lexeme] = kind
+        return kind
 
-    def skip_white_space(self):
-        """Skips white space in the input."""
-        while self.current_char is not None and self.current_char.isspace():
-            if self.current_char == '\n':
-                self.line += 1
-            self.advance()
+    def search(self):
+        """Returns the match of the next lexeme, None at the end of the input"""
+        return LEXEME_RE.search(self.text, self.pos)
 
-    def skip_comment(self):
-        """Skips comments in the input."""
-        while self.current_char not in ['\n','\x00']:
-            self.advance()
+    def get_next_token(self):
+        """Lexical analyzer (also known as scanner or tokenizer)
+        This method is responsible for breaking a sentence
+        apart into tokens. One token at a time.
+
+        Operators, keywords and EOF are shared Tokens without a position,
+        the position of every token is left in token_line and token_column."""
+        while True:
+            m = self.search()
+            text = self.text
+            if m is None:
+                newlines = text.count('\n', self.pos)
+                if newlines:
+                    self.line += newlines
+                    self.line_start = text.rfind('\n', self.pos) + 1
+                self.pos = len(text)
+                self.token_line = self.line
+                self.token_column = self.pos - self.line_start + 1
+                return EOF_TOKEN
+            start = m.start()
+            newlines = text.count('\n', self.pos, start)
+            if newlines:
+                self.line += newlines
+                self.line_start = text.rfind('\n', self.pos, start) + 1
+            line = self.token_line = self.line
+            column = self.token_column = start - self.line_start + 1
+            end = m.end()
+            self.pos = end
+            lexeme = m.group()
+            token = FIXED_TOKENS.get(lexeme)
+            if token is not None:
+                return token
+            kind = self.classify(lexeme)
+            if kind is None:
+                continue
+            if kind[0] is STR:
+                newlines = lexeme.count('\n')
+                if newlines:
+                    self.line += newlines
+                    self.line_start = text.rfind('\n', start, end) + 1
+            return Token(kind[0], kind[1], line, column)
+
+    def tokenize_all(self):
+        """Scans the rest of the input in a single pass.
+
+        Returns three parallel arrays: the token types (as indexes into
+        TOKEN_TYPES), the token values and the offset of each token in
+        the text. The stream always ends with an EOF token.
+        """
+        text = self.text
+        start = self.pos
+        types = array('B')
+        values = []
+        offsets = array('l')
+        add_type = types.append
+        add_value = values.append
+        add_offset = offsets.append
+        classify = self.classify
+        codes = TYPE_CODES
+        for m in LEXEME_RE.finditer(text, start):
+            kind = classify(m.group())
+            if kind is None:
+                continue
+            add_type(codes[kind[0]])
+            add_value(kind[1])
+            add_offset(m.start())
+        self.pos = len(text)
+        self.line += text.count('\n', start)
+        self.line_start = text.rfind('\n', 0, self.pos) + 1
+        add_type(codes[EOF])
+        add_value(None)
+        add_offset(self.pos)
+        return types, values, offsets
+
+    def tokens(self):
+        """Returns the remaining tokens as a list of (token, line, column), EOF included.
+
+        Scans in a single pass like tokenize_all(), giving the tokens and
+        positions get_next_token() would.
+        """
+        #the list only grows by acyclic tuples, running the cyclic garbage
+        #collector over it as it grows would cost more than the scan itself
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return self._tokens()
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _tokens(self):
+        text = self.text
+        classify = self.classify
+        fixed = FIXED_TOKENS
+        tokens = []
+        add = tokens.append
+        count = text.count
+        line = self.line
+        line_start = self.line_start
+        pos = self.pos
+        for m in LEXEME_RE.finditer(text, pos):
+            start = m.start()
+            newlines = count('\n', pos, start)
+            if newlines:
+                line += newlines
+                line_start = text.rfind('\n', pos, start) + 1
+            pos = m.end()
+            lexeme = m.group()
+            token = fixed.get(lexeme)
+            if token is not None:
+                add((token, line, start - line_start + 1))
+                continue
+            kind = classify(lexeme)
+            if kind is None:
+                continue
+            column = start - line_start + 1
+            add((Token(kind[0], kind[1], line, column), line, column))
+            if kind[0] is STR and '\n' in lexeme:
+                line += lexeme.count('\n')
+                line_start = text.rfind('\n', start, pos) + 1
+        newlines = count('\n', pos)
+        if newlines:
+            line += newlines
+            line_start = text.rfind('\n', pos) + 1
+        self.pos = len(text)
+        self.line = self.token_line = line
+        self.line_start = line_start
+        self.token_column = self.pos - line_start + 1
+        add((EOF_TOKEN, line, self.token_column))
+        return tokens
+
+
+class StreamLexer(Lexer):
+    """Lexer reading its text from a file object in chunks.
+
+    Works on text and binary files, pipes and mmap objects; bytes are
+    decoded as utf-8. Only the unscanned rest of the input plus one
+    chunk is kept in memory: a lexeme that reaches the end of the buffer
+    might continue in the next chunk, so it is scanned again once more
+    input has been read.
+    """
+
+    def __init__(self, file, chunk_size=STREAM_CHUNK_SIZE):
+        Lexer.__init__(self, '')
+        # read1 returns what a pipe has available instead of waiting for a full chunk
+        self.read = getattr(file, 'read1', file.read)
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.at_eof = False
+
+    def fill(self):
+        """Appends the next chunk to the buffer, dropping the text already scanned"""
+        chunk = self.read(self.chunk_size)
+        self.at_eof = not chunk
+        if not isinstance(chunk, str):
+            chunk = self.decoder.decode(chunk, final=self.at_eof)
+        drop = self.pos
+        self.text = self.text[drop:] + chunk
+        self.pos = 0
+        self.line_start -= drop
+        if len(self.lexemes) > MAX_STREAM_LEXEMES:
+            self.lexemes.clear()
 
-    def number(self):
-        """Returns an integer(multidigit) or a float that is read from the input"""
-        result = ''
-        while self.current_char is not None and self.current_char.isdigit():
-            result += self.current_char
-            self.advance()
+    def search(self):
+        while True:
+            m = LEXEME_RE.search(self.text, self.pos)
+            if self.at_eof or (m is not None and m.end() < len(self.text)):
+                return m
+            self.fill()
 
-        if self.current_char == '.':
-            result += self.current_char
-            self.advance()
 
-            while self.current_char is not None and self.current_char.isdigit():
-                result += self.current_char
-                self.advance()
+class OffsetLexer(Lexer):
+    """Lexer noting where the lexeme it scanned last starts and ends.
 
-            token = Token('REAL', float(result))
+    After a Parser returned a statement, match_start is the offset of its
+    lookahead token, the end of the text at EOF.
+    """
 
+    def search(self):
+        m = Lexer.search(self)
+        if m is None:
+            self.match_start = self.match_end = len(self.text)
         else:
-            token = Token('INTEGER', int(result))
-
-        return token
+            self.match_start = m.start()
+            self.match_end = m.end()
+        return m
 
-    def string(self):
-        result = ''
-        self.advance()
-        while self.current_char is not None and self.current_char != '"':
-            result += self.current_char
-            self.advance()
-        self.advance()
 
-        token = Token('STR', result)
-        return token
+class ReplayLexer(object):
+    """Feeds a list of already scanned (token, line, column) entries to a Parser"""
 
-    def _id(self):
-        """Handle identifiers and reserved keywords"""
-        result = ''
-        while self.current_char is not None and self.current_char.isalnum() or self.current_char=='_':
-            result += self.current_char
-            self.advance()
-
-        token = RESERVED_KEYWORDS.get(result, Token(ID, result))
-        return token
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+        self.token_line = None
+        self.token_column = None
 
     def get_next_token(self):
-        """Lexical analyzer (also known as scanner or tokenizer)
-        This method is responsible for breaking a sentence
-        apart into tokens. One token at a time."""
-        while self.current_char is not None:
-
-            if self.current_char.isspace():
-                self.skip_white_space()
-                continue
-
-            if self.current_char == '#':
-                self.advance()
-                self.skip_comment()
-                continue
-
-            if self.current_char.isalpha():
-                return self._id()
-
-            if self.current_char.isdigit():
-                return self.number()
-
-            if self.current_char == '=' and self.peek(1)!='=':
-                self.advance()
-                return Token(ASSIGN, '=')
-
-            if self.current_char == '=' and self.peek(1)=='=':
-                self.advance()
-                self.advance()
-                return Token(EQUAL, '==')
-
-            if self.current_char == '!' and self.peek(1)=='=':
-                self.advance()
-                self.advance()
-                return Token(NOT, '!=')
-
-            if self.current_char == '>' and self.peek(1)!='=':
-                self.advance()
-                return Token(GRET, '>')
-
-            if self.current_char == '<' and self.peek(1) == '=':
-                self.advance()
-                self.advance()
-                return Token(LESE, '<=')
-
-            if self.current_char == '>' and self.peek(1) == '=':
-                self.advance()
-                self.advance()
-                return Token(GRE, '>=')
-
-            if self.current_char == '<' and self.peek(1) != '=':
-                self.advance()
-                return Token(LEST, '<')
-
-            if self.current_char == '+':
-                self.advance()
-                return Token(PLUS, '+')
-
-            if self.current_char == '-':
-                self.advance()
-                return Token(MINUS, '-')
-
-            if self.current_char == '*':
-                self.advance()
-                return Token(MUL, '*')
-
-            if self.current_char == '/':
-                self.advance()
-                return Token(DIV, '/')
-
-            if self.current_char == '%':
-                self.advance()
-                return Token(MOD, '%')
-
-            if self.current_char == ';':
-                self.advance()
-                return Token(SEMI, ';')
-
-            if self.current_char == ',':
-                self.advance()
-                return Token(COMMA, ',')
-
-            if self.current_char == 'i' and self.peek(1) == 'f':
-                self.advance()
-                self.advance()
-                return Token(IF, 'if')
-
-            if self.current_char == 'e' and self.peek(1) == 'l' and self.peek(2) == 's' and self.peek(3) == 'e':
-                for x in range (0,4):
-                    self.advance()
-                return Token(ELSE,'else')
-
-            if self.current_char == 'e' and self.peek(1) == 'l' and self.peek(2) == 's' and self.peek(3) == 'i' and self.peek(4) == 'f':
-                for x in range (0,5):
-                    self.advance()
-                return Token(ELSIF,'elsif')
-
-            if self.current_char == 'w' and self.peek(1) == 'h' and self.peek(2) == 'i' and self.peek(3) == 'l' and self.peek(4) == 'e' and self.peek(5):
-                for x in range (0,5):
-                    self.advance()
-                return Token(WHILE, 'while')
-
-            if self.current_char == 'e' and self.peek(1) == 'n' and self.peek(2) == 'd':
-                for x in range (0, 3):
-                    self.advance()
-                return Token(END, 'end')
-
-            if self.current_char == 't' and self.peek(1) == 'r' and self.peek(2)=='u' and self.peek(3)=='e':
-                for x in range (0,4):
-                    self.advance()
-                return Token(TRUE, 'true')
-
-            if self.current_char == 'f' and self.peek(1) == 'a' and self.peek(2)=='l' and self.peek(3)=='s' and self.peek(4)=='e':
-                for x in range (0,5):
-                    self.advance()
-                return Token(FALSE, 'false')
-
-            if self.current_char == ')':
-                self.advance()
-                return Token(RPAREN, ')')
-
-            if self.current_char == '(':
-                self.advance()
-                return Token(LPAREN, '(')
-
-            if self.current_char == '.':
-                self.advance()
-                return Token(DOT, '.')
-
-            if self.current_char == '"':
-                self.advance()
-                return Token(APOS,'"')
-
-            self.error()
-
-        return Token(EOF, None)
\ No newline at end of file
+        if self.pos < len(self.tokens):
+            token, self.token_line, self.token_column = self.tokens[self.pos]
+            self.pos += 1
+            return token
+        return EOF_TOKEN
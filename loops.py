@@ -0,0 +1,432 @@
+import math
+
+from parser_ruby import *
+
+#the operators a closed form loop may compute with, on integers only
+AFFINE_OPS = (PLUS, MINUS, MUL)
+#the comparisons a closed form loop condition may make
+CLOSED_COMPARISONS = (LEST, LESE, GRET, GRE, EQUAL, NOT)
+
+
+class HoistedBinOp(BinOp):
+    """A BinOp whose value cannot change while its loop runs.
+
+    The backends compute it the first time an iteration needs it and
+    reuse the value for the rest of that run of the loop.
+    """
+    __slots__ = ()
+
+
+class HoistedUnaryOp(UnaryOp):
+    """A UnaryOp whose value cannot change while its loop runs"""
+    __slots__ = ()
+
+
+HOISTED = (HoistedBinOp, HoistedUnaryOp)
+
+
+class LoopPlan(object):
+    """What the loop analysis found out about a While.
+
+    written holds the names of the variables the loop may assign.
+    invariants are the largest operator expressions of the loop that
+    only read constants and variables it never assigns; they are turned
+    into HoistedBinOp/HoistedUnaryOp nodes, in place. closed is the
+    ClosedForm of a loop that only steps integer induction variables,
+    None for any other loop.
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self.written = self.assigned()
+        self.invariants = self.hoist()
+        self.closed = closed_form(node)
+
+    def assigned(self):
+        written = set()
+        stack = [self.node.condition, self.node.body]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, list):
+                stack.extend(node)
+                continue
+            if isinstance(node, Assign):
+                written.add(node.left.value)
+            elif isinstance(node, For):
+                written.add(node.var.value)
+            elif isinstance(node, MethodCall) and node.body is not None:
+                written.add(node.param)
+            elif isinstance(node, Def):
+                # the body of a def inside the loop is a method of its own
+                continue
+            stack.extend(iter_child_nodes(node))
+        return written
+
+    def invariant(self, expr, known):
+        """Notes in known, by id, which nodes of an expression the loop cannot change"""
+        # post order, the operands of an operator are known before it
+        stack = [(expr, False)]
+        while stack:
+            node, ready = stack.pop()
+            if isinstance(node, Var):
+                known[id(node)] = node.value not in self.written
+            elif isinstance(node, Num):
+                known[id(node)] = True
+            elif not isinstance(node, (BinOp, UnaryOp)):
+                known[id(node)] = False
+            elif ready:
+                known[id(node)] = all(known[id(child)] for child in iter_child_nodes(node))
+            else:
+                stack.append((node, True))
+                stack.extend((child, False) for child in iter_child_nodes(node))
+
+    def hoist(self):
+        known = {}
+        invariants = []
+        stack = [self.node.condition, self.node.body]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, list):
+                stack.extend(node)
+                continue
+            if isinstance(node, (BinOp, UnaryOp)):
+                if id(node) not in known:
+                    self.invariant(node, known)
+                if known[id(node)]:
+                    #a sign in front of a variable or constant costs no more to recompute
+                    if isinstance(node, BinOp) or isinstance(node.expr, (BinOp, UnaryOp)):
+                        node.__class__ = HoistedBinOp if isinstance(node, BinOp) else HoistedUnaryOp
+                        invariants.append(node)
+                    continue
+            elif isinstance(node, Def):
+                continue
+            elif isinstance(node, MethodCall) and node.body is not None:
+                # a block is native code that reads its variables once per call
+                stack.append(node.receiver)
+                continue
+            stack.extend(iter_child_nodes(node))
+        return invariants
+
+
+def loop_plan(node):
+    """Returns the LoopPlan of a While, analysed once per node"""
+    if node.plan is None:
+        node.plan = LoopPlan(node)
+    return node.plan
+
+
+def operators(expr):
+    """Counts the BinOp and UnaryOp nodes of an expression"""
+    count = 0
+    stack = [expr]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, (BinOp, UnaryOp)):
+            count += 1
+            stack.extend(iter_child_nodes(node))
+    return count
+
+
+def affine(expr):
+    """Tells whether an expression only adds, subtracts and multiplies int constants and variables"""
+    stack = [expr]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Num):
+            if type(node.value) is not int:
+                return False
+        elif isinstance(node, BinOp):
+            if node.op.type not in AFFINE_OPS:
+                return False
+            stack.append(node.left)
+            stack.append(node.right)
+        elif isinstance(node, UnaryOp):
+            stack.append(node.expr)
+        elif not isinstance(node, Var):
+            return False
+    return True
+
+
+def mentions(expr, name):
+    stack = [expr]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Var):
+            if node.value == name:
+                return True
+        else:
+            stack.extend(iter_child_nodes(node))
+    return False
+
+
+def terms(expr):
+    """Splits an expression into the (sign, node) terms it adds up"""
+    result = []
+    stack = [(expr, 1)]
+    while stack:
+        node, sign = stack.pop()
+        if isinstance(node, BinOp) and node.op.type in (PLUS, MINUS):
+            stack.append((node.left, sign))
+            stack.append((node.right, -sign if node.op.type == MINUS else sign))
+        elif isinstance(node, UnaryOp):
+            stack.append((node.expr, -sign if node.op.type == MINUS else sign))
+        else:
+            result.append((sign, node))
+    return result
+
+
+def closed_form(node):
+    """Returns the ClosedForm of a While, None when its shape does not allow one"""
+    condition = node.condition
+    if not (isinstance(condition, BinOp) and condition.op.type in CLOSED_COMPARISONS
+            and affine(condition.left) and affine(condition.right)):
+        return None
+    statements = []
+    for statement in node.body:
+        if isinstance(statement, NoOp):
+            continue
+        if not (isinstance(statement, Assign) and affine(statement.right)):
+            return None
+        statements.append(statement)
+    if not statements:
+        return None
+    if len(set(statement.left.value for statement in statements)) != len(statements):
+        return None
+    return ClosedForm(condition, statements)
+
+
+class Unsolvable(Exception):
+    """The values a ClosedForm is solved for do not allow a closed form"""
+
+
+class ClosedForm(object):
+    """A While that only steps integer induction variables, solved without iterating.
+
+    Its body only assigns +, -, * expressions of int constants and
+    variables, each variable once, and its condition compares two such
+    expressions. vars holds a Var node of every variable the loop uses,
+    the targets it assigns first. solve() works out the trip count and
+    the values the targets end with from the values before the loop.
+    """
+
+    def __init__(self, condition, statements):
+        self.condition = condition
+        # (name, increment terms or None, expression) of every assignment
+        self.steps = []
+        # name -> index of the step assigning it
+        self.assigned = {}
+        self.vars = []
+        for index, statement in enumerate(statements):
+            name = statement.left.value
+            self.assigned[name] = index
+            self.vars.append(statement.left)
+            self.steps.append((name, self.increment(name, statement.right), statement.right))
+        self.targets = len(self.vars)
+        seen = set(self.assigned)
+        stack = [condition] + [statement.right for statement in statements]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, Var):
+                if node.value not in seen:
+                    seen.add(node.value)
+                    self.vars.append(node)
+            else:
+                stack.extend(iter_child_nodes(node))
+
+    def increment(self, name, expr):
+        """Returns the terms added by v = v + terms, None for any other assignment of v"""
+        found = terms(expr)
+        own = [term for term in found if isinstance(term[1], Var) and term[1].value == name]
+        if len(own) != 1 or own[0][0] != 1:
+            return None
+        rest = [term for term in found if term is not own[0]]
+        if any(mentions(node, name) for sign, node in rest):
+            return None
+        return rest
+
+    def solve(self, values):
+        """Returns the values of the targets after the loop, given the ones of vars before it.
+
+        None when the loop has to run instead: a value it needs is not an
+        int, a target would be left unset or the loop would not end.
+        """
+        solver = Solver(self, {var.value: value for var, value in zip(self.vars, values)})
+        try:
+            count = solver.trip_count()
+            if count is None:
+                return None
+            results = [solver.final(var.value, count) for var in self.vars[:self.targets]]
+        except (Unsolvable, RecursionError):
+            return None
+        if None in results:
+            return None
+        return results
+
+
+def poly(value):
+    """Returns the constant polynomial of an int"""
+    return [value] if value else []
+
+
+def poly_add(p, q, sign=1):
+    result = list(p) + [0] * (len(q) - len(p))
+    for m, c in enumerate(q):
+        result[m] += sign * c
+    while result and not result[-1]:
+        result.pop()
+    return result
+
+
+def poly_scale(p, factor):
+    return [c * factor for c in p] if factor else []
+
+
+def poly_at(p, k):
+    return sum(c * math.comb(k, m) for m, c in enumerate(p))
+
+
+class Solver(object):
+    """Runs the body of a ClosedForm on polynomials of the iteration number k.
+
+    A polynomial is the list of its coefficients in the binomial basis,
+    p(k) = sum(p[m] * C(k, m)), so the sum of p over the iterations
+    before k is p shifted up by one. A step v = v + e makes the start
+    value of v the start value before the loop plus the sum of e, any
+    other step is evaluated in place and may only be read after it in
+    the same iteration. A product needs a constant side. Anything else
+    (a value that is not an int, steps depending on each other in a
+    cycle) raises Unsolvable.
+    """
+
+    def __init__(self, form, values):
+        self.form = form
+        self.values = values
+        # name -> polynomial of its value at the start of iteration k
+        self.starts = {}
+        # step index -> polynomial of the value it assigns in iteration k
+        self.results = {}
+        self.solving = set()
+
+    def initial(self, name):
+        value = self.values.get(name)
+        if type(value) is not int:
+            raise Unsolvable(name)
+        return poly(value)
+
+    def read(self, name, position):
+        """Returns the polynomial of a variable read before the step at position"""
+        index = self.form.assigned.get(name)
+        if index is None:
+            return self.initial(name)
+        if index < position:
+            return self.result(index)
+        if self.form.steps[index][1] is None:
+            raise Unsolvable(name)
+        return self.start(name)
+
+    def start(self, name):
+        start = self.starts.get(name)
+        if start is None:
+            if name in self.solving:
+                raise Unsolvable(name)
+            self.solving.add(name)
+            added = self.added(self.form.assigned[name])
+            start = self.starts[name] = poly_add(self.initial(name), [0] + added if added else [])
+            self.solving.discard(name)
+        return start
+
+    def added(self, index):
+        """Returns the polynomial a v = v + e step adds in iteration k"""
+        total = []
+        for sign, node in self.form.steps[index][1]:
+            total = poly_add(total, self.evaluate(node, index), sign)
+        return total
+
+    def result(self, index):
+        result = self.results.get(index)
+        if result is None:
+            name, increment, expr = self.form.steps[index]
+            if increment is None:
+                result = self.evaluate(expr, index)
+            else:
+                result = poly_add(self.start(name), self.added(index))
+            self.results[index] = result
+        return result
+
+    def evaluate(self, node, position):
+        if isinstance(node, Num):
+            return poly(node.value)
+        if isinstance(node, Var):
+            return self.read(node.value, position)
+        if isinstance(node, UnaryOp):
+            value = self.evaluate(node.expr, position)
+            return poly_scale(value, -1) if node.op.type == MINUS else value
+        left = self.evaluate(node.left, position)
+        right = self.evaluate(node.right, position)
+        if node.op.type == PLUS:
+            return poly_add(left, right)
+        if node.op.type == MINUS:
+            return poly_add(left, right, -1)
+        if len(left) <= 1:
+            return poly_scale(right, left[0] if left else 0)
+        if len(right) <= 1:
+            return poly_scale(left, right[0] if right else 0)
+        raise Unsolvable('product of two induction variables')
+
+    def trip_count(self):
+        """Returns how many iterations the loop runs, None when it never ends"""
+        condition = self.form.condition
+        op = condition.op.type
+        difference = poly_add(self.evaluate(condition.left, 0), self.evaluate(condition.right, 0), -1)
+        if op in (EQUAL, NOT):
+            return self.equality_count(difference, op)
+        # the loop runs while below(k) < 0, the ints being whole
+        if op == LEST:
+            below = difference
+        elif op == LESE:
+            below = poly_add(difference, [1], -1)
+        elif op == GRET:
+            below = poly_scale(difference, -1)
+        else:
+            below = poly_add(poly_scale(difference, -1), [1], -1)
+        if poly_at(below, 0) >= 0:
+            return 0
+        # with no negative coefficient past the constant below(k) never
+        # decreases, so the iterations are the k before it reaches 0
+        if not any(below[1:]) or min(below[1:]) < 0:
+            return None
+        high = 1
+        while poly_at(below, high) < 0:
+            high *= 2
+        low = high // 2
+        while high - low > 1:
+            middle = (low + high) // 2
+            if poly_at(below, middle) < 0:
+                low = middle
+            else:
+                high = middle
+        return high
+
+    def equality_count(self, difference, op):
+        if len(difference) > 2:
+            raise Unsolvable('condition is not linear')
+        start = poly_at(difference, 0)
+        step = difference[1] if len(difference) == 2 else 0
+        if op == EQUAL:
+            if start:
+                return 0
+            return 1 if step else None
+        if not start:
+            return 0
+        if not step or -start % step or -start // step < 0:
+            return None
+        return -start // step
+
+    def final(self, name, count):
+        """Returns the value of a target after count iterations"""
+        if not count:
+            return self.values.get(name)
+        index = self.form.assigned[name]
+        if self.form.steps[index][1] is not None:
+            return poly_at(self.start(name), count)
+        return poly_at(self.result(index), count - 1)
@@ -1,20 +1,244 @@
+import argparse
+import mmap
+import os
+import sys
+
 from lexer import *
 from parser_ruby import *
 from interpreter import *
+from compiler import *
+from vm import *
+from optimizer import optimize
+from cache import *
+from runner import *
+from profiler import ProfilingInterpreter
+from parallel import ParallelExecutor, StatementGraph, statements_of
+from repl import interact
+from chunked import parse_file
+from checkpoint import CheckpointedRun, CheckpointError, DEFAULT_INTERVAL
+
+DEFAULT_SCRIPT = "./testCases/input_test6.txt"
 
-def main():
-    file = open("./testCases/input_test6.txt", "r")
-    text = file.read()
-    lex = Lexer(text)
-    # for i in range(0,15):
-    #     print(lex.get_next_token())
-    par = Parser(lex)
-    tree = par.parse()
-    print(tree)
-    inter = Interpreter(tree)
+def run_single(path=DEFAULT_SCRIPT, backend='vm', optimized=True, dump_node_counts=False,
+               use_cache=True, clear_cache=False, profile=False, profile_output=None,
+               specialization_report=False, parallel=False, jobs=None, dependency_report=False,
+               method_stats=False, trace_report=False, parallel_parse=False):
+    """Runs one script, printing its final GLOBAL_MEMORY.
+
+    With profile set the tree walker records per node and per line counts
+    and timings, prints the hot spots and optionally writes collapsed
+    stacks for flamegraph tools to profile_output. specialization_report
+    prints the BinOp hit rates of the specializing backend. parallel runs
+    independent top level statements at the same time on jobs processes,
+    dependency_report prints their critical path and parallelism.
+    method_stats prints the call, frame and memo counters of the methods.
+    trace_report prints the loop traces of the tracing backend.
+    parallel_parse lexes and parses the script in chunks on jobs
+    processes, bypassing the cache.
+    """
+    if parallel_parse:
+        tree = parse_file(path, jobs)
+        if optimized:
+            tree = optimize(tree, dump=dump_node_counts)
+    else:
+        with open(path, "r") as file:
+            text = file.read()
+        # parsed programs are cached in __rbcache__ next to the script
+        cache = ProgramCache(os.path.join(os.path.dirname(path), DEFAULT_CACHE_DIR))
+        if clear_cache:
+            cache.clear()
+        tree = load_program(text, cache, optimized, bypass=not use_cache, dump=dump_node_counts)
+    if profile:
+        inter = ProfilingInterpreter(tree)
+    elif parallel:
+        inter = ParallelExecutor(tree, jobs, backend)
+    else:
+        inter = BACKENDS[backend](tree)
     result = inter.interpret()
     print('Run-time GLOBAL_MEMORY contents:')
     print(inter.GLOBAL_MEMORY)
+    if dependency_report:
+        print(inter.report() if parallel else StatementGraph(statements_of(tree)).report())
+    if profile:
+        print(inter.report())
+        if profile_output:
+            inter.write_collapsed(profile_output)
+    if specialization_report:
+        print(inter.specialization_report())
+    if trace_report:
+        print(inter.trace_report())
+    if method_stats:
+        methods = getattr(inter, 'methods', None)
+        print(inter.method_report() if methods else 'no methods defined')
+
+def run_streaming(path, backend='tree', optimized=True, echo=False):
+    """Runs one script while it is read, '-' reads it from stdin.
+
+    Files are memory-mapped, stdin is read as it arrives. With echo set
+    every top level assignment prints its variable and value as soon as
+    it ran.
+    """
+    inter = STREAM_BACKENDS[backend](None)
+
+    def print_assignment(node):
+        if isinstance(node, Assign):
+            name = node.left.value
+            sys.stdout.write('{} = {!r}\n'.format(name, inter.GLOBAL_MEMORY[name]))
+            sys.stdout.flush()
+
+    callback = print_assignment if echo else None
+    if path == '-':
+        inter.run_statements(stream_statements(sys.stdin.buffer, optimized), callback)
+    else:
+        with open(path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size:
+                source = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                source = file
+            try:
+                inter.run_statements(stream_statements(source, optimized), callback)
+            finally:
+                if source is not file:
+                    source.close()
+    print('Run-time GLOBAL_MEMORY contents:')
+    print(inter.GLOBAL_MEMORY)
+
+def run_checkpointed(path, checkpoint=None, interval=DEFAULT_INTERVAL, resume=None, optimized=True,
+                     use_cache=True):
+    """Runs one script on the VM, checkpointing it to checkpoint and/or resuming it from resume.
+
+    Returns 0 once it finished and 3 when SIGTERM stopped it after its
+    last checkpoint was written.
+    """
+    with open(path, 'r') as file:
+        text = file.read()
+    cache = ProgramCache(os.path.join(os.path.dirname(path), DEFAULT_CACHE_DIR))
+    tree = load_program(text, cache, optimized, bypass=not use_cache)
+    inter = CheckpointedRun(text, tree, checkpoint, interval, resume, optimized)
+    if not inter.run():
+        sys.stderr.write('stopped after {} steps, resume with --resume {}\n'.format(inter.vm.steps, checkpoint))
+        return 3
+    print('Run-time GLOBAL_MEMORY contents:')
+    print(inter.GLOBAL_MEMORY)
+    return 0
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Run Ruby scripts. Without paths the bundled demo script is run '
+                    'and its GLOBAL_MEMORY is printed; with paths one JSON '
+                    'result per script is streamed to stdout.')
+    parser.add_argument('paths', nargs='*', help='script paths or glob patterns')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='vm')
+    parser.add_argument('--no-optimize', dest='optimized', action='store_false',
+                        help='run the tree exactly as parsed')
+    parser.add_argument('--dump-node-counts', action='store_true',
+                        help='print the node counts before and after optimizing')
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                        help='neither read nor write the parsed program cache')
+    parser.add_argument('--clear-cache', action='store_true',
+                        help='empty the parsed program cache before running')
+    parser.add_argument('--stream', action='store_true',
+                        help="run a single script ('-' for stdin) one top level statement at a time "
+                             'while it is read, with constant memory')
+    parser.add_argument('--repl', action='store_true',
+                        help='read statements interactively, keeping the variables and methods between '
+                             'them; the paths are loaded first and can be reloaded with :reload')
+    parser.add_argument('--echo', action='store_true',
+                        help='with --stream, print every top level assignment as it runs')
+    parser.add_argument('--checkpoint', metavar='FILE',
+                        help='run a single script on the vm, writing its state to FILE every '
+                             '--checkpoint-interval seconds, on SIGUSR1 and on SIGTERM, which also stops it')
+    parser.add_argument('--checkpoint-interval', type=float, default=DEFAULT_INTERVAL, metavar='SECONDS',
+                        help='seconds between two checkpoints, 0 to write them only on signals '
+                             '(default: %(default)s)')
+    parser.add_argument('--resume', metavar='FILE',
+                        help='continue a single script from the checkpoint in FILE instead of its beginning')
+    parser.add_argument('--specialization-report', action='store_true',
+                        help='with --backend specializing, print the hit rates of the specialized operations')
+    parser.add_argument('--trace-report', action='store_true',
+                        help='with --backend tracing, print the traced loops, guard failures and compile times')
+    parser.add_argument('--parallel', action='store_true',
+                        help='run independent top level statements of a single script at the same time '
+                             'on --jobs worker processes')
+    parser.add_argument('--parallel-parse', action='store_true',
+                        help='lex and parse a single large script in chunks on --jobs worker processes')
+    parser.add_argument('--dependency-report', action='store_true',
+                        help='print the critical path and the parallelism of the top level statements')
+    parser.add_argument('--method-stats', action='store_true',
+                        help='print the calls, frame reuse and memo hit rates of the methods defined')
+    parser.add_argument('--profile', action='store_true',
+                        help='run a single script on the profiling tree walker and print its hot spots')
+    parser.add_argument('--profile-output', metavar='FILE',
+                        help='with --profile, write collapsed stacks for flamegraph tools to FILE')
+    return parser
+
+def main(argv=None):
+    arg_parser = build_arg_parser()
+    args = arg_parser.parse_args(argv)
+    if args.repl:
+        # the default backend cannot run statements one at a time, the tree walker stands in for it
+        backend = 'tree' if args.backend == 'vm' else args.backend
+        if backend not in STREAM_BACKENDS:
+            arg_parser.error('--repl runs on the {} backends'.format(' or '.join(sorted(STREAM_BACKENDS))))
+        interact(backend, args.optimized, expand_paths(args.paths))
+        return 0
+    if args.checkpoint or args.resume:
+        paths = expand_paths(args.paths) or [DEFAULT_SCRIPT]
+        if len(paths) != 1:
+            arg_parser.error('--checkpoint and --resume run a single script')
+        if args.backend != 'vm':
+            arg_parser.error('--checkpoint and --resume run on the vm backend')
+        if args.checkpoint_interval < 0:
+            arg_parser.error('--checkpoint-interval must not be negative')
+        try:
+            return run_checkpointed(paths[0], args.checkpoint, args.checkpoint_interval or None,
+                                    args.resume, args.optimized, args.use_cache)
+        except (CheckpointError, OSError) as e:
+            sys.stderr.write('{}\n'.format(e))
+            return 1
+    if args.stream:
+        paths = expand_paths(args.paths) or [DEFAULT_SCRIPT]
+        if len(paths) != 1:
+            arg_parser.error('--stream runs a single script')
+        # the default backend cannot stream, the tree walker stands in for it
+        backend = 'tree' if args.backend == 'vm' else args.backend
+        if backend not in STREAM_BACKENDS:
+            arg_parser.error('--stream runs on the {} backends'.format(' or '.join(sorted(STREAM_BACKENDS))))
+        run_streaming(paths[0], backend, args.optimized, args.echo)
+        return 0
+    if args.specialization_report and (args.backend != 'specializing' or args.profile):
+        arg_parser.error('--specialization-report needs --backend specializing')
+    if args.trace_report and (args.backend != 'tracing' or args.profile):
+        arg_parser.error('--trace-report needs --backend tracing')
+    if args.parallel and (args.profile or args.specialization_report or args.method_stats
+                          or args.trace_report):
+        arg_parser.error('--parallel cannot be combined with --profile, --specialization-report, '
+                         '--trace-report or --method-stats')
+    single = (args.profile or args.specialization_report or args.parallel or args.dependency_report
+              or args.method_stats or args.trace_report or args.parallel_parse)
+    if not args.paths or single:
+        paths = expand_paths(args.paths) or [DEFAULT_SCRIPT]
+        if len(paths) != 1:
+            arg_parser.error('--profile, --specialization-report, --trace-report, --parallel, '
+                             '--parallel-parse, --dependency-report and --method-stats run a single script')
+        run_single(paths[0], args.backend, args.optimized, args.dump_node_counts,
+                   args.use_cache, args.clear_cache, args.profile, args.profile_output,
+                   args.specialization_report, args.parallel, args.jobs, args.dependency_report,
+                   args.method_stats, args.trace_report, args.parallel_parse)
+        return 0
+    paths = expand_paths(args.paths)
+    if args.clear_cache:
+        for cache_dir in set(os.path.join(os.path.dirname(path), DEFAULT_CACHE_DIR) for path in paths):
+            ProgramCache(cache_dir).clear()
+    failed = 0
+    for result in run_many(paths, args.jobs, args.backend, args.optimized, args.use_cache):
+        if result['status'] != 'ok':
+            failed += 1
+        sys.stdout.write(to_json(result) + '\n')
+        sys.stdout.flush()
+    return 1 if failed else 0
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,260 @@
+from collections import OrderedDict
+
+from parser_ruby import *
+from rope import flatten
+
+#most results a memoized method keeps, the least recently used go first
+MAX_MEMO_ENTRIES = 4096
+#free frames kept for reuse per method, deeper recursion allocates more
+MAX_POOLED_FRAMES = 64
+#deepest nesting of method calls, deeper non tail recursion raises
+#RecursionError (Ruby's "stack level too deep")
+MAX_CALL_DEPTH = 10000
+#python frames a nested call may take, the recursion limit is raised by
+#MAX_CALL_DEPTH of them while the outermost call runs; a Ruby call nests
+#about fifteen python frames, so the default limit would stop recursion
+#at ~60 calls
+FRAMES_PER_CALL = 20
+
+
+class LocalVar(Var):
+    """A Var of a method local, slot is its index in the method frame"""
+    __slots__ = ()
+
+
+class LocalAssign(Assign):
+    """An Assign to a method local"""
+    __slots__ = ()
+
+
+class LocalFor(For):
+    """A For whose loop variable is a method local"""
+    __slots__ = ()
+
+
+class MethodCode(object):
+    """What is known about a Def before it runs.
+
+    Its parameters and every variable it assigns are locals, each with a
+    slot of the method frame, parameters first; their Var, Assign and For
+    nodes are turned into LocalVar, LocalAssign and LocalFor. Any other
+    variable it reads is a top level variable, a global. The Call of a
+    Return is marked as a tail call.
+    """
+
+    def __init__(self, node):
+        self.name = node.name
+        self.params = node.params
+        self.body = node.body
+        self.memoize = node.memoize
+        self.slots = {}
+        self.names = []
+        # globals read and methods called by the body
+        self.globals = set()
+        self.calls = set()
+        for name in node.params:
+            self.slot(name)
+        self.assigned(node.body)
+        self.rewrite(node.body)
+
+    def slot(self, name):
+        slot = self.slots.get(name)
+        if slot is None:
+            slot = self.slots[name] = len(self.names)
+            self.names.append(name)
+        return slot
+
+    def assigned(self, body):
+        """Gives a slot to every variable assigned in body"""
+        stack = [body]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, Assign):
+                self.slot(node.left.value)
+            elif isinstance(node, For):
+                self.slot(node.var.value)
+            if not isinstance(node, Def):
+                stack.extend(iter_child_nodes(node))
+
+    def rewrite(self, body):
+        # (node, names of the enclosing block parameters)
+        stack = [(body, frozenset())]
+        while stack:
+            node, params = stack.pop()
+            if isinstance(node, Var):
+                if node.value in params:
+                    continue
+                slot = self.slots.get(node.value)
+                if slot is None:
+                    self.globals.add(node.value)
+                else:
+                    node.__class__ = LocalVar
+                    node.slot = slot
+                continue
+            if isinstance(node, Def):
+                # a nested def is a method of its own
+                continue
+            if type(node) is Assign:
+                node.__class__ = LocalAssign
+            elif type(node) is For:
+                node.__class__ = LocalFor
+            elif isinstance(node, Call):
+                self.calls.add(node.name)
+            elif isinstance(node, Return) and isinstance(node.value, Call):
+                node.value.tail = True
+            elif isinstance(node, MethodCall) and node.body is not None:
+                stack.append((node.receiver, params))
+                stack.append((node.body, params | {node.param}))
+                continue
+            stack.extend((child, params) for child in iter_child_nodes(node))
+
+
+def method_code(node):
+    """Returns the MethodCode of a Def, analysed once per node"""
+    if node.code is None:
+        node.code = MethodCode(node)
+    return node.code
+
+
+def uses_methods(tree):
+    """Tells whether a tree defines or calls methods"""
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, (Def, Call)):
+            return True
+        stack.extend(iter_child_nodes(node))
+    return False
+
+
+class MethodReturn(Exception):
+    """Raised by a Return to end the method running it"""
+
+    def __init__(self, value):
+        self.value = value
+
+
+class TailCall(Exception):
+    """Raised by a Return of a call, the caller's frame is done before the call runs"""
+
+    def __init__(self, method, frame):
+        self.method = method
+        self.frame = frame
+
+
+class Method(object):
+    """A method defined in one interpreter.
+
+    Frames are lists of the method's locals taken from a pool of cleared
+    ones, so a call allocates nothing once the pool is warm. With memo
+    set (memoize def of a pure method) results are kept in a bounded LRU
+    cache keyed by the argument types and values. The counters are
+    reported by Interpreter.method_stats().
+    """
+
+    def __init__(self, code):
+        self.code = code
+        self.name = code.name
+        self.arity = len(code.params)
+        self.blank = [None] * len(code.names)
+        self.pool = []
+        self.memo = None
+        # None until purity is decided at the first call
+        self.pure = None
+        self.impure = None
+        self.calls = 0
+        self.tail_calls = 0
+        self.allocated = 0
+        self.reused = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def new_frame(self):
+        pool = self.pool
+        if pool:
+            self.reused += 1
+            return pool.pop()
+        self.allocated += 1
+        return self.blank[:]
+
+    def release(self, frame):
+        if len(self.pool) < MAX_POOLED_FRAMES:
+            frame[:] = self.blank
+            self.pool.append(frame)
+
+    def forget(self):
+        """Drops the memo and the purity verdict, a method was (re)defined"""
+        self.pure = self.impure = None
+        self.memo = None
+
+    def decide(self, methods):
+        """Decides whether the method is pure and starts its memo if it may have one"""
+        self.impure = impurity(self, methods, set())
+        self.pure = self.impure is None
+        if self.pure and self.code.memoize:
+            self.memo = OrderedDict()
+
+    def key(self, frame):
+        """Returns the memo key of the arguments in frame, None if one is unhashable"""
+        key = tuple((type(value), value) for value in map(flatten, frame[:self.arity]))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def lookup(self, key):
+        memo = self.memo
+        if key in memo:
+            memo.move_to_end(key)
+            self.hits += 1
+            return memo[key]
+        self.misses += 1
+        return None
+
+    def remember(self, key, value):
+        memo = self.memo
+        memo[key] = value
+        if len(memo) > MAX_MEMO_ENTRIES:
+            memo.popitem(last=False)
+            self.evictions += 1
+
+
+def impurity(method, methods, seen):
+    """Returns why a method is not pure, None when it is.
+
+    A pure method reads no globals and calls only pure methods, so its
+    result depends on its arguments alone.
+    """
+    seen.add(method.name)
+    code = method.code
+    if code.globals:
+        return 'reads {}'.format(', '.join(sorted(code.globals)))
+    for name in sorted(code.calls):
+        callee = methods.get(name)
+        if callee is None:
+            return 'calls undefined {}'.format(name)
+        if name not in seen and impurity(callee, methods, seen) is not None:
+            return 'calls impure {}'.format(name)
+    return None
+
+
+def define(methods, node):
+    """Defines the method of a Def in the methods dict of an interpreter.
+
+    A new method may make impure ones (calling it while undefined) pure,
+    redefining one may change what any other computes.
+    """
+    redefined = node.name in methods
+    for method in methods.values():
+        if redefined or not method.pure:
+            method.forget()
+    methods[node.name] = Method(method_code(node))
+
+
+def lookup_method(methods, name):
+    method = methods.get(name)
+    if method is None:
+        raise NameError("undefined method '{}'".format(name))
+    return method
@@ -0,0 +1,207 @@
+from parser_ruby import *
+from compiler import BINARY_OPS
+from vm import BINARY_FUNCS, UNARY_FUNCS
+from rope import Rope
+
+FOLD_BINARY = dict(zip(BINARY_OPS, BINARY_FUNCS))
+FOLD_UNARY = {PLUS: UNARY_FUNCS[0], MINUS: UNARY_FUNCS[1]}
+
+#folded strings longer than this are left to be built at run time
+MAX_FOLDED_STR = 4096
+
+
+def make_num(value):
+    """Builds a Num node holding a constant value"""
+    return Num(Token(literal_type(value), value))
+
+
+class Optimizer(NodeVisitor):
+    """Rewrites the tree returned by Parser.parse() before it is run.
+
+    Constant BinOp/UnaryOp subtrees are folded into Num nodes, If/Else
+    arms with a constant condition are pruned and NoOps and While loops
+    whose condition is constant false are removed. An operation that
+    raises (like 1/0) is not folded so the error still happens at run
+    time.
+
+    Statements are visited with statements() which returns the list of
+    statements that replace them, expressions are visited with visit().
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    def statements(self, node):
+        if isinstance(node, NoOp):
+            return []
+        if isinstance(node, (If, While, For, Def)):
+            return getattr(self, 'optimize_' + type(node).__name__)(node)
+        return [self.visit(node)]
+
+    def block(self, nodes):
+        result = []
+        for node in nodes:
+            result.extend(self.statements(node))
+        return result
+
+    def fold(self, node):
+        """Folds a BinOp/UnaryOp tree bottom up with an explicit work stack.
+
+        Long operator chains and deeply nested parentheses are optimized
+        without reaching the python recursion limit, other nodes met on
+        the way are visited as usual.
+        """
+        results = []
+        work = [(node, False)]
+        while work:
+            item, expanded = work.pop()
+            if not isinstance(item, (BinOp, UnaryOp)):
+                results.append(self.visit(item))
+            elif not expanded:
+                work.append((item, True))
+                if isinstance(item, BinOp):
+                    work.append((item.right, False))
+                    work.append((item.left, False))
+                else:
+                    work.append((item.expr, False))
+            elif isinstance(item, BinOp):
+                right = results.pop()
+                results[-1] = self.fold_BinOp(item, results[-1], right)
+            else:
+                results[-1] = self.fold_UnaryOp(item, results[-1])
+        return results[0]
+
+    visit_BinOp = fold
+    visit_UnaryOp = fold
+
+    def fold_BinOp(self, node, left, right):
+        """Returns the replacement of a BinOp whose operands are optimized already"""
+        node.left = left
+        node.right = right
+        if isinstance(left, Num) and isinstance(right, Num):
+            try:
+                value = FOLD_BINARY[node.op.type](left.value, right.value)
+            except Exception:
+                return node
+            if isinstance(value, Rope):
+                #a folded + of strings is a Rope, Num nodes hold plain str
+                value = value.flatten()
+            if isinstance(value, str) and len(value) > MAX_FOLDED_STR:
+                return node
+            return copy_location(make_num(value), node)
+        return node
+
+    def fold_UnaryOp(self, node, expr):
+        """Returns the replacement of a UnaryOp whose operand is optimized already"""
+        node.expr = expr
+        if isinstance(expr, Num):
+            try:
+                return copy_location(make_num(FOLD_UNARY[node.op.type](expr.value)), node)
+            except Exception:
+                return node
+        return node
+
+    def visit_Num(self, node):
+        return node
+
+    def visit_Compound(self, node):
+        node.children = self.block(node.children)
+        return node
+
+    def visit_Assign(self, node):
+        node.right = self.visit(node.right)
+        return node
+
+    def visit_Var(self, node):
+        return node
+
+    def visit_ArrayLiteral(self, node):
+        node.items = [self.visit(item) for item in node.items]
+        return node
+
+    def visit_RangeLiteral(self, node):
+        node.first = self.visit(node.first)
+        node.last = self.visit(node.last)
+        return node
+
+    def visit_Call(self, node):
+        node.args = [self.visit(arg) for arg in node.args]
+        return node
+
+    def visit_Return(self, node):
+        node.value = self.visit(node.value)
+        return node
+
+    def visit_MethodCall(self, node):
+        node.receiver = self.visit(node.receiver)
+        if node.body is not None:
+            node.body = self.visit(node.body)
+        return node
+
+    def optimize_If(self, node):
+        node.condition = condition = self.visit(node.condition)
+        if isinstance(condition, Num):
+            if condition.value:
+                return self.block(node.body)
+            return self.rest(node.rest)
+        node.body = self.block(node.body)
+        rest = self.rest(node.rest)
+        if not rest:
+            node.rest = []
+        elif len(rest) == 1 and isinstance(rest[0], If):
+            node.rest = rest[0]
+        elif isinstance(node.rest, Else):
+            node.rest.body = rest
+        else:
+            node.rest = copy_location(Else(rest), rest[0])
+        return [node]
+
+    def rest(self, node):
+        """Returns the statements that replace the rest of an If"""
+        if isinstance(node, If):
+            return self.optimize_If(node)
+        if isinstance(node, Else):
+            return self.block(node.body)
+        return self.block(node)
+
+    def optimize_While(self, node):
+        node.condition = condition = self.visit(node.condition)
+        if isinstance(condition, Num) and not condition.value:
+            return []
+        node.body = self.block(node.body)
+        return [node]
+
+    def optimize_For(self, node):
+        node.iterable = self.visit(node.iterable)
+        node.body = self.block(node.body)
+        return [node]
+
+    def optimize_Def(self, node):
+        node.body = self.block(node.body)
+        return [node]
+
+    def optimize(self):
+        if self.tree is None:
+            return None
+        return self.visit(self.tree)
+
+
+def optimize(tree, dump=False):
+    """Optimizes tree, printing its node count before and after when dump is set"""
+    if dump:
+        before = count_nodes(tree)
+    tree = Optimizer(tree).optimize()
+    if dump:
+        print('Optimizer: {} nodes before, {} nodes after'.format(before, count_nodes(tree)))
+    return tree
+
+
+def optimize_statements(statements):
+    """Optimizes top level statements one at a time, yielding their replacements.
+
+    Used to optimize a program that is never held as a whole tree.
+    """
+    optimizer = Optimizer(None)
+    for node in statements:
+        for node in optimizer.statements(node):
+            yield node
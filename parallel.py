@@ -0,0 +1,347 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from parser_ruby import *
+from cache import encode, decode
+from runner import BACKENDS, with_bindings, _warm_worker
+from methods import method_code
+
+#a loop (While, For or a method block) multiplies the estimated cost of
+#the nodes inside it by this, its trip count being unknown
+LOOP_WEIGHT = 100
+#a method call counts this much, on top of its arguments
+CALL_COST = LOOP_WEIGHT
+#statements estimated to cost at least this run on the worker processes,
+#cheaper ones are not worth the round trip and run in the main process
+HEAVY_COST = 500
+
+
+def read_write_sets(node):
+    """Returns the (reads, writes) variable name sets of a statement.
+
+    Every Var that is not an assignment target is a read, every
+    assignment target (and loop variable of a For) a write, wherever they
+    are inside If/Else arms and loop bodies. Writes inside an arm or body
+    may not happen at all. A def writes and a call reads the name
+    method_key() gives the method, the variables a method body uses are
+    its own (see StatementGraph for the globals it reads).
+    """
+    reads = set()
+    writes = set()
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Assign):
+            writes.add(node.left.value)
+            stack.append(node.right)
+        elif isinstance(node, For):
+            writes.add(node.var.value)
+            stack.append(node.iterable)
+            stack.append(node.body)
+        elif isinstance(node, Def):
+            writes.add(method_key(node.name))
+        elif isinstance(node, Call):
+            reads.add(method_key(node.name))
+            stack.extend(node.args)
+        elif isinstance(node, Var):
+            reads.add(node.value)
+        else:
+            stack.extend(iter_child_nodes(node))
+    return reads, writes
+
+
+def method_key(name):
+    """Returns the pseudo variable name of a method, it cannot clash with a variable"""
+    return 'def ' + name
+
+
+def method_globals(definitions, name):
+    """Returns the globals read by method name and by the methods it calls, as method_keys too"""
+    names = set()
+    todo = [name]
+    seen = set()
+    while todo:
+        name = todo.pop()
+        if name in seen or name not in definitions:
+            continue
+        seen.add(name)
+        names.add(method_key(name))
+        code = method_code(definitions[name])
+        names.update(code.globals)
+        todo.extend(code.calls)
+    return names
+
+
+def nested_defs(statement):
+    """Tells whether a statement holds a Def other than itself"""
+    stack = list(iter_child_nodes(statement))
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Def):
+            return True
+        stack.extend(iter_child_nodes(node))
+    return False
+
+
+def estimate_cost(node):
+    """Returns the number of nodes of a statement, loop bodies and blocks weighted by LOOP_WEIGHT"""
+    cost = 0
+    stack = [(node, 1)]
+    while stack:
+        node, weight = stack.pop()
+        if not isinstance(node, list):
+            cost += weight
+        if isinstance(node, Call):
+            cost += weight * CALL_COST
+        if isinstance(node, (While, For)) or (isinstance(node, MethodCall) and node.body is not None):
+            weight *= LOOP_WEIGHT
+        stack.extend((child, weight) for child in iter_child_nodes(node))
+    return cost
+
+
+class StatementGraph(object):
+    """Dependency DAG of the top level statements of a tree.
+
+    Statement j depends on an earlier statement i when j reads a variable
+    i may write, writes one i reads or writes one i writes. Running every
+    statement after the ones it depends on, each on the variables left by
+    them, therefore gives the same variables as running them in order.
+    depends[j] and dependents[i] hold statement indices. A call reads
+    the globals of the method (and of the ones it calls) as defined by
+    the statements before it, definitions[j] are the Defs before j.
+    """
+
+    def __init__(self, statements, heavy_cost=HEAVY_COST):
+        self.statements = statements
+        self.reads = []
+        self.writes = []
+        self.costs = []
+        self.depends = []
+        self.dependents = [[] for _ in statements]
+        self.definitions = []
+        # name -> indices of the statements so far that read / write it
+        readers = {}
+        writers = {}
+        # method name -> its latest Def
+        defined = {}
+        defs = []
+        for index, statement in enumerate(statements):
+            self.definitions.append(defs)
+            reads, writes = read_write_sets(statement)
+            for name in list(reads):
+                if name.startswith('def '):
+                    reads.update(method_globals(defined, name[4:]))
+            if isinstance(statement, Def):
+                defined[statement.name] = statement
+                defs = defs + [statement]
+            depends = set()
+            for name in reads:
+                depends.update(writers.get(name, ()))
+            for name in writes:
+                depends.update(writers.get(name, ()))
+                depends.update(readers.get(name, ()))
+            # only the latest conflicting statements are needed, the
+            # earlier ones are ordered before them already
+            for name in reads:
+                readers.setdefault(name, []).append(index)
+            for name in writes:
+                writers[name] = [index]
+                readers[name] = []
+            self.reads.append(reads)
+            self.writes.append(writes)
+            self.costs.append(estimate_cost(statement))
+            self.depends.append(sorted(depends))
+            for other in depends:
+                self.dependents[other].append(index)
+        self.heavy = [cost >= heavy_cost for cost in self.costs]
+
+    def __len__(self):
+        return len(self.statements)
+
+    def edges(self):
+        return sum(len(depends) for depends in self.depends)
+
+    def critical_path(self, weights=None):
+        """Returns (length, statement indices) of the heaviest dependency chain.
+
+        weights default to the estimated costs.
+        """
+        if weights is None:
+            weights = self.costs
+        length = []
+        previous = []
+        for index, depends in enumerate(self.depends):
+            best = max(depends, key=lambda other: length[other], default=None)
+            previous.append(best)
+            length.append(weights[index] + (length[best] if best is not None else 0))
+        if not length:
+            return 0, []
+        index = max(range(len(length)), key=length.__getitem__)
+        total = length[index]
+        path = []
+        while index is not None:
+            path.append(index)
+            index = previous[index]
+        path.reverse()
+        return total, path
+
+    def label(self, index):
+        statement = self.statements[index]
+        if statement.line is None:
+            return '#{} {}'.format(index, type(statement).__name__)
+        return '#{} {}@{}:{}'.format(index, type(statement).__name__, statement.line, statement.column)
+
+    def report(self, timings=None, wall=None):
+        """Returns the critical path and the available parallelism as text.
+
+        With the measured seconds of every statement (and the wall time
+        of the whole run) they are reported next to the estimates.
+        """
+        lines = ['{} statements, {} heavy, {} dependencies'.format(len(self), sum(self.heavy), self.edges())]
+        rows = [('estimated cost', self.costs, '{:.0f}')]
+        if timings is not None:
+            rows.append(('measured seconds', timings, '{:.6f}'))
+        for title, weights, number in rows:
+            work = sum(weights)
+            length, path = self.critical_path(weights)
+            parallelism = work / length if length else 1.0
+            lines.append('{}: total work {}, critical path {}, parallelism {:.2f}'.format(
+                title, number.format(work), number.format(length), parallelism))
+            lines.append('  critical path: ' + ' -> '.join(self.label(index) for index in path))
+        if timings is not None and wall:
+            lines.append('wall time {:.6f}s, speedup over running in order {:.2f}'.format(wall, sum(timings) / wall))
+        return '\n'.join(lines)
+
+
+def statements_of(tree):
+    if tree is None:
+        return []
+    if isinstance(tree, Compound):
+        return list(tree.children)
+    return [tree]
+
+
+def execute_statement(statement, bindings, names, backend='vm', definitions=()):
+    """Runs one statement on bindings, after the Defs of definitions.
+
+    Returns (values of names after it, error or None, seconds), on error
+    the values are the ones the statement had set when it failed.
+    """
+    tree = Compound()
+    tree.children.extend(definitions)
+    tree.children.append(statement)
+    start = time.perf_counter()
+    inter = None
+    error = None
+    try:
+        inter = BACKENDS[backend](with_bindings(tree, bindings))
+        inter.interpret()
+    except Exception as e:
+        error = e
+    seconds = time.perf_counter() - start
+    memory = inter.GLOBAL_MEMORY if inter is not None else {}
+    return {name: memory[name] for name in names if name in memory}, error, seconds
+
+
+def execute_encoded(data, bindings, names, backend='vm'):
+    """execute_statement() of a Compound of the definitions and the statement
+    encoded by cache.encode(), runs on the workers"""
+    children = decode(data).children
+    return execute_statement(children[-1], bindings, names, backend, children[:-1])
+
+
+class ParallelExecutor(object):
+    """Runs the top level statements of a tree out of order on a process pool.
+
+    Statements run as soon as the ones they depend on (see
+    StatementGraph) are done, heavy ones on the worker processes and
+    cheap ones right away in this process. Each gets the current values
+    of the variables it reads or writes and only its writes are merged
+    back. The final variables are rebuilt by merging the writes in
+    program order, up to and including the first statement that failed,
+    so they and the error raised are the ones running the statements in
+    order gives, whatever order the workers finish in.
+    """
+
+    def __init__(self, tree, jobs=None, backend='vm', heavy_cost=HEAVY_COST):
+        statements = statements_of(tree)
+        if any(nested_defs(statement) for statement in statements):
+            # only top level defs are run ahead of the statements using
+            # them, a program defining methods elsewhere runs as a whole
+            statements = [tree]
+        self.graph = StatementGraph(statements, heavy_cost)
+        self.jobs = jobs or os.cpu_count() or 1
+        self.backend = backend
+        self.GLOBAL_MEMORY = {}
+        self.timings = [0.0] * len(self.graph)
+        self.wall = 0.0
+
+    def report(self):
+        return self.graph.report(self.timings, self.wall)
+
+    def interpret(self):
+        graph = self.graph
+        count = len(graph)
+        waiting = [len(depends) for depends in graph.depends]
+        ready = [index for index in range(count) if not waiting[index]]
+        results = [None] * count
+        # variables as left by the statements done so far
+        values = {}
+        failed = count
+        start = time.perf_counter()
+        executor = None
+        in_flight = {}
+        try:
+            while ready or in_flight:
+                ready.sort(reverse=True)
+                while ready:
+                    index = ready.pop()
+                    if index > failed:
+                        # cannot affect the result any more
+                        continue
+                    names = graph.reads[index] | graph.writes[index]
+                    bindings = {name: values[name] for name in names if name in values}
+                    if graph.heavy[index] and self.jobs > 1:
+                        if executor is None:
+                            executor = ProcessPoolExecutor(max_workers=self.jobs, initializer=_warm_worker)
+                        tree = Compound()
+                        tree.children = graph.definitions[index] + [graph.statements[index]]
+                        future = executor.submit(execute_encoded, encode(tree), bindings,
+                                                 graph.writes[index], self.backend)
+                        in_flight[future] = index
+                    else:
+                        results[index] = execute_statement(graph.statements[index], bindings,
+                                                           graph.writes[index], self.backend,
+                                                           graph.definitions[index])
+                        failed = self.done(index, results, values, waiting, ready, failed)
+                if in_flight:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        index = in_flight.pop(future)
+                        results[index] = future.result()
+                        failed = self.done(index, results, values, waiting, ready, failed)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+            self.wall = time.perf_counter() - start
+        memory = {}
+        for index in range(min(failed + 1, count)):
+            written, error, seconds = results[index]
+            memory.update(written)
+            self.timings[index] = seconds
+        self.GLOBAL_MEMORY = memory
+        if failed < count:
+            raise results[failed][1]
+
+    def done(self, index, results, values, waiting, ready, failed):
+        """Merges the writes of a finished statement and returns the index of the first failure"""
+        written, error, seconds = results[index]
+        values.update(written)
+        if error is not None:
+            return min(failed, index)
+        for other in self.graph.dependents[index]:
+            waiting[other] -= 1
+            if not waiting[other]:
+                ready.append(other)
+        return failed
@@ -1,72 +1,348 @@
 from lexer import *
 
 class AST(object):
-    pass
+    # 1-based source position, None for nodes not built from source
+    __slots__ = ('line', 'column')
+
+    def set_position(self, line, column):
+        """Sets the source position and returns self"""
+        self.line = line
+        self.column = column
+        return self
+
+
+def copy_location(new_node, old_node):
+    """Copies the source position of old_node to new_node and returns new_node"""
+    new_node.line = old_node.line
+    new_node.column = old_node.column
+    return new_node
+
+
+def literal_type(value):
+    """Returns the token type of a constant value"""
+    if value is True:
+        return TRUE
+    if value is False:
+        return FALSE
+    if isinstance(value, int):
+        return INTEGER
+    if isinstance(value, float):
+        return REAL
+    return STR
 
 
 class BinOp(AST):
+    # hits and deopts count the guarded runs of a SpecializingInterpreter
+    __slots__ = ('left', 'op', 'right', 'hits', 'deopts')
+
     def __init__(self, left, op, right):
         self.left = left
-        self.token = self.op = op
+        self.op = op
         self.right = right
+        self.line = self.column = None
+        self.hits = self.deopts = 0
+
+    @property
+    def token(self):
+        return self.op
 
 
 class Num(AST):
+    """Num node keeps the value of its token, the token is rebuilt on demand"""
+    __slots__ = ('value',)
+
     def __init__(self, token):
-        self.token = token
         self.value = token.value
+        self.line = token.line
+        self.column = token.column
+
+    @property
+    def token(self):
+        return Token(literal_type(self.value), self.value, self.line, self.column)
 
 
 class UnaryOp(AST):
+    __slots__ = ('op', 'expr')
+
     def __init__(self, op, expr):
-        self.token = self.op = op
+        self.op = op
         self.expr = expr
+        self.line = self.column = None
+
+    @property
+    def token(self):
+        return self.op
 
 
 class Compound(AST):
+    __slots__ = ('children',)
+
     def __init__(self):
         self.children = []
+        self.line = self.column = None
 
 
 class Assign(AST):
+    __slots__ = ('left', 'op', 'right')
+
     def __init__(self, left, op, right):
         self.left = left
-        self.token = self.op = op
+        self.op = op
         self.right = right
+        copy_location(self, left)
+
+    @property
+    def token(self):
+        return self.op
 
 class Var(AST):
-    """Var node is constructed from ID token"""
+    """Var node is constructed from ID token, slot is set by the Resolver"""
+    __slots__ = ('value', 'slot')
+
     def __init__(self,token):
-        self.token=token
         self.value=token.value
+        self.line=token.line
+        self.column=token.column
+
+    @property
+    def token(self):
+        return Token(ID, self.value, self.line, self.column)
 
 class If(AST):
+    __slots__ = ('condition', 'body', 'rest')
+
     def __init__(self, condition, body, rest):
         self.condition = condition
         self.body = body
         self.rest = rest
+        self.line = self.column = None
 
 class Else(AST):
+    __slots__ = ('body',)
+
     def __init__(self, body):
         self.body=body
+        self.line = self.column = None
 
 
 class While(AST):
+    """while condition ... end, plan caches the analysis of the loop, see loops.loop_plan()"""
+    __slots__ = ('condition', 'body', 'plan')
+
     def __init__(self, condition, body):
         self.condition = condition
         self.body = body
+        self.plan = None
+        self.line = self.column = None
 
 class NoOp(AST):
-    pass
+    __slots__ = ()
+
+    def __init__(self):
+        self.line = self.column = None
+
+
+class ArrayLiteral(AST):
+    __slots__ = ('items',)
+
+    def __init__(self, items):
+        self.items = items
+        self.line = self.column = None
+
+
+class RangeLiteral(AST):
+    """first..last, or first...last without last"""
+    __slots__ = ('first', 'last', 'exclusive')
+
+    def __init__(self, first, last, exclusive):
+        self.first = first
+        self.last = last
+        self.exclusive = exclusive
+        self.line = self.column = None
+
+
+class MethodCall(AST):
+    """receiver.name, or receiver.name { |param| body } with an expression body.
+
+    native caches the body compiled to a python function, see
+    transpiler.NativeBlock.
+    """
+    __slots__ = ('receiver', 'name', 'param', 'body', 'native')
+
+    def __init__(self, receiver, name, param=None, body=None):
+        self.receiver = receiver
+        self.name = name
+        self.param = param
+        self.body = body
+        self.native = None
+        self.line = self.column = None
+
+
+class For(AST):
+    """for var in iterable ... end, receiver.each { |var| ... } is the same loop"""
+    __slots__ = ('var', 'iterable', 'body')
+
+    def __init__(self, var, iterable, body):
+        self.var = var
+        self.iterable = iterable
+        self.body = body
+        self.line = self.column = None
+
+
+class Def(AST):
+    """def name(params) body end, memoize def ... opts in to memoization.
+
+    The last statement of body returns its value, see returning().
+    code caches the analysis of the method, see methods.method_code().
+    """
+    __slots__ = ('name', 'params', 'body', 'memoize', 'code')
+
+    def __init__(self, name, params, body, memoize=False):
+        self.name = name
+        self.params = params
+        self.body = body
+        self.memoize = memoize
+        self.code = None
+        self.line = self.column = None
+
+
+class Call(AST):
+    """name(args), a call of a method defined by a Def.
+
+    tail is set for the value of a Return, which runs as a tail call.
+    statement is set when the value is not used, so the method may end
+    without one.
+    """
+    __slots__ = ('name', 'args', 'tail', 'statement')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.tail = False
+        self.statement = False
+        self.line = self.column = None
+
+
+class Return(AST):
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+        self.line = self.column = None
+
+
+def returning(statements):
+    """Makes the last statement of a method body return its value.
+
+    An expression becomes a Return of it, an Assign is followed by a
+    Return of its variable and the arms of an If are made returning in
+    turn. A method ending any other way returns no value.
+    """
+    if not statements:
+        return statements
+    last = statements[-1]
+    if isinstance(last, Assign):
+        statements.append(copy_location(Return(Var(last.left.token)), last))
+    elif isinstance(last, If):
+        returning_if(last)
+    elif not isinstance(last, (While, For, Return, Def, NoOp)):
+        statements[-1] = copy_location(Return(last), last)
+    return statements
+
+
+def returning_if(node):
+    returning(node.body)
+    rest = node.rest
+    if isinstance(rest, If):
+        returning_if(rest)
+    elif isinstance(rest, Else):
+        returning(rest.body)
+    else:
+        returning(rest)
+
+
+def iter_child_nodes(node):
+    """Yields the direct children of an AST node or a statement list"""
+    if isinstance(node, list):
+        for child in node:
+            yield child
+    elif isinstance(node, (BinOp, Assign)):
+        yield node.left
+        yield node.right
+    elif isinstance(node, UnaryOp):
+        yield node.expr
+    elif isinstance(node, Compound):
+        for child in node.children:
+            yield child
+    elif isinstance(node, If):
+        yield node.condition
+        yield node.body
+        yield node.rest
+    elif isinstance(node, While):
+        yield node.condition
+        yield node.body
+    elif isinstance(node, Else):
+        yield node.body
+    elif isinstance(node, ArrayLiteral):
+        for item in node.items:
+            yield item
+    elif isinstance(node, RangeLiteral):
+        yield node.first
+        yield node.last
+    elif isinstance(node, MethodCall):
+        yield node.receiver
+        if node.body is not None:
+            yield node.body
+    elif isinstance(node, For):
+        yield node.var
+        yield node.iterable
+        yield node.body
+    elif isinstance(node, Def):
+        yield node.body
+    elif isinstance(node, Call):
+        for arg in node.args:
+            yield arg
+    elif isinstance(node, Return):
+        yield node.value
+
+
+def count_nodes(node):
+    """Returns the number of AST nodes in a tree, statement lists are not counted"""
+    count = 0
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if not isinstance(node, list):
+            count += 1
+        stack.extend(iter_child_nodes(node))
+    return count
+
+#binding power of the binary operators, all of them are left associative
+BINARY_PRECEDENCE = {
+    PLUS: 1, MINUS: 1,
+    MUL: 2, DIV: 2, MOD: 2, EQUAL: 2, NOT: 2, LEST: 2, GRET: 2, LESE: 2, GRE: 2,
+    #ranges bind loosest and build a RangeLiteral instead of a BinOp
+    DOTDOT: 0.5, DOTDOTDOT: 0.5,
+}
+#operator stack entries of Parser.expr() that are not binary operators
+PAREN_ENTRY = 0
+UNARY_ENTRY = -1
+
 
 class Parser(object):
     def __init__(self,lexer):
         self.lexer=lexer
         #set current token to the first token taken from the input
         self.current_token=self.lexer.get_next_token()
+        # number of defs being parsed, return is only allowed inside one
+        self.method_depth = 0
 
     def error(self):
         raise Exception('invalid syntax')
+
+    def position(self):
+        """Returns the (line, column) of the current token"""
+        return self.lexer.token_line, self.lexer.token_column
     
     def eat(self,token_type):
         """Compares the current token type with the passed token type"""
@@ -88,6 +364,8 @@ class Parser(object):
         root=Compound()
         for node in nodes:
             root.children.append(node)
+        if nodes:
+            copy_location(root, nodes[0])
         return root
 
     def statement_list(self):
@@ -100,9 +378,19 @@ class Parser(object):
 
         return results
 
+    def statements(self):
+        """Yields the top level statements one at a time as they are parsed.
+
+        Same grammar as statement_list, used to run a script while it is
+        still being read instead of building its Compound first.
+        """
+        yield self.statement()
+        while self.current_token.type != EOF:
+            yield self.statement()
+
     def statement(self):
         """
-        statement : compound_statement | assignment_statement | if_statement | elsif_statement| else statement | while statement| empty
+        statement : compound_statement | assignment_statement | if_statement | elsif_statement| else statement | while statement| for_statement | def_statement | return_statement | expr | empty
         
         """
         if self.current_token.type==ID:
@@ -115,14 +403,32 @@ class Parser(object):
             node=self.else_statement()
         elif self.current_token.type==WHILE:
             node=self.while_statement()
+        elif self.current_token.type==FOR:
+            node=self.for_statement()
+        elif self.current_token.type==DEF:
+            node=self.def_statement()
+        elif self.current_token.type==RETURN:
+            node=self.return_statement()
         else:
-            node=self.conditional_statement()
+            node=self.expr(statement=True)
+        if type(node) is Call:
+            node.statement = True
         return node
 
     def assignment_statement(self):
-        """assignment_statement : variable ASSIGN expr"""
+        """assignment_statement : variable ASSIGN expr
+
+        A statement starting with a variable that is not assigned to is
+        an expression, like a.each { |x| ... }.
+        """
         left = self.variable()
         token = self.current_token
+        if token.type == DEF and left.value == 'memoize':
+            return self.def_statement(True)
+        if token.type == LPAREN and self.position()[0] == left.line:
+            return self.expr(self.call(left), statement=True)
+        if token.type != ASSIGN:
+            return self.expr(left, statement=True)
         self.eat(ASSIGN)
         right = self.expr()
         node = Assign(left, token, right)
@@ -130,27 +436,17 @@ class Parser(object):
 
     def if_statement(self):
         """
-        if_statement : IF conditional_statement  statement_list  (elsif_statement | else_statement | empty) END
+        if_statement : IF conditional_statement statement_list (elsif_statement | else_statement | END)
 
         """
-        self.eat(IF)
-        condition = self.conditional_statement()
-        body=[]
-        rest=[]
-        while self.current_token.type!=ELSIF and self.current_token.type!=ELSE and self.current_token.type!=END:
-            body.append(self.statement())
-        if self.current_token.type==ELSIF:
-            rest = self.elsif_statement()
-        if self.current_token.type==ELSE:
-            rest = self.else_statement()
-        node = If(condition, body, rest)
-        return node
+        return self.conditional_chain(IF)
 
     def while_statement(self):
         """
         while_statement : WHILE conditional_statement statement_list END
 
         """
+        line, column=self.position()
         self.eat(WHILE)
         condition=self.conditional_statement()
         body=[]
@@ -158,8 +454,82 @@ class Parser(object):
             body.append(self.statement())
         self.eat(END)
         node=While(condition,body)
-        return node
+        return node.set_position(line, column)
     
+    def for_statement(self):
+        """
+        for_statement : FOR variable IN expr (DO)? statement_list END
+
+        """
+        line, column=self.position()
+        self.eat(FOR)
+        var=self.variable()
+        self.eat(IN)
+        iterable=self.expr()
+        if self.current_token.type==DO:
+            self.eat(DO)
+        body=[]
+        while self.current_token.type!=END:
+            body.append(self.statement())
+        self.eat(END)
+        return For(var, iterable, body).set_position(line, column)
+
+    def def_statement(self, memoize=False):
+        """
+        def_statement : (memoize)? DEF ID (LPAREN (ID (COMMA ID)*)? RPAREN)? statement_list END
+
+        """
+        line, column = self.position()
+        self.eat(DEF)
+        name = self.current_token.value
+        self.eat(ID)
+        params = []
+        if self.current_token.type == LPAREN:
+            self.eat(LPAREN)
+            if self.current_token.type != RPAREN:
+                params.append(self.variable().value)
+                while self.current_token.type == COMMA:
+                    self.eat(COMMA)
+                    params.append(self.variable().value)
+            self.eat(RPAREN)
+        if len(set(params)) != len(params):
+            self.error()
+        self.method_depth += 1
+        body = []
+        while self.current_token.type != END:
+            body.append(self.statement())
+        self.method_depth -= 1
+        self.eat(END)
+        return Def(name, params, returning(body), memoize).set_position(line, column)
+
+    def return_statement(self):
+        """
+        return_statement : RETURN expr
+
+        """
+        if not self.method_depth:
+            self.error()
+        line, column = self.position()
+        self.eat(RETURN)
+        return Return(self.expr()).set_position(line, column)
+
+    def call(self, var):
+        """
+        call : ID LPAREN (expr (COMMA expr)*)? RPAREN
+
+        var is the already parsed name. The parenthesis must be on the
+        line of the name, so a statement can start with one.
+        """
+        self.eat(LPAREN)
+        args = []
+        if self.current_token.type != RPAREN:
+            args.append(self.expr())
+            while self.current_token.type == COMMA:
+                self.eat(COMMA)
+                args.append(self.expr())
+        self.eat(RPAREN)
+        return Call(var.value, args).set_position(var.line, var.column)
+
     def variable(self):
         """
         variable : ID
@@ -175,28 +545,48 @@ class Parser(object):
 
     def elsif_statement(self):
         """
-        elsif_statement : ELSIF conditional_statement statement_list (else | empty)
+        elsif_statement : ELSIF conditional_statement statement_list (elsif_statement | else_statement | END)
+        """
+        return self.conditional_chain(ELSIF)
+
+    def conditional_chain(self, token_type):
+        """Parses an if or elsif arm and every elsif arm after it.
+
+        The arms are collected in a loop and then nested from the last one
+        outwards, so a long elsif ladder does not recurse in the parser.
         """
-        self.eat(ELSIF)
-        elsif_condition=self.conditional_statement()
-        elseif_body=[]
-        rest=[]
-        while self.current_token.type!=ELSE:
-            elseif_body.append(self.statement())
+        position=self.position()
+        self.eat(token_type)
+        arms=[]
+        while True:
+            condition=self.conditional_statement()
+            body=[]
+            while self.current_token.type not in (ELSIF, ELSE, END):
+                body.append(self.statement())
+            arms.append((position, condition, body))
+            if self.current_token.type!=ELSIF:
+                break
+            position=self.position()
+            self.eat(ELSIF)
         if self.current_token.type==ELSE:
             rest=self.else_statement()
-        node=If(elsif_condition, elseif_body,rest)
-        return node
+        else:
+            self.eat(END)
+            rest=[]
+        for position, condition, body in reversed(arms):
+            rest=If(condition, body, rest).set_position(*position)
+        return rest
 
     def else_statement(self):
         """else_statement : ELSE statement_list """
+        line, column = self.position()
         self.eat(ELSE)
         else_body=[]
         while self.current_token.type!=END:
             else_body.append(self.statement())
         self.eat(END)
         node = Else(else_body)
-        return node
+        return node.set_position(line, column)
 
     def conditional_statement(self):
         """conditional_statement : expr (EQUAL|GRE|NOT|GRET|LESE|LEST) expr"""
@@ -207,106 +597,204 @@ class Parser(object):
             node=BinOp(node,token,self.expr())
         return node
 
-    def expr(self):
+    def expr(self, first=None, statement=False):
         """
-        expr : term ((PLUS | MINUS) term)*
+        expr : range ((DOTDOT | DOTDOTDOT) range)*
+        range : term ((PLUS | MINUS) term)*
+        term : factor ((MUL | DIV | MOD | EQUAL | NOT | LEST | GRET | LESE | GRE) factor)*
+        factor : PLUS factor
+                  | MINUS factor
+                  | primary (DOT method)*
+        primary : INTEGER
+                  | REAL
+                  | STR
+                  | LPAREN expr RPAREN
+                  | array
+                  | call
+                  | variable
+
+        Parsed by precedence climbing over an explicit operator stack, so
+        neither deeply nested parentheses nor long operator chains recurse.
+        The trees are the same as those of the recursive grammar above.
+        first is an already parsed variable the expression starts with.
+        With statement set the expression may be a whole .each loop.
         """
-        node = self.term()
-        while self.current_token.type in (PLUS, MINUS):
+        operands = []
+        operators = []
+        depth = 0
+        while True:
+            if first is not None:
+                operands.append(first)
+                first = None
+            else:
+                #prefix operators and opening parentheses of the next factor
+                while True:
+                    token = self.current_token
+                    if token.type == PLUS or token.type == MINUS:
+                        operators.append((UNARY_ENTRY, token, self.position()))
+                        self.eat(token.type)
+                    elif token.type == LPAREN:
+                        self.eat(LPAREN)
+                        operators.append((PAREN_ENTRY, token, None))
+                        depth += 1
+                    else:
+                        break
+                if token.type == INTEGER or token.type == REAL or token.type == STR:
+                    self.eat(token.type)
+                    operands.append(Num(token))
+                elif token.type == ID:
+                    self.eat(ID)
+                    if self.current_token.type == LPAREN and self.position()[0] == token.line:
+                        operands.append(self.call(Var(token)))
+                    else:
+                        operands.append(Var(token))
+                elif token.type == LBRACKET:
+                    operands.append(self.array())
+                else:
+                    operands.append(self.variable())
+            #a complete primary: parse its method calls, apply its prefix
+            #operators, then close parentheses
+            while True:
+                operands[-1] = self.methods(operands[-1], statement and not operators)
+                if type(operands[-1]) is For:
+                    # the loop is the whole statement
+                    if BINARY_PRECEDENCE.get(self.current_token.type) is not None:
+                        self.error()
+                    return operands[-1]
+                while operators and operators[-1][0] == UNARY_ENTRY:
+                    _, token, position = operators.pop()
+                    operands[-1] = UnaryOp(token, operands[-1]).set_position(*position)
+                if depth and self.current_token.type == RPAREN:
+                    self.reduce(operators, operands, 0)
+                    operators.pop()
+                    depth -= 1
+                    self.eat(RPAREN)
+                else:
+                    break
             token = self.current_token
-            if token.type == PLUS:
-                self.eat(PLUS)
-            elif token.type == MINUS:
-                self.eat(MINUS)
+            precedence = BINARY_PRECEDENCE.get(token.type)
+            if precedence is None:
+                break
+            self.reduce(operators, operands, precedence)
+            operators.append((precedence, token, self.position()))
+            self.eat(token.type)
+        if depth:
+            self.eat(RPAREN)
+        self.reduce(operators, operands, 0)
+        return operands[0]
 
-            node = BinOp(node,token,self.term())
-        return node
+    def reduce(self, operators, operands, precedence):
+        """Builds BinOps from the stacked operators binding at least as tight as precedence.
 
-    def term(self):
-        """term : factor ((MUL | DIV | MOD | EQUAL | NOT | LEST | GRET | LESE | GRE) factor)*"""
-        node = self.factor()
-        while self.current_token.type in (MUL,DIV, MOD,EQUAL,NOT,LEST,GRET,LESE,GRE):
-            token = self.current_token
-            if token.type == MUL:
-                self.eat(MUL)
-            elif token.type == DIV:
-                self.eat(DIV)
-            elif token.type == MOD:
-                self.eat(MOD)
-            elif token.type == EQUAL:
-                self.eat(EQUAL)
-            elif token.type == NOT:
-                self.eat(NOT)
-            elif token.type == LEST:
-                self.eat(LEST)
-            elif token.type == GRET:
-                self.eat(GRET)
-            elif token.type == LESE:
-                self.eat(LESE)
-            elif token.type == GRE:
-                self.eat(GRE)
-            node = BinOp(node,token,self.factor())
+        Operator stack entries are (precedence, token, (line, column)).
+        Range operators build RangeLiterals.
+        """
+        while operators and operators[-1][0] >= precedence and operators[-1][0] > 0:
+            _, token, position = operators.pop()
+            right = operands.pop()
+            if token.type == DOTDOT or token.type == DOTDOTDOT:
+                operands[-1] = RangeLiteral(operands[-1], right, token.type == DOTDOTDOT).set_position(*position)
+            else:
+                operands[-1] = BinOp(operands[-1], token, right).set_position(*position)
+
+    def methods(self, node, each=False):
+        """
+        methods : (DOT ID block?)*
 
+        Method calls on node. .each takes a statement block and makes the
+        For loop of node, allowed only when each is set; other methods
+        take an optional expression block in braces.
+        """
+        while self.current_token.type == DOT:
+            self.eat(DOT)
+            line, column = self.position()
+            name = self.current_token.value
+            self.eat(ID)
+            if name == 'each':
+                if not each:
+                    self.error()
+                var, body = self.block(True)
+                return For(var, node, body).set_position(line, column)
+            param = body = None
+            if self.current_token.type == LBRACE:
+                var, body = self.block()
+                param = var.value
+            node = MethodCall(node, name, param, body).set_position(line, column)
         return node
 
-    def factor(self):
-        """factor : PLUS factor
-                  | MINUS factor
-                  | INTEGER
-                  | REAL
-                  | LPAREN expr RPAREN
-                  | variable
+    def block(self, statements=False):
         """
-        token = self.current_token
-        if token.type == INTEGER:
-            self.eat(INTEGER)
-            return Num(token)
-        elif token.type == REAL:
-            self.eat(REAL)
-            return Num(token)
-        elif token.type == PLUS:
-            self.eat(PLUS)
-            node = UnaryOp(token, self.factor())
-            return node
-        elif token.type == MINUS:
-            self.eat(MINUS)
-            node = UnaryOp(token, self.factor())
-            return node
-        elif token.type == LPAREN:
-            self.eat(LPAREN)
-            node = self.expr()
-            self.eat(RPAREN)
-            return node
-        elif token.type == ID:
-            self.eat(ID)
-            return Var(token)
-        elif token.type == STR:
-            self.eat(STR)
-            return Num(token)
+        block : LBRACE PIPE variable PIPE expr RBRACE
+              | (LBRACE | DO) PIPE variable PIPE statement_list (RBRACE | END)
+
+        Returns (variable, body), the body is a statement list when
+        statements is set and an expression otherwise. do ... end blocks
+        only hold statements, so that for x in a do is never a block.
+        """
+        if self.current_token.type == DO and statements:
+            self.eat(DO)
+            closer = END
+        else:
+            self.eat(LBRACE)
+            closer = RBRACE
+        self.eat(PIPE)
+        var = self.variable()
+        self.eat(PIPE)
+        if not statements:
+            body = self.expr()
         else:
-            node = self.variable()
-            return node
+            body = []
+            while self.current_token.type != closer:
+                body.append(self.statement())
+        self.eat(closer)
+        return var, body
+
+    def array(self):
+        """
+        array : LBRACKET (expr (COMMA expr)*)? RBRACKET
+        """
+        line, column = self.position()
+        self.eat(LBRACKET)
+        items = []
+        if self.current_token.type != RBRACKET:
+            items.append(self.expr())
+            while self.current_token.type == COMMA:
+                self.eat(COMMA)
+                items.append(self.expr())
+        self.eat(RBRACKET)
+        return ArrayLiteral(items).set_position(line, column)
 
     def parse(self):
         """
         program : compound_statement
         compound_statement : statement_list
         statement_list : statement | statement SEMI statement_list
-        statement : compound_statement | assignment_statement |  if_statement | elsif_statement| else statement | while statement| empty
+        statement : compound_statement | assignment_statement |  if_statement | elsif_statement| else statement | while statement| for_statement | def_statement | return_statement | expr | empty
         assignment_statement : variable ASSIGN expr
-        if_statement : IF conditional_statement  statement_list  (elsif_statement | else_statement | empty) END
-        elsif_statement : ELSIF conditional_statement statement_list (else | empty)
+        if_statement : IF conditional_statement statement_list (elsif_statement | else_statement | END)
+        elsif_statement : ELSIF conditional_statement statement_list (elsif_statement | else_statement | END)
         else_statement : ELSE statement_list
         while_statement : WHILE conditional_statement statement_list END
+        for_statement : FOR variable IN expr (DO)? statement_list END
+                  | primary methods DOT each block
+        def_statement : (memoize)? DEF ID (LPAREN (ID (COMMA ID)*)? RPAREN)? statement_list END
+        return_statement : RETURN expr
         conditional_statement : expr (EQUAL|GRE|NOT|GRET|LESE|LEST) expr
-        expr : term ((PLUS | MINUS) term)*
+        expr : range ((DOTDOT | DOTDOTDOT) range)*
+        range : term ((PLUS | MINUS) term)*
         term : factor ((MUL | DIV | MOD | EQUAL | NOT | LEST | GRET | LESE | GRE) factor)*
         factor : PLUS factor
                   | MINUS factor
-                  | INTEGER
+                  | primary methods
+        primary : INTEGER
                   | REAL
                   | LPAREN expr RPAREN
+                  | array
+                  | call
                   | variable
+        call : ID LPAREN (expr (COMMA expr)*)? RPAREN
+        methods : (DOT ID block?)*
+        array : LBRACKET (expr (COMMA expr)*)? RBRACKET
         variable : ID
 
         """
@@ -323,4 +811,9 @@ class NodeVisitor(object):
         return visitor(node)
 
     def generic_visit(self, node):
+        #subclasses of a node class are visited like their base class
+        for cls in type(node).__mro__[1:]:
+            visitor = getattr(self, 'visit_' + cls.__name__, None)
+            if visitor is not None:
+                return visitor(node)
         raise Exception('No visit_{} method'.format(type(node).__name__))
\ No newline at end of file
@@ -0,0 +1,146 @@
+import time
+
+from interpreter import *
+
+
+class NodeStats(object):
+    """Execution counters of one AST node"""
+
+    def __init__(self, node):
+        self.node = node
+        self.count = 0
+        # seconds spent in the node including its children, counted at its
+        # outermost activation only so recursion does not count them twice
+        self.total = 0.0
+        # seconds spent in the node itself
+        self.self_time = 0.0
+        # part of total not already counted by an enclosing node on the same line
+        self.line_total = 0.0
+        # activations of the node on the visit stack
+        self.active = 0
+
+    @property
+    def label(self):
+        return node_label(self.node)
+
+
+class LineStats(object):
+    """Execution counters of one source line"""
+
+    def __init__(self, line):
+        self.line = line
+        self.count = 0
+        self.total = 0.0
+        self.self_time = 0.0
+
+
+def node_label(node):
+    if node.line is None:
+        return type(node).__name__
+    return '{}@{}:{}'.format(type(node).__name__, node.line, node.column)
+
+
+class ProfilingInterpreter(Interpreter):
+    """Interpreter that records how often every node runs and for how long.
+
+    All the bookkeeping lives in this subclass, so the plain Interpreter
+    pays nothing for profiling being available. Collapsed stacks are
+    keyed by nested (parent key, node) tuples and only turned into text
+    when they are written out.
+    """
+
+    def __init__(self, tree, clock=time.perf_counter):
+        Interpreter.__init__(self, tree)
+        self.clock = clock
+        self.stats = {}
+        self.stacks = {}
+        self._stack_key = None
+        self._child_time = [0.0]
+        self._line = None
+        # line -> activations of its nodes on the visit stack
+        self._line_active = {}
+
+    def visit(self, node):
+        if isinstance(node, list):
+            return NodeVisitor.visit(self, node)
+        stats = self.stats.get(id(node))
+        if stats is None:
+            stats = self.stats[id(node)] = NodeStats(node)
+        parent_key = self._stack_key
+        parent_line = self._line
+        key = self._stack_key = (parent_key, node)
+        line = self._line = node.line
+        line_active = self._line_active
+        line_active[line] = line_active.get(line, 0) + 1
+        stats.active += 1
+        child_time = self._child_time
+        child_time.append(0.0)
+        start = self.clock()
+        try:
+            return NodeVisitor.visit(self, node)
+        finally:
+            elapsed = self.clock() - start
+            children = child_time.pop()
+            child_time[-1] += elapsed
+            self._stack_key = parent_key
+            self._line = parent_line
+            stats.active -= 1
+            line_active[line] -= 1
+            stats.count += 1
+            if not stats.active:
+                stats.total += elapsed
+            stats.self_time += elapsed - children
+            if not line_active[line]:
+                stats.line_total += elapsed
+            self.stacks[key] = self.stacks.get(key, 0.0) + elapsed - children
+
+    def hot_nodes(self, limit=None):
+        """Returns the NodeStats sorted by self time, hottest first"""
+        nodes = sorted(self.stats.values(), key=lambda s: s.self_time, reverse=True)
+        return nodes if limit is None else nodes[:limit]
+
+    def hot_lines(self, limit=None):
+        """Returns the LineStats sorted by self time, hottest first"""
+        lines = {}
+        for stats in self.stats.values():
+            line = lines.get(stats.node.line)
+            if line is None:
+                line = lines[stats.node.line] = LineStats(stats.node.line)
+            line.count = max(line.count, stats.count)
+            line.total += stats.line_total
+            line.self_time += stats.self_time
+        result = sorted(lines.values(), key=lambda s: s.self_time, reverse=True)
+        return result if limit is None else result[:limit]
+
+    def report(self, limit=20):
+        """Returns the hot line and hot node tables as text"""
+        out = ['{:>6} {:>10} {:>12} {:>12}'.format('line', 'count', 'total ms', 'self ms')]
+        for stats in self.hot_lines(limit):
+            out.append('{:>6} {:>10} {:>12.3f} {:>12.3f}'.format(
+                '?' if stats.line is None else stats.line, stats.count, stats.total * 1e3, stats.self_time * 1e3))
+        out.append('')
+        out.append('{:<24} {:>10} {:>12} {:>12}'.format('node', 'count', 'total ms', 'self ms'))
+        for stats in self.hot_nodes(limit):
+            out.append('{:<24} {:>10} {:>12.3f} {:>12.3f}'.format(
+                stats.label, stats.count, stats.total * 1e3, stats.self_time * 1e3))
+        return '\n'.join(out)
+
+    def collapsed_stacks(self):
+        """Yields 'frame;frame;frame microseconds' lines for flamegraph tools"""
+        merged = {}
+        for key, seconds in self.stacks.items():
+            frames = []
+            while key is not None:
+                key, node = key
+                frames.append(node_label(node))
+            path = ';'.join(reversed(frames))
+            merged[path] = merged.get(path, 0.0) + seconds
+        for path in sorted(merged):
+            micros = int(round(merged[path] * 1e6))
+            if micros:
+                yield '{} {}'.format(path, micros)
+
+    def write_collapsed(self, path):
+        with open(path, 'w') as file:
+            for line in self.collapsed_stacks():
+                file.write(line + '\n')
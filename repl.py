@@ -0,0 +1,332 @@
+import hashlib
+import shlex
+import sys
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+from lexer import *
+from parser_ruby import *
+from optimizer import optimize_statements
+from rope import flatten_memory
+from collection import to_python
+from runner import STREAM_BACKENDS
+
+PROMPT = '>> '
+#shown while the input is inside an unfinished statement or block
+CONTINUATION_PROMPT = '.. '
+#most statement trees kept by text hash, the least recently used go first
+MAX_PARSED_CHUNKS = 100000
+
+HELP = """\
+Statements run as they are entered; if/while/for/def blocks run at their end.
+:load PATH   run a script, parsing only the statements changed since its last load
+:reload      load the last script again
+:vars        print the variables
+:reset       forget the variables and methods
+:quit        leave (so does end of input)"""
+
+
+class Incomplete(Exception):
+    """The input ends inside a statement, more lines are needed"""
+
+
+def text_key(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+
+def common_prefix(a, b):
+    """Returns the length of the longest common prefix of two strings.
+
+    Only the slices past the part known to match are compared, halving
+    every time, so each string is read about twice at memcmp speed.
+    """
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[low:middle] == b[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def common_suffix(a, b, limit):
+    """Returns the length, at most limit, of the longest common suffix of two strings"""
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[len(a) - middle:len(a) - low] == b[len(b) - middle:len(b) - low]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+class Script(object):
+    """A loaded file split into the chunks of its top level statements.
+
+    starts[i] is the offset of chunk i, which runs to the next one: the
+    text of a statement and the blanks and comments after it. chunks[i]
+    is the (text hash, statements after optimizing) pair of chunk i.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.text = ''
+        self.starts = []
+        self.chunks = []
+
+    def update(self, text, parse):
+        """Splits the new text of the script into chunks and returns how many were parsed.
+
+        Chunks before the first changed character are kept, except the
+        last two: the statement of the chunk holding the change and the
+        one before it may now end elsewhere. Parsing goes on from there
+        until a statement ends where an old chunk started, inside the
+        unchanged end of the text; from there on the old chunks are kept,
+        moved by the change in length. parse(text, start) returns the
+        (key, nodes, end) of the statement at start.
+        """
+        old = self.text
+        if text == old:
+            return 0
+        prefix = common_prefix(old, text)
+        suffix = common_suffix(old, text, min(len(old), len(text)) - prefix)
+        moved = len(text) - len(old)
+        # text from here on is the same as the end of the old text
+        unchanged = len(text) - suffix
+        first = max(bisect_right(self.starts, prefix) - 2, 0)
+        starts = self.starts[:first]
+        chunks = self.chunks[:first]
+        start = self.starts[first] if first < len(self.starts) else 0
+        parsed = 0
+        while start < len(text):
+            if start >= unchanged:
+                index = bisect_left(self.starts, start - moved)
+                if index < len(self.starts) and self.starts[index] == start - moved:
+                    starts.extend(offset + moved for offset in self.starts[index:])
+                    chunks.extend(self.chunks[index:])
+                    break
+            key, nodes, end = parse(text, start)
+            if key is None:
+                break
+            starts.append(start)
+            chunks.append((key, nodes))
+            parsed += 1
+            start = end
+        self.text = text
+        self.starts = starts
+        self.chunks = chunks
+        return parsed
+
+    def statements(self):
+        return [node for key, nodes in self.chunks for node in nodes]
+
+
+class Session(object):
+    """One interpreter state fed with statements as they are entered and scripts as they are loaded.
+
+    Every top level statement is parsed on its own, its node positions
+    counting from its first token, and its optimized statements are kept
+    by the hash of its text: the same text, entered again or unchanged in
+    a reloaded script, runs on the same nodes without being parsed again.
+    """
+
+    def __init__(self, backend='tree', optimized=True):
+        self.backend = backend
+        self.optimized = optimized
+        self.inter = STREAM_BACKENDS[backend](None)
+        # text hash -> statements, see parse()
+        self.parsed = OrderedDict()
+        # path -> Script
+        self.scripts = {}
+        self.last_path = None
+
+    @property
+    def GLOBAL_MEMORY(self):
+        return self.inter.GLOBAL_MEMORY
+
+    def reset(self):
+        """Starts over with no variables and no methods, the parsed statements are kept"""
+        self.inter = STREAM_BACKENDS[self.backend](None)
+
+    def parse(self, text, start):
+        """Parses the top level statement at offset start of text.
+
+        Returns (key, nodes, end): the hash of its chunk, its statements
+        after optimizing and the offset of the next statement. key is None
+        when only blanks and comments are left. Raises Incomplete when
+        the text ends inside the statement.
+        """
+        lexer = OffsetLexer(text)
+        lexer.pos = lexer.line_start = start
+        parser = None
+        try:
+            parser = Parser(lexer)
+            if parser.current_token.type == EOF:
+                return None, None, len(text)
+            node = parser.statement()
+        except UnterminatedString:
+            raise Incomplete('the input ends inside a string')
+        except Exception:
+            if parser is not None and parser.current_token.type == EOF:
+                raise Incomplete('the input ends inside a statement')
+            raise
+        end = lexer.match_start
+        key = text_key(text[start:end])
+        nodes = self.parsed.get(key)
+        if nodes is None:
+            nodes = list(optimize_statements([node])) if self.optimized else [node]
+            self.parsed[key] = nodes
+            if len(self.parsed) > MAX_PARSED_CHUNKS:
+                self.parsed.popitem(last=False)
+        else:
+            self.parsed.move_to_end(key)
+        return key, nodes, end
+
+    def statements(self, text):
+        """Returns the statements of an input, raises Incomplete when a statement is unfinished"""
+        statements = []
+        start = 0
+        while start < len(text):
+            key, nodes, start = self.parse(text, start)
+            if key is not None:
+                statements.extend(nodes)
+        return statements
+
+    def execute(self, statements, callback=None):
+        """Runs statements, callback(node, value) is called after each one"""
+        inter = self.inter
+        try:
+            for node in statements:
+                value = inter.visit(node)
+                if callback is not None:
+                    callback(node, value)
+        finally:
+            flatten_memory(inter.GLOBAL_MEMORY)
+
+    def load(self, path):
+        """Runs a script; returns its number of chunks, how many were parsed and the parse seconds"""
+        self.last_path = path
+        with open(path, 'r') as file:
+            text = file.read()
+        script = self.scripts.get(path)
+        if script is None:
+            script = Script(path)
+        start = time.perf_counter()
+        parsed = script.update(text, self.parse)
+        elapsed = time.perf_counter() - start
+        self.scripts[path] = script
+        self.execute(script.statements())
+        return len(script.chunks), parsed, elapsed
+
+
+def show(value):
+    return repr(to_python(value))
+
+
+class Console(object):
+    """Reads lines, runs them in a Session and prints what they did"""
+
+    def __init__(self, session, read=input, write=sys.stdout.write):
+        self.session = session
+        self.read = read
+        self.write = write
+        self.lines = []
+
+    def echo(self, node, value):
+        if isinstance(node, Assign):
+            name = node.left.value
+            self.write('{} = {}\n'.format(name, show(self.session.GLOBAL_MEMORY[name])))
+        elif value is not None and not isinstance(node, (Def, If, While, For)):
+            self.write('=> {}\n'.format(show(value)))
+
+    def run(self):
+        while True:
+            try:
+                line = self.read(CONTINUATION_PROMPT if self.lines else PROMPT)
+            except EOFError:
+                self.write('\n')
+                return
+            except KeyboardInterrupt:
+                # drops the unfinished input
+                self.lines = []
+                self.write('\n')
+                continue
+            if not self.lines and line.strip().startswith(':'):
+                if not self.command(line.strip()):
+                    return
+                continue
+            self.lines.append(line + '\n')
+            self.feed(''.join(self.lines))
+
+    def feed(self, text):
+        try:
+            statements = self.session.statements(text)
+        except Incomplete:
+            return
+        except Exception as e:
+            self.lines = []
+            self.error(e)
+            return
+        self.lines = []
+        try:
+            self.session.execute(statements, self.echo)
+        except KeyboardInterrupt:
+            self.write('interrupted\n')
+        except Exception as e:
+            self.error(e)
+
+    def error(self, e):
+        self.write('{}: {}\n'.format(type(e).__name__, e))
+
+    def command(self, line):
+        """Runs a : command, returns False to leave"""
+        try:
+            words = shlex.split(line)
+        except ValueError as e:
+            self.error(e)
+            return True
+        name, args = words[0], words[1:]
+        if name in (':quit', ':q', ':exit'):
+            return False
+        if name == ':help':
+            self.write(HELP + '\n')
+        elif name == ':vars':
+            for var, value in self.session.GLOBAL_MEMORY.items():
+                self.write('{} = {}\n'.format(var, show(value)))
+        elif name == ':reset':
+            self.session.reset()
+        elif name in (':load', ':reload'):
+            path = args[0] if name == ':load' and args else self.session.last_path
+            if path is None or (name == ':load' and len(args) != 1):
+                self.write('usage: :load PATH\n')
+            else:
+                self.load(path)
+        else:
+            self.write('unknown command {}, see :help\n'.format(name))
+        return True
+
+    def load(self, path):
+        try:
+            chunks, parsed, elapsed = self.session.load(path)
+        except KeyboardInterrupt:
+            self.write('interrupted\n')
+        except Exception as e:
+            self.error(e)
+        else:
+            self.write('loaded {}: {} statements, {} parsed in {:.1f} ms\n'.format(
+                path, chunks, parsed, elapsed * 1000))
+
+
+def interact(backend='tree', optimized=True, paths=()):
+    """Runs the interactive loop on a new Session, loading paths first"""
+    try:
+        import readline
+    except ImportError:
+        pass
+    console = Console(Session(backend, optimized))
+    for path in paths:
+        console.load(path)
+    console.run()
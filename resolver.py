@@ -0,0 +1,127 @@
+from parser_ruby import *
+from rope import flatten
+from methods import method_code
+
+
+class SymbolTable(object):
+    """Maps every identifier of a program to an integer slot"""
+
+    def __init__(self):
+        self.names = []
+        self.slots = {}
+
+    def slot(self, name):
+        """Returns the slot of name, allocating the next free one if needed"""
+        slot = self.slots.get(name)
+        if slot is None:
+            slot = self.slots[name] = len(self.names)
+            self.names.append(name)
+        return slot
+
+    def new_frame(self):
+        """Returns an empty frame, None marks a variable that is not set yet"""
+        return [None] * len(self.names)
+
+    def view(self, frame):
+        """Rebuilds the name to value mapping of the variables set in frame, Ropes as str"""
+        return {name: flatten(value) for name, value in zip(self.names, frame) if value is not None}
+
+    def __len__(self):
+        return len(self.names)
+
+
+class Resolver(NodeVisitor):
+    """Stores the slot of its identifier on every Var node of the tree.
+
+    The locals of a method have slots of the method frame instead, given
+    by its MethodCode; only the globals it reads get a slot here.
+    """
+
+    def __init__(self, tree, symbols=None):
+        self.tree = tree
+        self.symbols = SymbolTable() if symbols is None else symbols
+
+    def visit_BinOp(self, node):
+        self.visit(node.left)
+        self.visit(node.right)
+
+    def visit_Num(self, node):
+        pass
+
+    def visit_UnaryOp(self, node):
+        self.visit(node.expr)
+
+    def visit_Compound(self, node):
+        for child in node.children:
+            self.visit(child)
+
+    def visit_Assign(self, node):
+        self.visit(node.left)
+        self.visit(node.right)
+
+    def visit_Var(self, node):
+        node.slot = self.symbols.slot(node.value)
+
+    def visit_If(self, node):
+        self.visit(node.condition)
+        self.visit(node.body)
+        self.visit(node.rest)
+
+    def visit_Else(self, node):
+        self.visit(node.body)
+
+    def visit_While(self, node):
+        self.visit(node.condition)
+        self.visit(node.body)
+
+    def visit_For(self, node):
+        self.visit(node.var)
+        self.visit(node.iterable)
+        self.visit(node.body)
+
+    def visit_ArrayLiteral(self, node):
+        for item in node.items:
+            self.visit(item)
+
+    def visit_RangeLiteral(self, node):
+        self.visit(node.first)
+        self.visit(node.last)
+
+    def visit_MethodCall(self, node):
+        #the block parameter gets a slot too, it is never set
+        self.visit(node.receiver)
+        if node.body is not None:
+            self.visit(node.body)
+
+    def visit_Def(self, node):
+        method_code(node)
+        self.visit(node.body)
+
+    def visit_Call(self, node):
+        for arg in node.args:
+            self.visit(arg)
+
+    def visit_Return(self, node):
+        self.visit(node.value)
+
+    def visit_LocalVar(self, node):
+        pass
+
+    def visit_LocalAssign(self, node):
+        self.visit(node.right)
+
+    def visit_LocalFor(self, node):
+        self.visit(node.iterable)
+        self.visit(node.body)
+
+    def visit_list(self, node):
+        for child in node:
+            self.visit(child)
+
+    def visit_NoOp(self, node):
+        pass
+
+    def resolve(self):
+        if self.tree is not None:
+            self.visit(self.tree)
+        return self.symbols
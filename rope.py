@@ -0,0 +1,129 @@
+import operator
+
+#concatenations shorter than this stay plain python strings
+MIN_ROPE_LENGTH = 256
+
+
+class Rope(object):
+    """An immutable string built by concatenation without copying.
+
+    A rope is the first count pieces of a piece list that it may share
+    with the ropes appended to it. Appending to the rope that ends its
+    list appends to the list in place, so building a string with
+    s = s + piece costs amortized O(len(piece)) rather than a copy of all
+    of s every time; appending to an older rope copies the piece list.
+    The pieces are joined only when the string is needed (compared,
+    hashed, printed, stored in the final bindings) and the result is
+    kept, later appends start from it.
+
+    Ropes behave like the str they stand for: any operation other than
+    concatenation is done on the flattened string, so results and errors
+    are the ones of plain strings.
+    """
+    __slots__ = ('pieces', 'count', 'length', 'string')
+
+    def __init__(self, pieces, count, length):
+        self.pieces = pieces
+        self.count = count
+        self.length = length
+        self.string = None
+
+    def flatten(self):
+        """Returns the str of the rope"""
+        string = self.string
+        if string is None:
+            pieces = self.pieces
+            string = self.string = ''.join(pieces if len(pieces) == self.count else pieces[:self.count])
+        return string
+
+    def append(self, piece):
+        """Returns the rope of this string followed by the str piece"""
+        if self.string is not None:
+            # joined already, the new list starts from the joined string
+            pieces = [self.string]
+        elif len(self.pieces) == self.count:
+            pieces = self.pieces
+        else:
+            pieces = self.pieces[:self.count]
+        pieces.append(piece)
+        return Rope(pieces, len(pieces), self.length + len(piece))
+
+    def __add__(self, other):
+        if type(other) is str:
+            return self.append(other)
+        if type(other) is Rope:
+            return self.append(other.flatten())
+        return self.flatten() + other
+
+    def __radd__(self, other):
+        if type(other) is str:
+            return Rope([other, self.flatten()], 2, len(other) + self.length)
+        return other + self.flatten()
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        return self.length != 0
+
+    def __str__(self):
+        return self.flatten()
+
+    def __repr__(self):
+        return repr(self.flatten())
+
+    def __hash__(self):
+        return hash(self.flatten())
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + self.length
+
+    def __reduce__(self):
+        return (str, (self.flatten(),))
+
+
+def _forward(func):
+    def method(self, *args):
+        return func(self.flatten(), *args)
+    return method
+
+
+def _reflected(func):
+    def method(self, other):
+        return func(other, self.flatten())
+    return method
+
+
+for _name in ('eq', 'ne', 'lt', 'le', 'gt', 'ge', 'sub', 'mul', 'truediv', 'mod', 'pos', 'neg'):
+    setattr(Rope, '__{}__'.format(_name), _forward(getattr(operator, _name)))
+for _name in ('sub', 'mul', 'truediv', 'mod'):
+    setattr(Rope, '__r{}__'.format(_name), _reflected(getattr(operator, _name)))
+
+
+def concat(left, right):
+    """Returns left + right, joining long strings into a Rope"""
+    if type(left) is str and type(right) is str:
+        if len(left) + len(right) < MIN_ROPE_LENGTH:
+            return left + right
+        return Rope([left, right], 2, len(left) + len(right))
+    return left + right
+
+
+def plus(left, right):
+    """Returns left + right, a string on the left is joined by concat()"""
+    if type(left) is str or type(left) is Rope:
+        return concat(left, right)
+    return left + right
+
+
+def flatten(value):
+    """Returns the str of a Rope, any other value as it is"""
+    return value.flatten() if type(value) is Rope else value
+
+
+def flatten_memory(memory):
+    """Replaces the Ropes among the values of a bindings dict by their str"""
+    for name, value in memory.items():
+        if type(value) is Rope:
+            memory[name] = value.flatten()
+    return memory
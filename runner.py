@@ -0,0 +1,289 @@
+import glob
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from lexer import *
+from parser_ruby import *
+from interpreter import *
+from compiler import *
+from vm import *
+from optimizer import optimize, optimize_statements, make_num
+from cache import *
+from transpiler import PythonBackend
+from flatast import FlatInterpreter
+from tracing import TracingInterpreter
+from collection import Array, Range, to_python
+from methods import uses_methods
+
+
+def with_methods(factory):
+    """Wraps the factory of a backend without methods, trees using them run on the Interpreter"""
+    return lambda tree: Interpreter(tree) if uses_methods(tree) else factory(tree)
+
+
+#backend name -> factory building an object with interpret() and GLOBAL_MEMORY from a tree
+BACKENDS = {
+    'vm': with_methods(lambda tree: VM(Compiler(tree).compile())),
+    'tree': Interpreter,
+    'slot': SlotInterpreter,
+    'iterative': IterativeInterpreter,
+    'specializing': SpecializingInterpreter,
+    'tracing': TracingInterpreter,
+    'python': with_methods(PythonBackend),
+    'flat': with_methods(FlatInterpreter),
+}
+
+#backends that can run a script one top level statement at a time
+STREAM_BACKENDS = {
+    'tree': Interpreter,
+    'iterative': IterativeInterpreter,
+    'specializing': SpecializingInterpreter,
+    'tracing': TracingInterpreter,
+}
+
+
+def new_result(path=None, error=None):
+    """Returns an empty result record, marked as failed when error is given.
+
+    The record holds the final variable bindings, a status of 'ok' or
+    'error', the error message and the lex/parse/optimize/execute
+    timings in seconds.
+    """
+    return {
+        'path': path,
+        'status': 'ok' if error is None else 'error',
+        'bindings': None,
+        'error': error,
+        'cached': False,
+        'timings': {'lex': 0.0, 'parse': 0.0, 'optimize': 0.0, 'execute': 0.0},
+    }
+
+
+#python types a starting binding may have, besides lists, Arrays and Ranges
+BINDING_TYPES = (bool, int, float, str)
+
+
+def literal(name, value):
+    """Returns the expression node building the starting value of binding name"""
+    if type(value) is Array:
+        value = value.to_list()
+    if type(value) is list:
+        return ArrayLiteral([literal(name, item) for item in value])
+    if type(value) is Range:
+        return RangeLiteral(make_num(value.first), make_num(value.last), value.exclusive)
+    if not isinstance(value, BINDING_TYPES):
+        raise TypeError('binding {} has unsupported type {}'.format(name, type(value).__name__))
+    return make_num(value)
+
+
+def with_bindings(tree, bindings):
+    """Returns a tree that assigns bindings and then runs tree.
+
+    Every backend then sees the starting values as ordinary assignments.
+    tree itself is left untouched, so a cached tree can be reused.
+    """
+    if not bindings:
+        return tree
+    root = Compound()
+    for name, value in bindings.items():
+        root.children.append(Assign(Var(Token(ID, name)), FIXED_TOKENS['='], literal(name, value)))
+    if tree is not None:
+        root.children.extend(tree.children if isinstance(tree, Compound) else [tree])
+        copy_location(root, tree)
+    return root
+
+
+def run_source(text, backend='vm', optimized=True, cache=None, path=None, bindings=None):
+    """Runs one script and returns its result record, see new_result().
+
+    bindings are the starting values of variables. Errors are reported
+    in the record, not raised.
+    """
+    result = new_result(path)
+    timings = result['timings']
+    try:
+        tree = cache.load(text, optimized) if cache is not None else None
+        if tree is not None:
+            result['cached'] = True
+        else:
+            start = time.perf_counter()
+            tokens = Lexer(text).tokens()
+            timings['lex'] = time.perf_counter() - start
+            start = time.perf_counter()
+            tree = Parser(ReplayLexer(tokens)).parse()
+            timings['parse'] = time.perf_counter() - start
+            if optimized:
+                start = time.perf_counter()
+                tree = optimize(tree)
+                timings['optimize'] = time.perf_counter() - start
+            if cache is not None:
+                try:
+                    cache.store(text, tree, optimized)
+                except OSError:
+                    pass
+        tree = with_bindings(tree, bindings)
+        start = time.perf_counter()
+        inter = BACKENDS[backend](tree)
+        try:
+            inter.interpret()
+        finally:
+            timings['execute'] = time.perf_counter() - start
+            result['bindings'] = dict(inter.GLOBAL_MEMORY)
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    return result
+
+
+def run_script(path, backend='vm', optimized=True, use_cache=True):
+    """Reads and runs the script at path, see run_source()"""
+    try:
+        with open(path, 'r') as file:
+            text = file.read()
+    except OSError as e:
+        return new_result(path, '{}: {}'.format(type(e).__name__, e))
+    cache = None
+    if use_cache:
+        cache = ProgramCache(os.path.join(os.path.dirname(path), DEFAULT_CACHE_DIR))
+    return run_source(text, backend, optimized, cache, path)
+
+
+def stream_statements(file, optimized=True, chunk_size=STREAM_CHUNK_SIZE):
+    """Yields the top level statements of a script while it is being read.
+
+    file is a text or binary file object, a pipe or an mmap. Each
+    statement is yielded as soon as it has been parsed (and optimized),
+    so running and dropping them one by one keeps memory bounded by the
+    largest statement rather than by the script, see
+    Interpreter.run_statements().
+    """
+    statements = Parser(StreamLexer(file, chunk_size)).statements()
+    if optimized:
+        statements = optimize_statements(statements)
+    return statements
+
+
+def expand_paths(patterns):
+    """Expands glob patterns, plain paths are kept even if they do not exist"""
+    paths = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            paths.extend(sorted(glob.glob(pattern, recursive=True)))
+        else:
+            paths.append(pattern)
+    return paths
+
+
+def _warm_worker():
+    """Runs a tiny script so a worker is warm before its first real job"""
+    run_source('a = 1\nwhile a < 2\n a = a + 1\nend')
+
+
+def run_scripts(paths, backend='vm', optimized=True, use_cache=True):
+    """Runs a chunk of scripts in one worker call"""
+    return [run_script(path, backend, optimized, use_cache) for path in paths]
+
+
+def chunks(paths, size):
+    chunk = []
+    for path in paths:
+        chunk.append(path)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def run_isolated(path, backend='vm', optimized=True, use_cache=True):
+    """Runs one script in a worker process of its own.
+
+    Returns the failed result of the script when the worker dies, the
+    script itself killed it since nothing else ran in that process.
+    """
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        try:
+            return executor.submit(run_script, path, backend, optimized, use_cache).result()
+        except BrokenProcessPool:
+            return new_result(path, 'BrokenProcessPool: worker process died')
+
+
+def run_many(paths, jobs=None, backend='vm', optimized=True, use_cache=True, chunksize=16):
+    """Runs every script and yields the result records as they complete.
+
+    With jobs > 1 the scripts run in chunks on a pool of reused worker
+    processes. At most a few chunks per worker are queued at a time so a
+    huge list of scripts is streamed rather than submitted all at once.
+    If a worker dies the pool is rebuilt and its chunks are retried, then
+    split into single scripts. A single script still in flight when the
+    pool breaks again may just have shared it with the culprit, it is
+    rerun on a worker of its own so only the culprit is reported as failed.
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    options = (backend, optimized, use_cache)
+    if jobs <= 1:
+        for path in paths:
+            yield run_script(path, *options)
+        return
+
+    pending = chunks(paths, chunksize)
+    retries = []
+    max_in_flight = jobs * 4
+    executor = ProcessPoolExecutor(max_workers=jobs, initializer=_warm_worker)
+    in_flight = {}
+    try:
+        while True:
+            while len(in_flight) < max_in_flight:
+                if retries:
+                    chunk, attempt = retries.pop()
+                else:
+                    chunk = next(pending, None)
+                    attempt = 0
+                    if chunk is None:
+                        break
+                in_flight[executor.submit(run_scripts, chunk, *options)] = (chunk, attempt)
+            if not in_flight:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            broken = False
+            suspects = []
+            for future in done:
+                chunk, attempt = in_flight.pop(future)
+                try:
+                    results = future.result()
+                except BrokenProcessPool:
+                    broken = True
+                    if attempt == 0:
+                        retries.append((chunk, 1))
+                    elif len(chunk) > 1:
+                        retries.extend(([path], 1) for path in chunk)
+                    else:
+                        suspects.append(chunk[0])
+                    continue
+                for result in results:
+                    yield result
+            if broken:
+                retries.extend(in_flight.values())
+                in_flight.clear()
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = ProcessPoolExecutor(max_workers=jobs, initializer=_warm_worker)
+            for path in suspects:
+                yield run_isolated(path, *options)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def json_value(value):
+    """Returns a value json cannot serialize as plain data, an Array as a list"""
+    if type(value) is Array:
+        return to_python(value)
+    return str(value)
+
+
+def to_json(result):
+    """Serializes a result record as one line of JSON"""
+    return json.dumps(result, default=json_value)
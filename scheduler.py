@@ -0,0 +1,202 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+from compiler import Compiler, CompileError
+from vm import VM, LimitExceeded
+from cache import parse_source
+from methods import uses_methods
+
+#task states
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+#instructions a task runs per slice unless it asks for another budget
+DEFAULT_BUDGET = 1000
+#seconds the asyncio driver runs slices before it yields to the event loop
+DEFAULT_QUANTUM = 0.005
+#the pass of a task grows by STRIDE / priority per slice it runs
+STRIDE = 1 << 20
+
+
+class Cancelled(Exception):
+    """A task was cancelled before it finished"""
+
+
+class Task(object):
+    """One script instance running on a Scheduler.
+
+    bindings holds the final variables of a task that is done, error the
+    exception of one that failed or was cancelled. steps and slices count
+    the instructions and time slices it ran.
+    """
+
+    def __init__(self, scheduler, task_id, vm, priority, budget, step_limit, memory_limit):
+        self.scheduler = scheduler
+        self.id = task_id
+        self.vm = vm
+        self.priority = priority
+        self.budget = budget
+        self.step_limit = step_limit
+        self.memory_limit = memory_limit
+        self.state = PENDING
+        self.bindings = None
+        self.error = None
+        self.slices = 0
+        # stride scheduling position, the task with the lowest pass runs next
+        self.pass_value = 0
+        self.future = None
+
+    @property
+    def steps(self):
+        return self.vm.steps
+
+    @property
+    def finished(self):
+        return self.state != PENDING
+
+    def cancel(self):
+        """Stops the task, it fails with Cancelled unless it already finished"""
+        if not self.finished:
+            self.scheduler.finish(self, CANCELLED, Cancelled('task {} cancelled'.format(self.id)))
+
+    def result(self):
+        """Returns the final bindings or raises the error of the task"""
+        if self.state == PENDING:
+            raise Exception('task {} has not finished'.format(self.id))
+        if self.error is not None:
+            raise self.error
+        return self.bindings
+
+    def __repr__(self):
+        return 'Task({}, {}, steps={})'.format(self.id, self.state, self.steps)
+
+
+class Scheduler(object):
+    """Interleaves many scripts in one process on resumable VMs.
+
+    Every task runs in slices of at most its instruction budget, a
+    collection method taking one instruction per element, so a runaway
+    loop only ever delays the others by one slice. Tasks share
+    the CPU in proportion to their priority (stride scheduling: the task
+    that has had the least CPU per unit of priority runs next), so low
+    priorities are slowed down, never starved. A task fails with
+    LimitExceeded when it runs more than step_limit instructions or its
+    variables grow past memory_limit bytes.
+
+    step() and run_all() drive the tasks synchronously, run() is the
+    asyncio API and drives them from a background coroutine that yields
+    to the event loop every quantum seconds.
+    """
+
+    def __init__(self, budget=DEFAULT_BUDGET, quantum=DEFAULT_QUANTUM, optimized=True):
+        self.budget = budget
+        self.quantum = quantum
+        self.optimized = optimized
+        self.ready = []
+        self.tasks = {}
+        self._ids = itertools.count(1)
+        self._order = itertools.count()
+        # pass of the task that ran last, new tasks start from it
+        self._pass = 0
+        self._driver = None
+
+    def submit(self, script, priority=1, budget=None, step_limit=None, memory_limit=None):
+        """Adds a script (source text or parsed tree) and returns its Task.
+
+        priority is a positive weight, a task of priority 2 gets twice the
+        slices of one of priority 1. Parse errors are raised right away,
+        and so is a CompileError for a program using methods, which only
+        the tree walker runs.
+        """
+        if priority <= 0:
+            raise ValueError('priority must be positive')
+        tree = parse_source(script, self.optimized) if isinstance(script, str) else script
+        if uses_methods(tree):
+            raise CompileError('a program defining or calling methods cannot run on a scheduled vm')
+        vm = VM(Compiler(tree).compile())
+        task = Task(self, next(self._ids), vm, priority, budget or self.budget, step_limit, memory_limit)
+        task.pass_value = self._pass
+        self.tasks[task.id] = task
+        heapq.heappush(self.ready, (task.pass_value, next(self._order), task))
+        return task
+
+    def finish(self, task, state, error=None):
+        task.state = state
+        task.error = error
+        if state == DONE:
+            task.bindings = task.vm.GLOBAL_MEMORY
+        del self.tasks[task.id]
+        future = task.future
+        if future is not None and not future.done():
+            if error is None:
+                future.set_result(task.bindings)
+            else:
+                future.set_exception(error)
+
+    def step(self):
+        """Runs one slice of the next task, returns False when no task is left"""
+        while self.ready:
+            pass_value, _, task = heapq.heappop(self.ready)
+            if task.finished:
+                # cancelled while it was waiting
+                continue
+            self._pass = pass_value
+            self.run_slice(task)
+            if not task.finished:
+                task.pass_value += STRIDE // task.priority
+                heapq.heappush(self.ready, (task.pass_value, next(self._order), task))
+            return True
+        return False
+
+    def run_slice(self, task):
+        vm = task.vm
+        budget = task.budget
+        if task.step_limit is not None:
+            budget = min(budget, task.step_limit - vm.steps + 1)
+        task.slices += 1
+        try:
+            halted = vm.run_slice(budget, task.memory_limit, step_methods=True)
+            if not halted and task.step_limit is not None and vm.steps > task.step_limit:
+                raise LimitExceeded('step limit of {} exceeded'.format(task.step_limit))
+            if task.memory_limit is not None and vm.memory_size() > task.memory_limit:
+                raise LimitExceeded('memory limit of {} bytes exceeded'.format(task.memory_limit))
+        except Exception as e:
+            self.finish(task, FAILED, e)
+            return
+        if halted:
+            self.finish(task, DONE)
+
+    def run_all(self):
+        """Runs every task to completion and returns the Tasks that ran"""
+        tasks = list(self.tasks.values())
+        while self.step():
+            pass
+        return tasks
+
+    async def run(self, script, priority=1, budget=None, step_limit=None, memory_limit=None):
+        """Runs a script next to the others and returns its final bindings.
+
+        Errors of the script are raised here; cancelling the awaiting
+        coroutine cancels the task.
+        """
+        task = self.submit(script, priority, budget, step_limit, memory_limit)
+        task.future = asyncio.get_running_loop().create_future()
+        if self._driver is None or self._driver.done():
+            self._driver = asyncio.ensure_future(self.drive())
+        try:
+            return await task.future
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+
+    async def drive(self):
+        """Runs slices until no task is left, yielding to the event loop every quantum"""
+        while self.ready:
+            deadline = time.perf_counter() + self.quantum
+            while time.perf_counter() < deadline and self.step():
+                pass
+            await asyncio.sleep(0)
@@ -0,0 +1,286 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from cache import ProgramCache, DEFAULT_CACHE_DIR
+from runner import BACKENDS, new_result, run_source, to_json, _warm_worker
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 7878
+#requests waiting for a worker beyond this are rejected as busy
+DEFAULT_MAX_QUEUE = 256
+#requests of one connection running at a time, the connection is not read
+#further until one of them is answered
+DEFAULT_MAX_PIPELINE = 16
+#longest request line in bytes
+MAX_REQUEST_BYTES = 16 * 1024 * 1024
+
+#parsed program cache of a worker process, per cache directory
+_caches = {}
+
+
+def run_request(request, cache_dir):
+    """Runs one request in a worker process and returns its result record"""
+    cache = None
+    if cache_dir is not None:
+        cache = _caches.get(cache_dir)
+        if cache is None:
+            cache = _caches[cache_dir] = ProgramCache(cache_dir)
+    path = request.get('path')
+    source = request.get('source')
+    if source is None:
+        try:
+            with open(path, 'r') as file:
+                source = file.read()
+        except OSError as e:
+            return new_result(path, '{}: {}'.format(type(e).__name__, e))
+    return run_source(source, request.get('backend', 'vm'), request.get('optimized', True),
+                      cache, path, request.get('bindings'))
+
+
+def check_request(request):
+    """Returns what is wrong with a run request, None if it can run"""
+    if not isinstance(request, dict):
+        return 'a request must be a JSON object'
+    if ('source' in request) == ('path' in request):
+        return 'a request needs either source or path'
+    if not isinstance(request.get('source', request.get('path')), str):
+        return 'source and path must be strings'
+    if request.get('backend', 'vm') not in BACKENDS:
+        return 'unknown backend {!r}'.format(request.get('backend'))
+    bindings = request.get('bindings')
+    if bindings is not None and not isinstance(bindings, dict):
+        return 'bindings must be a JSON object'
+    return None
+
+
+class Server(object):
+    """Runs scripts sent over a socket on a pool of warm worker processes.
+
+    The protocol is one JSON object per line each way. A request holds
+    either the source of a script or the path of one, and optionally
+    bindings (the starting variables), backend, optimized and an id that
+    is echoed in the reply. The reply is the result record of run_source()
+    with the time spent waiting for a worker and the total time added to
+    its timings. {"op": "metrics"} is answered with metrics() right away.
+
+    Replies of one connection come back in the order their scripts
+    finish. At most jobs scripts run at a time; at most max_queue more
+    wait for a worker and further requests are rejected with a busy error
+    at once. A connection with max_pipeline requests running is not read
+    until one of them is answered, so a fast client is slowed down by TCP
+    flow control rather than filling the server's memory.
+    """
+
+    def __init__(self, jobs=None, cache_dir=DEFAULT_CACHE_DIR,
+                 max_queue=DEFAULT_MAX_QUEUE, max_pipeline=DEFAULT_MAX_PIPELINE):
+        self.jobs = jobs or os.cpu_count() or 1
+        self.cache_dir = cache_dir
+        self.max_queue = max_queue
+        self.max_pipeline = max_pipeline
+        self.executor = None
+        self.slots = None
+        self.server = None
+        self.started = time.time()
+        self.connections = 0
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.busy_time = 0.0
+        self.max_queued = 0
+
+    def new_executor(self):
+        # forked workers would inherit the sockets of open connections and
+        # keep them open after the server closes them
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        return ProcessPoolExecutor(max_workers=self.jobs, mp_context=context, initializer=_warm_worker)
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT, unix=None):
+        """Starts the workers and listens on a unix socket path or on host:port"""
+        self.executor = self.new_executor()
+        self.slots = asyncio.Semaphore(self.jobs)
+        # workers start on demand, start them all before the first request
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self.executor, _warm_worker) for _ in range(self.jobs)))
+        if unix is not None:
+            self.server = await asyncio.start_unix_server(self.serve, unix, limit=MAX_REQUEST_BYTES)
+        else:
+            self.server = await asyncio.start_server(self.serve, host, port, limit=MAX_REQUEST_BYTES)
+        return self.server
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def metrics(self):
+        finished = self.completed + self.failed
+        return {
+            'queue_depth': self.queued,
+            'max_queue_depth': self.max_queued,
+            'in_flight': self.in_flight,
+            'completed': self.completed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'connections': self.connections,
+            'workers': self.jobs,
+            'mean_latency': self.busy_time / finished if finished else 0.0,
+            'uptime': time.time() - self.started,
+        }
+
+    async def execute(self, request):
+        """Runs a request on a worker and returns its result record"""
+        received = time.perf_counter()
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            return new_result(request.get('path'), 'Busy: {} requests are waiting'.format(self.queued))
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        try:
+            await self.slots.acquire()
+        finally:
+            self.queued -= 1
+        self.in_flight += 1
+        start = time.perf_counter()
+        try:
+            result = await self.call(request)
+        finally:
+            self.in_flight -= 1
+            self.slots.release()
+        end = time.perf_counter()
+        result['timings']['queue'] = start - received
+        result['timings']['total'] = end - received
+        self.busy_time += end - received
+        if result['status'] == 'ok':
+            self.completed += 1
+        else:
+            self.failed += 1
+        return result
+
+    async def call(self, request):
+        """Runs a request on the pool, rebuilding the pool once if a worker died"""
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            executor = self.executor
+            try:
+                return await loop.run_in_executor(executor, run_request, request, self.cache_dir)
+            except BrokenProcessPool:
+                # other requests may have replaced the pool already
+                if self.executor is executor:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    self.executor = self.new_executor()
+        return new_result(request.get('path'), 'BrokenProcessPool: worker process died')
+
+    def parse(self, line):
+        """Returns a request line as (request, reply), reply is None for a script to run"""
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return None, new_result(None, 'ValueError: {}'.format(e))
+        if isinstance(request, dict) and 'op' in request:
+            if request['op'] == 'metrics':
+                return request, self.metrics()
+            return request, new_result(None, 'unknown op {!r}'.format(request['op']))
+        error = check_request(request)
+        return request, None if error is None else new_result(None, error)
+
+    async def reply(self, writer, lock, request, response):
+        if isinstance(request, dict) and 'id' in request:
+            response['id'] = request['id']
+        async with lock:
+            writer.write((to_json(response) + '\n').encode('utf-8'))
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    async def answer(self, writer, lock, pipeline, request):
+        try:
+            await self.reply(writer, lock, request, await self.execute(request))
+        finally:
+            pipeline.release()
+
+    async def serve(self, reader, writer):
+        """Handles one connection until the client closes it"""
+        self.connections += 1
+        lock = asyncio.Lock()
+        pipeline = asyncio.Semaphore(self.max_pipeline)
+        tasks = set()
+        try:
+            while True:
+                await pipeline.acquire()
+                try:
+                    line = await reader.readline()
+                except (ValueError, ConnectionError) as e:
+                    # a line longer than the limit cannot be resynchronized
+                    await self.reply(writer, lock, None, new_result(None, '{}: {}'.format(type(e).__name__, e)))
+                    break
+                if not line:
+                    break
+                request, response = self.parse(line) if line.strip() else (None, None)
+                if request is None or response is not None:
+                    if response is not None:
+                        await self.reply(writer, lock, request, response)
+                    pipeline.release()
+                    continue
+                task = asyncio.ensure_future(self.answer(writer, lock, pipeline, request))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            self.connections -= 1
+            writer.close()
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Serve script runs over a socket, one JSON request and reply per line.')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--unix', metavar='PATH', help='listen on a unix domain socket instead of TCP')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help='parsed program cache shared by the workers')
+    parser.add_argument('--no-cache', dest='cache_dir', action='store_const', const=None,
+                        help='neither read nor write the parsed program cache')
+    parser.add_argument('--max-queue', type=int, default=DEFAULT_MAX_QUEUE,
+                        help='requests that may wait for a worker before new ones are rejected')
+    parser.add_argument('--max-pipeline', type=int, default=DEFAULT_MAX_PIPELINE,
+                        help='requests of one connection that may run at a time')
+    return parser
+
+
+async def serve_forever(args):
+    server = Server(args.jobs, args.cache_dir, args.max_queue, args.max_pipeline)
+    listener = await server.start(args.host, args.port, args.unix)
+    address = args.unix or '{}:{}'.format(args.host, args.port)
+    sys.stderr.write('listening on {} with {} workers\n'.format(address, server.jobs))
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.close()
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    try:
+        asyncio.run(serve_forever(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
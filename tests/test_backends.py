@@ -0,0 +1,105 @@
+import glob
+import os
+
+import pytest
+
+from collection import to_python
+from runner import BACKENDS, run_source
+
+CASES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'testCases')
+
+#programs covering what testCases/ does not: strings, collections, methods
+PROGRAMS = {
+    'strings': '''s = "ab"
+i = 0
+while i < 12
+  s = s + "cd" + s
+  s = s + "e"
+  i = i + 1
+end
+t = "x\\ty\\n" + "z"
+same = s == (s + "")
+''',
+    'collections': '''a = [1, 2, 3, 4]
+b = a.map { |x| x * 3 }
+c = (1..10).select { |x| x % 3 == 0 }
+d = (1...10).reject { |x| x > 4 }
+e = (1..1000000000).sum
+f = [1.5, 2.5].sum
+total = 0
+for x in b do
+  total = total + x
+end
+a.each do |y|
+  total = total - y
+end
+n = (1..5).size + a.max + a.first + c.last
+''',
+    'branches': '''x = 7
+if x > 10
+  y = 1
+elsif x > 5
+  y = 2
+else
+  y = 3
+end
+z = 0
+k = 0
+while k < 50
+  if k % 2 == 0
+    z = z + k * 2
+  else
+    z = z - 1
+  end
+  k = k + 1
+end
+w = -(3 - 10) / 2.0 + 17 % 5
+''',
+    'loops': '''a = 0
+i = 0
+while i < 100000
+  a = a + i * 3 + 1
+  i = i + 1
+end
+b = 0
+j = 0
+while j < 1000
+  b = b + j * j
+  j = j + 2
+end
+''',
+    'methods': '''def square(x)
+  x * x
+end
+memoize def fib(n)
+  if n < 2
+    return n
+  end
+  fib(n - 1) + fib(n - 2)
+end
+a = square(12)
+b = fib(40)
+''',
+}
+
+
+def corpus():
+    for path in sorted(glob.glob(os.path.join(CASES_DIR, '*.txt'))):
+        with open(path) as file:
+            yield os.path.basename(path), file.read()
+    for name, source in PROGRAMS.items():
+        yield name, source
+
+
+def bindings(source, backend, optimized=True):
+    result = run_source(source, backend, optimized)
+    assert result['status'] == 'ok', result['error']
+    return {name: to_python(value) for name, value in result['bindings'].items()}
+
+
+@pytest.mark.parametrize('source', [source for _, source in corpus()], ids=[name for name, _ in corpus()])
+def test_backends_agree(source):
+    expected = bindings(source, 'tree', optimized=False)
+    for backend in BACKENDS:
+        for optimized in (True, False):
+            assert bindings(source, backend, optimized) == expected, (backend, optimized)
@@ -0,0 +1,32 @@
+from cache import ProgramCache, encode, decode, load_program
+from optimizer import MAX_FOLDED_STR
+from parser_ruby import Num
+from runner import run_source
+
+
+def test_round_trip(tmp_path):
+    source = 'a = 1\nb = [a, 2]\nwhile a < 10\n  a = a + 2\nend\n'
+    cache = ProgramCache(str(tmp_path))
+    tree = load_program(source, cache)
+    assert encode(decode(encode(tree))) == encode(tree)
+    assert encode(cache.load(source)) == encode(tree)
+
+
+def test_folded_string_concatenation_is_cached(tmp_path):
+    #two literals folded into a string longer than a Rope's minimum
+    source = 's = "{}" + "{}"\n'.format('a' * 200, 'b' * 200)
+    cache = ProgramCache(str(tmp_path))
+    tree = load_program(source, cache)
+    value = tree.children[0].right
+    assert isinstance(value, Num) and type(value.value) is str
+    assert cache.load(source) is not None
+    result = run_source(source, cache=cache)
+    assert result['status'] == 'ok'
+    assert result['bindings']['s'] == 'a' * 200 + 'b' * 200
+
+
+def test_long_folded_string_is_left_to_run_time(tmp_path):
+    half = MAX_FOLDED_STR // 2 + 1
+    source = 's = "{}" + "{}"\n'.format('a' * half, 'b' * half)
+    tree = load_program(source, ProgramCache(str(tmp_path)))
+    assert not isinstance(tree.children[0].right, Num)
@@ -0,0 +1,52 @@
+from checkpoint import CheckpointedRun, compile_program, program_key, restore, save
+from cache import parse_source
+from collection import to_python
+from vm import VM
+
+SOURCE = '''a = [1, 2, 3]
+s = "x"
+total = 0
+for i in 1..2000 do
+  j = 0
+  while j < 3
+    total = total + i * j
+    j = j + 1
+  end
+  s = s + "y"
+end
+b = a.map { |x| x + total }
+'''
+
+
+def python_bindings(memory):
+    return {name: to_python(value) for name, value in memory.items()}
+
+
+def expected():
+    vm = VM(compile_program(parse_source(SOURCE)))
+    vm.run()
+    return python_bindings(vm.GLOBAL_MEMORY)
+
+
+def test_resume_from_the_middle_of_loops(tmp_path):
+    path = str(tmp_path / 'run.ckpt')
+    key = program_key(SOURCE)
+    vm = VM(compile_program(parse_source(SOURCE)))
+    assert not vm.run_slice(5003)
+    save(vm, key, path)
+    resumed = restore(compile_program(parse_source(SOURCE)), key, path)
+    assert resumed.steps == vm.steps
+    resumed.run()
+    assert python_bindings(resumed.GLOBAL_MEMORY) == expected()
+
+
+def test_checkpointed_run_resumes(tmp_path):
+    path = str(tmp_path / 'run.ckpt')
+    first = CheckpointedRun(SOURCE, parse_source(SOURCE), path, interval=0.0, budget=1000)
+    assert first.run()
+    assert first.checkpoints > 0
+    # the last checkpoint was written before the run ended
+    second = CheckpointedRun(SOURCE, parse_source(SOURCE), resume=path, budget=1000)
+    assert second.vm.steps > 0
+    assert second.run()
+    assert python_bindings(second.GLOBAL_MEMORY) == expected()
@@ -0,0 +1,35 @@
+from cache import encode
+import chunked
+from chunked import parse_file
+from parser_ruby import Parser
+from lexer import Lexer
+
+BLOCK = '''x{i} = {i} + 2 * 3
+if x{i} > 5
+y = "a
+b{i}"
+end
+while x{i} < 10
+  x{i} = x{i} + 1
+end
+# comment {i}
+def f{i}(a)
+a + 1
+end
+'''
+
+
+def test_chunked_parse_matches_serial_parse(tmp_path, monkeypatch):
+    monkeypatch.setattr(chunked, 'MIN_PARALLEL_SIZE', 1 << 12)
+    parts = []
+    size = 0
+    i = 0
+    while size < 1 << 16:
+        parts.append(BLOCK.format(i=i))
+        size += len(parts[-1])
+        i += 1
+    source = ''.join(parts)
+    path = tmp_path / 'big.rb'
+    path.write_text(source)
+    serial = Parser(Lexer(source)).parse()
+    assert encode(parse_file(str(path), jobs=4)) == encode(serial)
@@ -0,0 +1,40 @@
+import io
+
+import pytest
+
+from lexer import Lexer, StreamLexer, UnterminatedString, EOF
+
+
+def test_string_escapes():
+    token = Lexer('"a\\"b\\n"').get_next_token()
+    assert token.value == 'a"b\n'
+
+
+@pytest.mark.parametrize('source', ['s = "abc\nt = 1\n', 's = "abc\\"', 's = "'])
+def test_unterminated_string_is_an_error(source):
+    lexer = Lexer(source)
+    with pytest.raises(UnterminatedString):
+        while lexer.get_next_token().type != EOF:
+            pass
+    with pytest.raises(UnterminatedString):
+        Lexer(source).tokenize_all()
+
+
+def test_unterminated_string_in_a_stream():
+    lexer = StreamLexer(io.StringIO('a = 1\ns = "' + 'x' * 100), chunk_size=8)
+    with pytest.raises(UnterminatedString):
+        while lexer.get_next_token().type != EOF:
+            pass
+
+
+def test_tokens_match_get_next_token():
+    source = 'a = 1 # x\n  s = "a\nb\n c" + "d"\n\nwhile a < 3\n a = a + 1.5\nend\n\n'
+    lexer = Lexer(source)
+    expected = []
+    while True:
+        token = lexer.get_next_token()
+        expected.append((token.type, token.value, lexer.token_line, lexer.token_column))
+        if token.type == EOF:
+            break
+    tokens = [(token.type, token.value, line, column) for token, line, column in Lexer(source).tokens()]
+    assert tokens == expected
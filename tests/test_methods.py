@@ -0,0 +1,29 @@
+import sys
+
+from runner import run_source
+
+RECURSIVE = '''def f(n)
+  if n == 0
+    0
+  else
+    1 + f(n - 1)
+  end
+end
+x = f({})
+'''
+
+
+def test_deep_recursion():
+    assert run_source(RECURSIVE.format(5000), backend='tree')['bindings'] == {'x': 5000}
+
+
+def test_too_deep_recursion_fails_and_restores_the_limit():
+    limit = sys.getrecursionlimit()
+    result = run_source(RECURSIVE.format(50000), backend='tree')
+    assert result['error'] == 'RecursionError: stack level too deep'
+    assert sys.getrecursionlimit() == limit
+
+
+def test_tail_recursion_runs_in_constant_stack():
+    source = 'def f(n, acc)\n  if n == 0\n    return acc\n  end\n  return f(n - 1, acc + n)\nend\nx = f(100000, 0)\n'
+    assert run_source(source, backend='tree')['bindings'] == {'x': 5000050000}
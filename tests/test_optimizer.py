@@ -0,0 +1,24 @@
+from cache import parse_source
+from parser_ruby import BinOp, Num, Var
+from runner import run_source
+
+
+def test_constants_are_folded():
+    tree = parse_source('a = 2 * 3 + -(4)\n')
+    value = tree.children[0].right
+    assert isinstance(value, Num) and value.value == 2
+
+
+def test_multiplication_by_two_is_kept():
+    tree = parse_source('x = 3\ny = x * 2\n')
+    value = tree.children[1].right
+    assert isinstance(value, BinOp) and value.op.value == '*'
+    assert isinstance(value.left, Var) and value.right.value == 2
+
+
+def test_deep_expressions_are_folded_without_recursion():
+    source = 'a = {}1{}\nb = {}a\n'.format('(' * 5000, ')' * 5000, '1 + ' * 20000)
+    tree = parse_source(source)
+    assert tree.children[0].right.value == 1
+    assert tree.children[1].right.left.value == 20000
+    assert run_source(source, backend='iterative')['bindings'] == {'a': 1, 'b': 20001}
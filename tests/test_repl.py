@@ -0,0 +1,53 @@
+from repl import HELP, Console, Session
+
+
+def console_output(lines, session=None):
+    """Runs a Console over lines, returns what it wrote"""
+    lines = iter(lines)
+    out = []
+
+    def read(prompt):
+        try:
+            return next(lines)
+        except StopIteration:
+            raise EOFError
+
+    Console(session or Session(), read=read, write=out.append).run()
+    return ''.join(out)
+
+
+def test_unbalanced_quotes_in_a_command():
+    out = console_output([':load "foo', 'a = 1'])
+    assert 'ValueError: No closing quotation' in out
+    assert 'a = 1' in out
+
+
+def test_statements_and_blocks():
+    out = console_output(['a = 2', 'while a < 10', '  a = a * 2', 'end', 'a + 1', ':vars'])
+    assert out == 'a = 2\n=> 17\na = 16\n\n'
+
+
+def test_errors_keep_the_session():
+    out = console_output(['a = 1', 'b = zz', 'a = ) 2', ':vars', ':nope'])
+    assert "NameError: 'zz'" in out
+    assert out.endswith('a = 1\nunknown command :nope, see :help\n\n')
+
+
+def test_reset_help_and_quit():
+    out = console_output(['a = 1', ':reset', ':vars', ':help', ':quit', 'b = 2'])
+    assert out == 'a = 1\n' + HELP + '\n'
+
+
+def test_load_and_reload(tmp_path):
+    path = tmp_path / 'script.rb'
+    path.write_text('a = 1\nb = a + 1\n')
+    session = Session()
+    out = console_output([':load {}'.format(path)], session)
+    assert 'loaded {}: 2 statements, 2 parsed'.format(path) in out
+    assert session.GLOBAL_MEMORY == {'a': 1, 'b': 2}
+    path.write_text('a = 5\nb = a + 1\n')
+    out = console_output([':reload'], session)
+    assert 'loaded {}: 2 statements, 1 parsed'.format(path) in out
+    assert session.GLOBAL_MEMORY == {'a': 5, 'b': 6}
+    assert 'usage: :load PATH' in console_output([':load'])
+    assert 'FileNotFoundError' in console_output([':load {}'.format(tmp_path / 'missing.rb')])
@@ -0,0 +1,32 @@
+import multiprocessing
+import os
+
+import pytest
+
+import runner
+from runner import run_many
+
+run_script = runner.run_script
+
+
+def crashing_run_script(path, *options):
+    """Kills the worker process on the script named crash.rb"""
+    if os.path.basename(path) == 'crash.rb':
+        os._exit(1)
+    return run_script(path, *options)
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork',
+                    reason='workers only see the patched runner when forked')
+def test_broken_pool_only_fails_the_culprit(tmp_path, monkeypatch):
+    monkeypatch.setattr(runner, 'run_script', crashing_run_script)
+    paths = []
+    for i in range(30):
+        path = tmp_path / ('crash.rb' if i == 13 else 'script{}.rb'.format(i))
+        path.write_text('a = {}\n'.format(i))
+        paths.append(str(path))
+    results = {result['path']: result for result in run_many(paths, jobs=4, use_cache=False, chunksize=4)}
+    assert sorted(results) == sorted(paths)
+    failed = [path for path, result in results.items() if result['status'] != 'ok']
+    assert failed == [str(tmp_path / 'crash.rb')]
+    assert results[paths[0]]['bindings'] == {'a': 0}
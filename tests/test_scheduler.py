@@ -0,0 +1,69 @@
+from collection import to_python
+from scheduler import Scheduler, DONE, FAILED
+from vm import LimitExceeded
+
+LOOP = 'x = 0\nwhile x < 1000\n  x = x + 1\nend\n'
+
+
+def test_block_methods_run_one_element_per_step():
+    scheduler = Scheduler(budget=100)
+    big = scheduler.submit('a = (1..20000000).map { |i| i + 1 }', memory_limit=10 ** 6)
+    small = scheduler.submit(LOOP)
+    while not small.finished:
+        scheduler.step()
+    assert not big.finished
+    scheduler.run_all()
+    assert big.state == FAILED and isinstance(big.error, LimitExceeded)
+    assert big.steps < 10 ** 6
+    assert small.result() == {'x': 1000}
+
+
+def test_stepped_methods_give_the_unscheduled_results():
+    source = ('a = [1, 2, 3, 4].map { |x| x * 2 }\nb = (1..10).select { |x| x % 2 == 0 }\n'
+              'c = (1..10).reject { |x| x > 3 }\nd = (1..4).sum { |x| x * 1.5 }\ne = (1..5).to_a\n')
+    scheduler = Scheduler(budget=3)
+    task = scheduler.submit(source)
+    scheduler.run_all()
+    assert task.state == DONE
+    bindings = {name: to_python(value) for name, value in task.result().items()}
+    assert bindings == {'a': [2, 4, 6, 8], 'b': [2, 4, 6, 8, 10], 'c': [1, 2, 3], 'd': 15.0, 'e': [1, 2, 3, 4, 5]}
+
+
+def test_step_limit():
+    scheduler = Scheduler(budget=50)
+    task = scheduler.submit('x = 0\nwhile x >= 0\n  x = x + 1\nend\n', step_limit=1000)
+    other = scheduler.submit(LOOP)
+    scheduler.run_all()
+    assert task.state == FAILED and isinstance(task.error, LimitExceeded)
+    assert task.steps <= 1001
+    assert other.result() == {'x': 1000}
+
+
+def test_memory_limit():
+    scheduler = Scheduler(budget=50)
+    task = scheduler.submit('x = 0\ns = "ab"\nwhile x >= 0\n  s = s + s\nend\n', memory_limit=10 ** 5)
+    scheduler.run_all()
+    assert task.state == FAILED and isinstance(task.error, LimitExceeded)
+
+
+def test_slices_follow_priorities():
+    scheduler = Scheduler(budget=10)
+    source = 'x = 0\nwhile x >= 0\n  x = x + 1\nend\n'
+    low = scheduler.submit(source, priority=1)
+    high = scheduler.submit(source, priority=3)
+    for _ in range(400):
+        scheduler.step()
+    assert high.slices == 300 and low.slices == 100
+    low.cancel()
+    high.cancel()
+    assert not scheduler.step()
+
+
+def test_slices_are_interleaved():
+    scheduler = Scheduler(budget=10)
+    tasks = [scheduler.submit(LOOP) for _ in range(3)]
+    while not tasks[0].finished:
+        scheduler.step()
+    assert all(abs(task.slices - tasks[0].slices) <= 1 for task in tasks)
+    scheduler.run_all()
+    assert [task.result() for task in tasks] == [{'x': 1000}] * 3
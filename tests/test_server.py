@@ -0,0 +1,71 @@
+import asyncio
+import json
+import socket
+import threading
+
+import pytest
+
+import client
+from server import Server
+
+
+@pytest.fixture
+def address(tmp_path):
+    """Path of the unix socket of a Server with one worker, running in a thread"""
+    path = str(tmp_path / 'ruby.sock')
+    server = Server(jobs=1, cache_dir=str(tmp_path / 'cache'))
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        asyncio.run_coroutine_threadsafe(server.start(unix=path), loop).result(60)
+        yield path
+    finally:
+        loop.call_soon_threadsafe(server.close)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(10)
+
+
+def requests(path, lines):
+    """Sends request lines on one connection, returns the replies"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        client.send(sock, [json.loads(line) if isinstance(line, str) else line for line in lines])
+        with sock.makefile('r', encoding='utf-8') as replies:
+            return [json.loads(line) for line in replies]
+
+
+def test_requests_and_metrics(address, tmp_path):
+    script = tmp_path / 'script.rb'
+    script.write_text('x = 2\ny = x * 5\n')
+    replies = requests(address, [
+        {'id': 1, 'source': 'b = a * 2', 'bindings': {'a': 21}},
+        {'id': 2, 'path': str(script), 'backend': 'tree'},
+        {'id': 3, 'source': 'c = zz'},
+        {'id': 4, 'source': 'c = 1', 'backend': 'nope'},
+    ])
+    by_id = {reply['id']: reply for reply in replies}
+    assert by_id[1]['bindings'] == {'a': 21, 'b': 42}
+    assert by_id[2]['bindings'] == {'x': 2, 'y': 10}
+    assert by_id[3]['status'] == 'error' and 'NameError' in by_id[3]['error']
+    assert by_id[4]['error'] == "unknown backend 'nope'"
+    metrics = requests(address, [{'op': 'metrics'}])[0]
+    assert metrics['completed'] == 2 and metrics['failed'] == 1 and metrics['workers'] == 1
+
+
+def test_client(address, capsys):
+    assert client.main(['--unix', address, '-e', 'b = a * 2', '-b', 'a=21']) == 0
+    reply = json.loads(capsys.readouterr().out)
+    assert reply['id'] == 0 and reply['bindings'] == {'a': 21, 'b': 42}
+    assert client.main(['--unix', address, '-e', 'b = zz']) == 1
+
+
+def test_client_paths_are_relative_to_its_working_directory(address, tmp_path, monkeypatch, capsys):
+    directory = tmp_path / 'scripts'
+    directory.mkdir()
+    (directory / 'script.rb').write_text('x = 3\n')
+    monkeypatch.chdir(directory)
+    assert client.main(['--unix', address, 'script.rb']) == 0
+    reply = json.loads(capsys.readouterr().out)
+    assert reply['path'] == str(directory / 'script.rb')
+    assert reply['bindings'] == {'x': 3}
@@ -0,0 +1,533 @@
+import math
+import time
+
+from interpreter import *
+from transpiler import PY_BINARY, PY_UNARY, COMPARE_PREC, UNARY_PREC, ATOM_PREC
+from profiler import node_label
+
+#interpreted iterations after which a While loop is recorded
+HOT_LOOP_ITERATIONS = 50
+#a loop recorded this often without keeping a trace stays interpreted
+MAX_RECORDINGS = 4
+#a trace that left by side exits this often, and more often than it ran
+#whole iterations, is dropped so the path taken now gets recorded
+MIN_SIDE_EXITS = 16
+#a side exit taken this often gets the path from it compiled into the trace
+HOT_EXIT_COUNT = 8
+#most branches compiled into one trace
+MAX_BRANCHES = 8
+#the values a trace can hold; the result type of every operation on them
+#depends on the operand types alone, so guarding the types a trace starts
+#with fixes the type of every value in it
+TRACE_TYPES = (int, float, bool)
+#the nodes a loop may be made of to be traced, anything else (nested
+#loops, calls, collections) keeps it in the interpreter
+TRACE_NODES = (Num, Var, BinOp, UnaryOp, Assign, If, Else, NoOp, Compound)
+#the operators of a hoisted expression computed before the loop of a
+#trace, they cannot raise on the values a trace holds unless ints and
+#floats are mixed (a float of a too large int overflows)
+SAFE_OPS = (PLUS, MINUS, MUL, EQUAL, NOT, GRE, LESE, GRET, LEST)
+
+#what a trace function returns as its exit besides the side exit numbers
+ENTRY_GUARD_FAILED = -1
+LOOP_DONE = 0
+
+
+def untraceable(loop):
+    """Returns the first node of a While a trace cannot hold, None when there is none"""
+    stack = [loop.body, loop.condition]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list):
+            stack.extend(reversed(node))
+        elif isinstance(node, TRACE_NODES):
+            stack.extend(reversed(list(iter_child_nodes(node))))
+        else:
+            return node
+    return None
+
+
+def var_key(node):
+    """Returns the (name, slot) of a variable, slot is None for a top level one"""
+    return node.value, node.slot if isinstance(node, LocalVar) else None
+
+
+def py_var(key):
+    name, slot = key
+    return 'g_' + name if slot is None else 'l_{}'.format(slot)
+
+
+class TraceRecorder(object):
+    """Runs one iteration of a While on an interpreter and records it.
+
+    ops is the linear trace of what ran: ('assign', key, expr) for every
+    assignment and ('guard', condition, truth, exit) for every If
+    condition, truth being the arm taken. exits[exit - 1] is the If a
+    failing guard resumes at and the (statements, index) positions
+    enclosing it, numbered on from the exits given. types holds the types
+    of the variables read before being assigned, the ones the recorded
+    path must start with. unsupported is why the path cannot be
+    compiled, None when it can.
+    """
+
+    def __init__(self, interpreter, node, exits=()):
+        self.inter = interpreter
+        self.node = node
+        self.ops = []
+        self.exits = list(exits)
+        self.types = {}
+        self.written = []
+        self.unsupported = None
+        self._position = []
+
+    def record(self):
+        """Runs the loop condition and, if it holds, the body; returns the condition"""
+        self.reads(self.node.condition)
+        if not self.inter.visit(self.node.condition):
+            return False
+        self.statements(self.node.body)
+        self.check_types(self.types)
+        return True
+
+    def record_exit(self, node, position):
+        """Runs the rest of an iteration from the If of a side exit"""
+        self._position = list(position)
+        self.statement(node)
+        for depth in range(len(position) - 1, -1, -1):
+            statements, index = position[depth]
+            del self._position[depth:]
+            self.statements(statements, index + 1)
+
+    def check_types(self, types):
+        """Makes sure the variables of types still have them at the end of the iteration"""
+        for key, kind in types.items():
+            if key in self.written and type(self.value(key)) is not kind:
+                self.unsupport('type of {} changes'.format(key[0]))
+
+    def value(self, key):
+        name, slot = key
+        if slot is None:
+            return self.inter.GLOBAL_MEMORY.get(name)
+        return self.inter.locals[slot]
+
+    def reads(self, expr):
+        """Notes the types of the variables an expression reads before they are assigned"""
+        stack = [expr]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, Var):
+                key = var_key(node)
+                if key not in self.written and key not in self.types:
+                    value = self.value(key)
+                    self.types[key] = type(value)
+                    if type(value) not in TRACE_TYPES and value is not None:
+                        self.unsupport('{} holds a {}'.format(node.value, type(value).__name__))
+            elif isinstance(node, Num):
+                if type(node.value) not in TRACE_TYPES:
+                    self.unsupport('{} constant'.format(type(node.value).__name__))
+            else:
+                stack.extend(iter_child_nodes(node))
+
+    def unsupport(self, reason):
+        if self.unsupported is None:
+            self.unsupported = reason
+
+    def statements(self, statements, start=0):
+        position = self._position
+        for index in range(start, len(statements)):
+            position.append((statements, index))
+            self.statement(statements[index])
+            position.pop()
+
+    def statement(self, node):
+        if isinstance(node, Assign):
+            self.reads(node.right)
+            self.inter.visit(node)
+            key = var_key(node.left)
+            value = self.value(key)
+            if type(value) not in TRACE_TYPES:
+                self.unsupport('{} is set to a {}'.format(key[0], type(value).__name__))
+            self.ops.append(('assign', key, node.right))
+            if key not in self.written:
+                self.written.append(key)
+        elif isinstance(node, If):
+            self.reads(node.condition)
+            truth = bool(self.inter.visit(node.condition))
+            self.exits.append((node, tuple(self._position)))
+            self.ops.append(('guard', node.condition, truth, len(self.exits)))
+            if truth:
+                self.statements(node.body)
+            elif isinstance(node.rest, If):
+                # an elsif resumes where its If would
+                self.statement(node.rest)
+            elif isinstance(node.rest, Else):
+                self.statements(node.rest.body)
+            else:
+                self.statements(node.rest)
+        elif isinstance(node, Compound):
+            self.statements(node.children)
+        elif isinstance(node, list):
+            self.statements(node)
+
+
+class Trace(object):
+    """The recorded paths of a While compiled into a python function.
+
+    function(memory, frame) loads the variables of the trace, checks the
+    types they start with and loops natively over the recorded path while
+    the loop condition holds. An If taking the other arm is a side exit:
+    the variables are stored back and (exit, iterations) returned, exit
+    being LOOP_DONE when the condition failed, ENTRY_GUARD_FAILED when the
+    types did not match (nothing ran) or the number of the failing guard.
+    A side exit taken HOT_EXIT_COUNT times gets the rest of the iteration
+    from it recorded as a branch (see attach()), which is compiled in
+    place of the exit, so a loop alternating between the arms of an If
+    stays in the trace.
+    """
+
+    def __init__(self, recorder):
+        self.node = recorder.node
+        self.ops = recorder.ops
+        self.exits = recorder.exits
+        self.types = recorder.types
+        self.written = list(recorder.written)
+        # exit -> the TraceRecorder of its branch
+        self.branches = {}
+        # exits whose branch could not be compiled
+        self.unattached = set()
+        self.exit_counts = {}
+        self.iterations = 0
+        self.side_exits = 0
+        self.build()
+
+    def build(self):
+        self.consts = []
+        self.source = self.generate()
+        namespace = {'__consts': self.consts}
+        exec(compile(self.source, '<trace {}>'.format(node_label(self.node)), 'exec'), namespace)
+        self.function = namespace['__trace']
+
+    def hot_exit(self, exit):
+        """Counts a side exit, tells whether its branch should be recorded now"""
+        count = self.exit_counts[exit] = self.exit_counts.get(exit, 0) + 1
+        return (count >= HOT_EXIT_COUNT and exit not in self.branches and exit not in self.unattached
+                and len(self.branches) < MAX_BRANCHES)
+
+    def attach(self, exit, recorder):
+        """Compiles the branch recorded at a side exit into the trace, returns why it cannot be"""
+        recorder.check_types(self.types)
+        if recorder.unsupported is None:
+            branches = self.branches
+            exits = self.exits
+            written = self.written
+            self.branches = dict(branches)
+            self.branches[exit] = recorder
+            self.exits = recorder.exits
+            self.written = written + [key for key in recorder.written if key not in written]
+            try:
+                self.build()
+                return None
+            except (RecursionError, SyntaxError, MemoryError):
+                recorder.unsupported = 'too deeply nested'
+                self.branches = branches
+                self.exits = exits
+                self.written = written
+        self.unattached.add(exit)
+        return recorder.unsupported
+
+    def generate(self):
+        lines = ['def __trace(__memory, __frame):']
+        keys = list(self.types) + [key for key in self.written if key not in self.types]
+        for branch in self.branches.values():
+            keys.extend(key for key in branch.types if key not in keys)
+        for key in keys:
+            name, slot = key
+            load = '__memory.get({!r})'.format(name) if slot is None else '__frame[{}]'.format(slot)
+            lines.append('    {} = {}'.format(py_var(key), load))
+        guards = self.guards(self.types)
+        if guards:
+            lines.append('    if {}:'.format(guards))
+            lines.append('        return {}, 0'.format(ENTRY_GUARD_FAILED))
+        self.hoist(lines)
+        lines.append('    __exit = {}'.format(LOOP_DONE))
+        lines.append('    __count = 0')
+        lines.append('    try:')
+        lines.append('        while {}:'.format(self.expr(self.node.condition)[0]))
+        self.path(self.ops, 3, lines)
+        lines.append('            __count += 1')
+        lines.append('    finally:')
+        if not self.written:
+            lines.append('        pass')
+        for key in self.written:
+            name, slot = key
+            store = '__memory[{!r}]'.format(name) if slot is None else '__frame[{}]'.format(slot)
+            if key in self.types:
+                lines.append('        {} = {}'.format(store, py_var(key)))
+            else:
+                # never set when the trace left before assigning it
+                lines.append('        if {} is not None:'.format(py_var(key)))
+                lines.append('            {} = {}'.format(store, py_var(key)))
+        lines.append('    return __exit, __count')
+        return '\n'.join(lines) + '\n'
+
+    def hoist(self, lines):
+        """Appends the code computing the hoisted expressions of the trace that cannot raise"""
+        # hoisted node -> the python variable holding its value
+        self.invariants = {}
+        stack = [self.node.condition]
+        for ops in [self.ops] + [branch.ops for branch in self.branches.values()]:
+            stack.extend(op[2] if op[0] == 'assign' else op[1] for op in ops)
+        while stack:
+            node = stack.pop()
+            if isinstance(node, HOISTED) and self.safe(node):
+                if node not in self.invariants:
+                    source = self.expr(node)[0]
+                    self.invariants[node] = '__h{}'.format(len(self.invariants))
+                    lines.append('    {} = {}'.format(self.invariants[node], source))
+            else:
+                stack.extend(iter_child_nodes(node))
+
+    def safe(self, expr):
+        """Tells whether an expression of the variables the trace starts with cannot raise"""
+        kinds = set()
+        stack = [expr]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, Var):
+                kind = self.types.get(var_key(node))
+                if kind not in TRACE_TYPES:
+                    return False
+                kinds.add(kind)
+            elif isinstance(node, Num):
+                kinds.add(type(node.value))
+            elif isinstance(node, BinOp):
+                if node.op.type not in SAFE_OPS:
+                    return False
+                stack.append(node.left)
+                stack.append(node.right)
+            else:
+                stack.append(node.expr)
+        return not (int in kinds and float in kinds)
+
+    def guards(self, types):
+        return ' or '.join('type({}) is not {}'.format(py_var(key), kind.__name__) for key, kind in types.items())
+
+    def path(self, ops, depth, lines):
+        """Appends the code of a recorded path, branches inlined at their exits"""
+        indent = '    ' * depth
+        for op in ops:
+            if op[0] == 'assign':
+                lines.append('{}{} = {}'.format(indent, py_var(op[1]), self.expr(op[2])[0]))
+                continue
+            condition = self.expr(op[1])[0]
+            if op[2]:
+                condition = 'not ' + condition
+            lines.append('{}if {}:'.format(indent, condition))
+            branch = self.branches.get(op[3])
+            if branch is not None:
+                # variables the branch reads first may have any type here,
+                # if they differ it leaves by the exit it replaces
+                types = {key: kind for key, kind in branch.types.items()
+                         if key not in self.types or key in self.written}
+                if types:
+                    lines.append('{}    if {}:'.format(indent, self.guards(types)))
+                    lines.append('{}        __exit = {}'.format(indent, op[3]))
+                    lines.append('{}        break'.format(indent))
+                # the first op of the branch is the failed guard, taken the other way
+                self.path(branch.ops[1:], depth + 1, lines)
+                lines.append('{}    __count += 1'.format(indent))
+                lines.append('{}    continue'.format(indent))
+            else:
+                lines.append('{}    __exit = {}'.format(indent, op[3]))
+                lines.append('{}    break'.format(indent))
+
+    def expr(self, node):
+        """Returns (python source, precedence) of a traced expression"""
+        name = self.invariants.get(node)
+        if name is not None:
+            return name, ATOM_PREC
+        if isinstance(node, Var):
+            return py_var(var_key(node)), ATOM_PREC
+        if isinstance(node, Num):
+            value = node.value
+            if isinstance(value, float) and not math.isfinite(value):
+                self.consts.append(value)
+                return '__consts[{}]'.format(len(self.consts) - 1), ATOM_PREC
+            if math.copysign(1, value) < 0:
+                return '(' + repr(value) + ')', ATOM_PREC
+            return repr(value), ATOM_PREC
+        if isinstance(node, UnaryOp):
+            operand, prec = self.expr(node.expr)
+            if prec < UNARY_PREC:
+                operand = '(' + operand + ')'
+            return PY_UNARY[node.op.type] + operand, UNARY_PREC
+        left, left_prec = self.expr(node.left)
+        right, right_prec = self.expr(node.right)
+        op, prec = PY_BINARY[node.op.type]
+        #comparisons must never chain, everything else is left associative
+        if left_prec < prec or (left_prec == COMPARE_PREC and prec == COMPARE_PREC):
+            left = '(' + left + ')'
+        if right_prec <= prec:
+            right = '(' + right + ')'
+        return '{} {} {}'.format(left, op, right), prec
+
+
+class TraceLoop(object):
+    """The tracing state and counters of one While node"""
+
+    def __init__(self, node):
+        self.node = node
+        self.trace = None
+        self.count = 0
+        # iterations run by the interpreter and by traces
+        self.interpreted = 0
+        self.traced = 0
+        self.recordings = 0
+        self.traces = 0
+        self.branches = 0
+        self.entries = 0
+        self.type_failures = 0
+        self.side_exits = 0
+        self.compile_seconds = 0.0
+        blocker = untraceable(node)
+        self.disabled = blocker is not None
+        # why the loop is not traced, None while it may be
+        self.reason = None if blocker is None else 'holds {}'.format(node_label(blocker))
+
+    def hot(self):
+        return self.count >= HOT_LOOP_ITERATIONS
+
+    def compile(self, recorder):
+        """Compiles a recorded iteration, or gives up on it"""
+        self.recordings += 1
+        self.count = 0
+        if recorder.unsupported is None:
+            start = time.perf_counter()
+            try:
+                self.trace = Trace(recorder)
+                self.traces += 1
+                self.reason = None
+            except (RecursionError, SyntaxError, MemoryError):
+                recorder.unsupported = 'too deeply nested'
+            self.compile_seconds += time.perf_counter() - start
+        if recorder.unsupported is not None:
+            self.drop(recorder.unsupported)
+
+    def attach(self, exit, recorder):
+        """Compiles the branch recorded at a side exit into the trace"""
+        start = time.perf_counter()
+        if self.trace.attach(exit, recorder) is None:
+            self.branches += 1
+        self.compile_seconds += time.perf_counter() - start
+
+    def drop(self, reason):
+        """Drops the trace, the loop is recorded again once hot unless it was too often"""
+        self.trace = None
+        self.count = 0
+        self.reason = reason
+        if self.recordings >= MAX_RECORDINGS:
+            self.disabled = True
+
+
+class TracingInterpreter(Interpreter):
+    """Interpreter compiling the hot paths of While loops to python.
+
+    A While counts its interpreted iterations; after HOT_LOOP_ITERATIONS
+    the next one is recorded (see TraceRecorder) and compiled into a
+    Trace, which then runs the loop until its condition fails or an If
+    of the body takes the other arm. On such a side exit the interpreter
+    resumes at that If, finishes the iteration and enters the trace
+    again; once an exit is hot the rest of the iteration from it is
+    recorded too and compiled into the trace as a branch. A trace is
+    dropped when the variable types it was compiled for change or when
+    it mostly side exits; a loop recorded MAX_RECORDINGS times stays
+    interpreted. trace_stats() reports the counters.
+    """
+
+    def __init__(self, tree):
+        Interpreter.__init__(self, tree)
+        # While node -> its TraceLoop
+        self.loops = {}
+
+    def run_loop(self, node):
+        loop = self.loops.get(node)
+        if loop is None:
+            loop = self.loops[node] = TraceLoop(node)
+        if loop.disabled:
+            return self.interpret_loop(node, loop)
+        while True:
+            trace = loop.trace
+            if trace is not None:
+                loop.entries += 1
+                exit, count = trace.function(self.GLOBAL_MEMORY, self.locals)
+                loop.traced += count
+                trace.iterations += count
+                if exit == LOOP_DONE:
+                    return
+                if exit == ENTRY_GUARD_FAILED:
+                    loop.type_failures += 1
+                    loop.drop('variable types changed')
+                else:
+                    loop.side_exits += 1
+                    trace.side_exits += 1
+                    if trace.hot_exit(exit):
+                        recorder = TraceRecorder(self, node, trace.exits)
+                        recorder.record_exit(*trace.exits[exit - 1])
+                        loop.attach(exit, recorder)
+                    else:
+                        self.resume(*trace.exits[exit - 1])
+                    loop.interpreted += 1
+                    if trace.side_exits >= MIN_SIDE_EXITS and trace.side_exits > trace.iterations:
+                        loop.drop('left by side exits')
+                    continue
+            if loop.disabled:
+                return self.interpret_loop(node, loop)
+            if loop.hot():
+                recorder = TraceRecorder(self, node)
+                if not recorder.record():
+                    return
+                loop.interpreted += 1
+                loop.compile(recorder)
+                continue
+            if not self.visit(node.condition):
+                return
+            self.visit(node.body)
+            loop.interpreted += 1
+            loop.count += 1
+
+    def interpret_loop(self, node, loop):
+        """Runs the rest of a loop that is not traced"""
+        while self.visit(node.condition):
+            self.visit(node.body)
+            loop.interpreted += 1
+
+    def resume(self, node, position):
+        """Finishes an iteration left by a side exit at the If node"""
+        self.visit(node)
+        for statements, index in reversed(position):
+            for statement in statements[index + 1:]:
+                self.visit(statement)
+
+    def trace_stats(self):
+        """Returns (node, TraceLoop) for every While that ran, in source order"""
+        stats = list(self.loops.items())
+        stats.sort(key=lambda item: (item[0].line or 0, item[0].column or 0))
+        return stats
+
+    def trace_report(self):
+        """Returns the per loop iteration, guard and compile counters as text"""
+        row = '{:<12} {:>11} {:>11} {:>6} {:>8} {:>8} {:>10} {:>10} {:>10}  {}'
+        lines = [row.format('loop', 'interpreted', 'traced', 'traces', 'branches', 'entries',
+                            'type fails', 'side exits', 'compile ms', 'status')]
+        for node, loop in self.trace_stats():
+            position = '?' if node.line is None else '{}:{}'.format(node.line, node.column)
+            if loop.trace is not None:
+                status = 'traced, {} ops'.format(len(loop.trace.ops))
+            elif loop.reason is not None:
+                status = ('off, ' if loop.disabled else 'dropped, ') + loop.reason
+            else:
+                status = 'cold'
+            lines.append(row.format(position, loop.interpreted, loop.traced, loop.traces, loop.branches,
+                                    loop.entries, loop.type_failures, loop.side_exits,
+                                    '{:.3f}'.format(loop.compile_seconds * 1000), status))
+        return '\n'.join(lines)
@@ -0,0 +1,419 @@
+import math
+import re
+from collections import OrderedDict
+
+from parser_ruby import *
+from vm import *
+from loops import loop_plan, operators
+from rope import concat, flatten, plus
+from collection import Array, Range, call_method, iterate, method_steps
+
+#python operator and precedence of every binary operator, higher binds tighter
+PY_BINARY = {
+    PLUS: ('+', 2),
+    MINUS: ('-', 2),
+    MUL: ('*', 3),
+    DIV: ('/', 3),
+    MOD: ('%', 3),
+    EQUAL: ('==', 1),
+    NOT: ('!=', 1),
+    GRE: ('>=', 1),
+    LESE: ('<=', 1),
+    GRET: ('>', 1),
+    LEST: ('<', 1),
+}
+PY_UNARY = {PLUS: '+', MINUS: '-'}
+COMPARE_PREC = 1
+UNARY_PREC = 4
+ATOM_PREC = 5
+
+#hoisted loop invariants with fewer operators are recomputed, checking a
+#cached value costs python about as much as a single operation
+MIN_HOISTED_OPERATORS = 2
+
+#ruby variables become python locals with this prefix, so they can never
+#clash with python keywords, builtins or the helpers of the generated code
+VAR_PREFIX = 'v_'
+UNBOUND_RE = re.compile(r"'{}(\w+)'".format(VAR_PREFIX))
+
+
+def py_name(name):
+    return VAR_PREFIX + name
+
+
+def undefined(error):
+    """Returns the NameError(repr(name)) of a python NameError about a v_ local"""
+    match = UNBOUND_RE.search(str(error))
+    return NameError(repr(match.group(1)) if match else str(error))
+
+
+def new_array(items):
+    return Array.of(items)
+
+
+#helpers the generated code calls, by name
+HELPERS = {
+    '__concat': concat,
+    '__plus': plus,
+    '__array': new_array,
+    '__range': Range,
+    '__call': call_method,
+    '__iter': iterate,
+}
+
+
+class Transpiler(NodeVisitor):
+    """Turns the tree returned by Parser.parse() into python source.
+
+    The program becomes the function __ruby_main__(__init, __out): every
+    variable is a local, While/If/Else become native while/if/elif/else.
+    __init holds initial bindings; on exit, normal or not, the bound
+    locals are copied to __out. Expressions are only parenthesized where
+    python precedence requires it, so long operator chains stay flat.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.lines = []
+        self.indent = 0
+        self.names = []
+        self._seen = set()
+        self.consts = []
+        # ids of the BinOps transpiled as string joins
+        self._joins = set()
+        # hoisted node -> the local caching its value in the innermost loop
+        self._hoisted = {}
+        # hoisted locals named so far, an inner loop renames the invariants
+        # it shares with the enclosing one so len(_hoisted) may not grow
+        self._hoisted_count = 0
+
+    def emit(self, line):
+        self.lines.append('    ' * self.indent + line)
+
+    def name(self, name):
+        if name not in self._seen:
+            self._seen.add(name)
+            self.names.append(name)
+        return py_name(name)
+
+    def expr(self, node):
+        """Returns (python source, precedence) of an expression node"""
+        #subclasses of a node class are transpiled like their base class
+        for cls in type(node).__mro__:
+            method = getattr(self, 'expr_' + cls.__name__, None)
+            if method is not None:
+                return method(node)
+        raise Exception('No expr_{} method'.format(type(node).__name__))
+
+    def expr_BinOp(self, node):
+        left, left_prec = self.expr(node.left)
+        right, right_prec = self.expr(node.right)
+        if joins_strings(node, id(node.left) in self._joins, id(node.right) in self._joins):
+            #strings are joined as Ropes, see rope.py
+            self._joins.add(id(node))
+            return '__concat({}, {})'.format(left, right), ATOM_PREC
+        if node.op.type == PLUS and not adds_number(node):
+            #either operand may be a string, joined as a Rope when it is
+            return '__plus({}, {})'.format(left, right), ATOM_PREC
+        op, prec = PY_BINARY[node.op.type]
+        #comparisons must never chain, everything else is left associative
+        if left_prec < prec or (left_prec == COMPARE_PREC and prec == COMPARE_PREC):
+            left = '(' + left + ')'
+        if right_prec <= prec:
+            right = '(' + right + ')'
+        return '{} {} {}'.format(left, op, right), prec
+
+    def expr_UnaryOp(self, node):
+        operand, prec = self.expr(node.expr)
+        if prec < UNARY_PREC:
+            operand = '(' + operand + ')'
+        return PY_UNARY[node.op.type] + operand, UNARY_PREC
+
+    def expr_HoistedBinOp(self, node):
+        source, prec = self.expr_BinOp(node) if isinstance(node, BinOp) else self.expr_UnaryOp(node)
+        local = self._hoisted.get(node)
+        if local is None:
+            return source, prec
+        return '({0} if {0} is not None else ({0} := {1}))'.format(local, source), ATOM_PREC
+
+    expr_HoistedUnaryOp = expr_HoistedBinOp
+
+    def expr_Num(self, node):
+        value = node.value
+        if isinstance(value, float) and not math.isfinite(value):
+            self.consts.append(value)
+            return '__consts[{}]'.format(len(self.consts) - 1), ATOM_PREC
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and math.copysign(1, value) < 0:
+            return '(' + repr(value) + ')', ATOM_PREC
+        return repr(value), ATOM_PREC
+
+    def expr_Var(self, node):
+        return self.name(node.value), ATOM_PREC
+
+    def expr_ArrayLiteral(self, node):
+        return '__array([{}])'.format(', '.join(self.expr(item)[0] for item in node.items)), ATOM_PREC
+
+    def expr_RangeLiteral(self, node):
+        return '__range({}, {}, {})'.format(self.expr(node.first)[0], self.expr(node.last)[0],
+                                            node.exclusive), ATOM_PREC
+
+    def expr_MethodCall(self, node):
+        receiver = self.expr(node.receiver)[0]
+        if node.body is None:
+            return '__call({}, {!r})'.format(receiver, node.name), ATOM_PREC
+        #the parameter is a lambda local, it never becomes a ruby variable
+        seen = node.param in self._seen
+        self._seen.add(node.param)
+        body = self.expr(node.body)[0]
+        if not seen:
+            self._seen.discard(node.param)
+        return '__call({}, {!r}, lambda {}: {})'.format(receiver, node.name, py_name(node.param), body), ATOM_PREC
+
+    def expr_Call(self, node):
+        #only blocks call methods, programs defining them run on the Interpreter
+        args = ', '.join(self.expr(arg)[0] for arg in node.args)
+        return '__invoke({!r}, [{}])'.format(node.name, args), ATOM_PREC
+
+    def block(self, nodes):
+        start = len(self.lines)
+        self.indent += 1
+        for node in nodes:
+            self.visit(node)
+        if len(self.lines) == start:
+            self.emit('pass')
+        self.indent -= 1
+
+    def visit_Compound(self, node):
+        for child in node.children:
+            self.visit(child)
+
+    def visit_Assign(self, node):
+        self.emit('{} = {}'.format(self.name(node.left.value), self.expr(node.right)[0]))
+
+    def visit_If(self, node, keyword='if'):
+        self.emit('{} {}:'.format(keyword, self.expr(node.condition)[0]))
+        self.block(node.body)
+        rest = node.rest
+        if isinstance(rest, If):
+            self.visit_If(rest, 'elif')
+        elif isinstance(rest, Else):
+            self.emit('else:')
+            self.block(rest.body)
+        elif rest:
+            self.emit('else:')
+            self.block(rest)
+
+    def visit_While(self, node):
+        plan = loop_plan(node)
+        closed = plan.closed
+        if closed is not None:
+            #the loop only runs when its ClosedForm cannot be solved
+            self.consts.append(closed)
+            values = ', '.join('__state.get({!r})'.format(self.name(var.value)) for var in closed.vars)
+            self.emit('__state = locals()')
+            self.emit('__values = __consts[{}].solve([{}])'.format(len(self.consts) - 1, values))
+            self.emit('if __values is None:')
+            self.indent += 1
+        for invariant in plan.invariants:
+            if operators(invariant) >= MIN_HOISTED_OPERATORS:
+                local = self._hoisted[invariant] = '__h{}'.format(self._hoisted_count)
+                self._hoisted_count += 1
+                self.emit('{} = None'.format(local))
+        self.emit('while {}:'.format(self.expr(node.condition)[0]))
+        self.block(node.body)
+        if closed is not None:
+            self.indent -= 1
+            self.emit('else:')
+            targets = ''.join(self.name(var.value) + ', ' for var in closed.vars[:closed.targets])
+            self.emit('    {}= __values'.format(targets))
+
+    def visit_For(self, node):
+        self.emit('for {} in __iter({}):'.format(self.name(node.var.value), self.expr(node.iterable)[0]))
+        self.block(node.body)
+
+    def visit_NoOp(self, node):
+        pass
+
+    def visit_list(self, node):
+        for child in node:
+            self.visit(child)
+
+    def generic_visit(self, node):
+        #any other node is an expression statement, run for its errors
+        self.emit(self.expr(node)[0])
+
+    def transpile(self):
+        if self.tree is not None:
+            self.indent = 2
+            self.visit(self.tree)
+        body = self.lines
+        self.indent = 0
+        self.lines = []
+        self.emit('def __ruby_main__(__init, __out):')
+        self.indent = 1
+        for name in self.names:
+            self.emit("if {!r} in __init: {} = __init[{!r}]".format(name, py_name(name), name))
+        self.emit('try:')
+        self.indent = 2
+        self.emit('pass')
+        self.lines.extend(body)
+        self.indent = 1
+        self.emit('finally:')
+        self.emit('    __out.update(locals())')
+        return '\n'.join(self.lines) + '\n'
+
+
+class CompiledProgram(object):
+    """Python code object of a transpiled program"""
+
+    def __init__(self, tree):
+        transpiler = Transpiler(tree)
+        self.source = transpiler.transpile()
+        self.names = transpiler.names
+        self.consts = transpiler.consts
+        namespace = dict(HELPERS, __consts=self.consts, __builtins__={'locals': locals})
+        exec(compile(self.source, '<ruby>', 'exec'), namespace)
+        self.function = namespace['__ruby_main__']
+
+    def run(self, initial=None):
+        """Runs the program and returns the final bindings.
+
+        An undefined variable raises NameError(repr(name)) like the tree
+        walking Interpreter. On any error the bindings made so far are
+        attached to the exception as .bindings.
+        """
+        out = {}
+        try:
+            self.function(initial or {}, out)
+        except NameError as e:
+            # an unbound local, or a free variable of a block
+            error = undefined(e)
+            error.bindings = self.bindings(out)
+            raise error from None
+        except Exception as e:
+            e.bindings = self.bindings(out)
+            raise
+        return self.bindings(out)
+
+    def bindings(self, out):
+        result = {}
+        for name in self.names:
+            value = out.get(py_name(name))
+            if value is not None:
+                result[name] = flatten(value)
+        return result
+
+
+class NativeBlock(object):
+    """The expression block of a MethodCall compiled to a python function.
+
+    The body becomes lambda v_param: body, its other variables (free)
+    are read from the program when the function is made, so a block
+    runs as native code on every element whatever backend runs the
+    program.
+    """
+
+    def __init__(self, param, body):
+        transpiler = Transpiler(None)
+        transpiler._seen.add(param)
+        source = 'lambda {}: {}'.format(py_name(param), transpiler.expr(body)[0])
+        self.param = param
+        self.free = transpiler.names
+        self.consts = transpiler.consts
+        self.code = compile(source, '<ruby block>', 'eval')
+
+    def function(self, values, invoke=None):
+        """Returns the python function of the block, values are the ones of
+        the free variables in order, None for an unset one. invoke(name,
+        args) calls the methods the block calls."""
+        namespace = dict(HELPERS, __consts=self.consts, __invoke=invoke, __builtins__={})
+        for name, value in zip(self.free, values):
+            if value is not None:
+                namespace[py_name(name)] = value
+        return eval(self.code, namespace)
+
+    def call(self, receiver, name, values, invoke=None):
+        """Calls the method name of receiver with the block"""
+        try:
+            return call_method(receiver, name, self.function(values, invoke))
+        except NameError as e:
+            raise undefined(e) from None
+
+    def steps(self, receiver, name, values, invoke=None):
+        """Generator version of call(), see collection.method_steps()"""
+        try:
+            return (yield from method_steps(receiver, name, self.function(values, invoke)))
+        except NameError as e:
+            raise undefined(e) from None
+
+
+def native_block(node):
+    """Returns the NativeBlock of a MethodCall with a block, made once per node"""
+    if node.native is None:
+        node.native = NativeBlock(node.param, node.body)
+    return node.native
+
+
+class CodeCache(object):
+    """Bounded LRU cache of CompiledPrograms.
+
+    Keys are either a tree, looked up by identity, or source text. A tree
+    entry keeps a reference to its tree so its id cannot be reused while
+    the entry exists.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tree, source=None):
+        key = ('source', source) if source is not None else ('tree', id(tree))
+        entry = self.entries.get(key)
+        if entry is not None and (source is not None or entry[0] is tree):
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        program = CompiledProgram(tree)
+        self.entries[key] = (tree, program)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return program
+
+    def clear(self):
+        self.entries.clear()
+
+
+CODE_CACHE = CodeCache()
+
+
+class PythonBackend(object):
+    """Runs a tree as a compiled python code object.
+
+    Trees the python compiler cannot handle (too deeply nested for it)
+    fall back to the bytecode VM, which gives the same results.
+    """
+
+    def __init__(self, tree, cache=CODE_CACHE, source=None):
+        self.tree = tree
+        self.GLOBAL_MEMORY = {}
+        try:
+            self.program = cache.get(tree, source)
+            self.fallback = None
+        except (RecursionError, SyntaxError, MemoryError):
+            self.program = None
+            self.fallback = VM(Compiler(tree).compile())
+
+    def interpret(self):
+        if self.fallback is not None:
+            try:
+                return self.fallback.interpret()
+            finally:
+                self.GLOBAL_MEMORY = self.fallback.GLOBAL_MEMORY
+        try:
+            self.GLOBAL_MEMORY = self.program.run()
+        except Exception as e:
+            self.GLOBAL_MEMORY = getattr(e, 'bindings', {})
+            raise
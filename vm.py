@@ -0,0 +1,215 @@
+import operator
+import sys
+from itertools import count
+
+from compiler import *
+from rope import Rope, concat, plus
+from collection import Array, Range, call_method, iterate, method_steps
+
+#implementations of BINARY_OPS / UNARY_OPS, indexed by the instruction
+#argument, followed by the ones of CONCAT and ADD_NUMBER. A + of unknown
+#operands joins strings into Ropes like the tree walker does
+BINARY_FUNCS = (
+    plus,
+    operator.sub,
+    operator.mul,
+    operator.truediv,
+    operator.mod,
+    operator.eq,
+    operator.ne,
+    operator.ge,
+    operator.le,
+    operator.gt,
+    operator.lt,
+    concat,
+    operator.add,
+)
+UNARY_FUNCS = (operator.pos, operator.neg)
+
+#the only values whose size an operation can blow up
+GROWING_TYPES = (str, int, Rope, Array)
+
+
+class LimitExceeded(Exception):
+    """A program ran past its step or memory limit"""
+
+
+class VM(object):
+    """Stack machine that runs the Bytecode produced by Compiler.
+
+    Produces the same GLOBAL_MEMORY contents as the tree walking
+    Interpreter, which is kept as the reference backend.
+    """
+
+    def __init__(self, bytecode):
+        self.bytecode = bytecode
+        self.frame = bytecode.symbols.new_frame()
+        # where run_slice() continues
+        self.code = bytecode.code.tolist()
+        self.pc = 0
+        self.stack = []
+        # values of the hoisted loop invariants, None until computed
+        self.hoisted = [None] * bytecode.hoisted
+        self.steps = 0
+        self.halted = False
+        # generator of the collection method a stepped slice is inside of
+        # and the values it collected so far, see run_slice()
+        self.method = None
+        self.collected = None
+
+    @property
+    def GLOBAL_MEMORY(self):
+        return self.bytecode.symbols.view(self.frame)
+
+    def run(self):
+        """Runs the program to its end"""
+        self.run_slice(None)
+
+    def run_slice(self, budget, memory_limit=None, step_methods=False):
+        """Runs at most budget instructions, continuing where the last slice stopped.
+
+        A budget of None runs the program to its end, which is all run()
+        does. Returns True once the program has halted. With memory_limit
+        set, a string or int result bigger than memory_limit bytes raises
+        LimitExceeded right away; the total size of the variables is left
+        to the caller to check between slices, see memory_size().
+
+        With step_methods set a collection method takes one instruction
+        per element it calls its block on, so a map over a huge range
+        spreads over many slices and the memory limit is checked as its
+        result grows.
+        """
+        if self.halted:
+            return True
+        code = self.code
+        consts = self.bytecode.consts
+        names = self.bytecode.names
+        frame = self.frame
+        hoisted = self.hoisted
+        binary_funcs = BINARY_FUNCS
+        unary_funcs = UNARY_FUNCS
+        stack = self.stack
+        push = stack.append
+        pop = stack.pop
+        pc = self.pc
+        # index of the instruction running, the loop itself keeps the budget
+        executed = -1
+        try:
+            for executed in (count() if budget is None else range(budget)):
+                op = code[pc]
+                arg = code[pc + 1]
+                pc += 2
+                if op == LOAD_SLOT:
+                    value = frame[arg]
+                    if value is None:
+                        raise NameError(repr(names[arg]))
+                    push(value)
+                elif op == LOAD_CONST:
+                    push(consts[arg])
+                elif op == BINARY_OP:
+                    right = pop()
+                    value = stack[-1] = binary_funcs[arg](stack[-1], right)
+                    if memory_limit is not None and type(value) in GROWING_TYPES and sys.getsizeof(value) > memory_limit:
+                        raise LimitExceeded('memory limit of {} bytes exceeded'.format(memory_limit))
+                elif op == STORE_SLOT:
+                    frame[arg] = pop()
+                elif op == POP_JUMP_IF_FALSE:
+                    if not pop():
+                        pc = arg
+                elif op == JUMP:
+                    pc = arg
+                elif op == UNARY_OP:
+                    stack[-1] = unary_funcs[arg](stack[-1])
+                elif op == LOAD_HOISTED:
+                    index, end = consts[arg]
+                    value = hoisted[index]
+                    if value is not None:
+                        push(value)
+                        pc = end
+                elif op == HOIST:
+                    hoisted[arg] = stack[-1]
+                elif op == FOR_ITER:
+                    try:
+                        push(next(stack[-1]))
+                    except StopIteration:
+                        pop()
+                        pc = arg
+                elif op == CLEAR_HOISTED:
+                    for index in consts[arg]:
+                        hoisted[index] = None
+                elif op == CLOSED_LOOP:
+                    pc = self.closed_loop(consts[arg], pc)
+                elif op == CALL_METHOD:
+                    if step_methods:
+                        method = self.method
+                        if method is None:
+                            method = self.method = self.method_steps(consts[arg], stack[-1])
+                        try:
+                            collected = self.collected = next(method)
+                        except StopIteration as stop:
+                            self.method = self.collected = None
+                            value = stack[-1] = stop.value
+                        else:
+                            # run the instruction again for the next element
+                            pc -= 2
+                            if memory_limit is not None and sys.getsizeof(collected) > memory_limit:
+                                raise LimitExceeded('memory limit of {} bytes exceeded'.format(memory_limit))
+                            continue
+                    else:
+                        value = stack[-1] = self.call_method(consts[arg], stack[-1])
+                    if memory_limit is not None and type(value) in GROWING_TYPES and sys.getsizeof(value) > memory_limit:
+                        raise LimitExceeded('memory limit of {} bytes exceeded'.format(memory_limit))
+                elif op == GET_ITER:
+                    stack[-1] = iterate(stack[-1])
+                elif op == BUILD_ARRAY:
+                    items = Array.of(stack[len(stack) - arg:])
+                    del stack[len(stack) - arg:]
+                    push(items)
+                elif op == BUILD_RANGE:
+                    right = pop()
+                    stack[-1] = Range(stack[-1], right, arg == 1)
+                elif op == HALT:
+                    self.halted = True
+                    return True
+                else:
+                    raise Exception('Unknown opcode {}'.format(op))
+            return False
+        finally:
+            self.pc = pc
+            self.steps += executed + 1
+
+    def closed_loop(self, site, pc):
+        """Runs the CLOSED_LOOP site (closed, slots, end), returns where to continue"""
+        closed, slots, end = site
+        frame = self.frame
+        values = closed.solve([frame[slot] for slot in slots])
+        if values is None:
+            return pc
+        for slot, value in zip(slots, values):
+            frame[slot] = value
+        return end
+
+    def call_method(self, site, receiver):
+        """Runs the CALL_METHOD site (name, block, slots) on receiver"""
+        name, block, slots = site
+        if block is None:
+            return call_method(receiver, name)
+        frame = self.frame
+        return block.call(receiver, name, [frame[slot] for slot in slots])
+
+    def method_steps(self, site, receiver):
+        """Returns the generator running the CALL_METHOD site on receiver in steps"""
+        name, block, slots = site
+        if block is None:
+            return method_steps(receiver, name)
+        frame = self.frame
+        return block.steps(receiver, name, [frame[slot] for slot in slots])
+
+    def memory_size(self):
+        """Returns the bytes held by the variables, the value stack and a stepped method"""
+        size = sum(sys.getsizeof(value) for value in self.frame + self.hoisted if value is not None)
+        size += sys.getsizeof(self.collected) if self.collected is not None else 0
+        return size + sum(sys.getsizeof(value) for value in self.stack)
+
+    def interpret(self):
+        return self.run()
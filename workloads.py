@@ -0,0 +1,102 @@
+#Generators of scaled benchmark programs. Every generator returns a
+#Workload holding the source text and the number of loop iterations the
+#program performs when it runs.
+
+
+class Workload(object):
+    def __init__(self, name, source, iterations=0):
+        self.name = name
+        self.source = source
+        self.iterations = iterations
+
+    def __repr__(self):
+        return 'Workload({}, {} chars)'.format(self.name, len(self.source))
+
+
+def arithmetic_chain(terms=20000, lines=10):
+    """lines assignments, each a chain of terms mixed +,-,*,/,% operations"""
+    ops = ('+', '-', '*', '/', '%')
+    out = ['x = 3']
+    per_line = max(1, terms // lines)
+    for line in range(lines):
+        parts = ['x']
+        for i in range(per_line):
+            parts.append(ops[i % len(ops)])
+            parts.append(str(i % 9 + 1))
+        out.append('a{} = {}'.format(line, ' '.join(parts)))
+    return Workload('arithmetic_chain', '\n'.join(out) + '\n')
+
+
+def nested_parens(depth=200, copies=50):
+    """copies assignments of an expression nested depth parentheses deep"""
+    expr = 'x'
+    for i in range(depth):
+        expr = '({} + {})'.format(expr, i % 7)
+    out = ['x = 1']
+    for i in range(copies):
+        out.append('n{} = {}'.format(i, expr))
+    return Workload('nested_parens', '\n'.join(out) + '\n')
+
+
+def while_loop(iterations=200000):
+    """One while loop counting to iterations and accumulating a sum"""
+    source = (
+        'i = 0\n'
+        's = 0\n'
+        'while i < {}\n'
+        '    i = i + 1\n'
+        '    s = s + i % 7\n'
+        'end\n'
+    ).format(iterations)
+    return Workload('while_loop', source, iterations)
+
+
+def if_ladder(width=200, iterations=2000):
+    """A while loop around an if/elsif ladder width arms wide"""
+    out = ['i = 0', 'hits = 0', 'while i < {}'.format(iterations)]
+    out.append('    v = i % {}'.format(width))
+    for arm in range(width):
+        out.append('    {} v == {}'.format('if' if arm == 0 else 'elsif', arm))
+        out.append('        hits = hits + {}'.format(arm % 5 + 1))
+    out.append('    else')
+    out.append('        hits = hits - 1')
+    out.append('    end')
+    out.append('    i = i + 1')
+    out.append('end')
+    return Workload('if_ladder', '\n'.join(out) + '\n', iterations)
+
+
+def many_variables(count=5000):
+    """count distinct variables, each computed from the previous ones"""
+    out = ['v0 = 1', 'v1 = 2']
+    for i in range(2, count):
+        out.append('v{} = v{} + v{} % 10'.format(i, i - 1, i - 2))
+    return Workload('many_variables', '\n'.join(out) + '\n')
+
+
+GENERATORS = {
+    'arithmetic_chain': arithmetic_chain,
+    'nested_parens': nested_parens,
+    'while_loop': while_loop,
+    'if_ladder': if_ladder,
+    'many_variables': many_variables,
+}
+
+#the size argument of every generator at scale 1
+DEFAULT_SIZES = {
+    'arithmetic_chain': 20000,
+    'nested_parens': 200,
+    'while_loop': 200000,
+    'if_ladder': 200,
+    'many_variables': 5000,
+}
+
+
+def generate(name, scale=1.0):
+    """Builds the named workload with its size multiplied by scale"""
+    size = max(1, int(DEFAULT_SIZES[name] * scale))
+    return GENERATORS[name](size)
+
+
+def generate_all(scale=1.0, names=None):
+    return [generate(name, scale) for name in (names or GENERATORS)]